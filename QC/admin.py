@@ -3,6 +3,6 @@ from django.contrib import admin
 from .models import ExecutionStats
 
 class ExecutionStatsAdmin(admin.ModelAdmin):
-    list_display = ('project_id', 'details')
+    list_display = ('project', 'details')
 
 admin.site.register(ExecutionStats, ExecutionStatsAdmin)
\ No newline at end of file
@@ -16,3 +16,45 @@ Storage
 
 ENV_PATH = os.path.abspath(os.path.dirname(__file__))
 PROJECT_STORAGE = os.path.abspath(os.path.join(ENV_PATH, '../JamBio/Project_Storage/'))
+
+# FastQC scheduling. Files are run largest first on a pool of
+# FASTQC_WORKERS processes, each using FASTQC_THREADS threads. The pool is
+# shrunk so that the total stays within MAX_QC_THREADS threads and
+# MAX_QC_MEMORY_MB of memory, FastQC reserves FASTQC_MEMORY_MB per thread.
+FASTQC_WORKERS = 4
+FASTQC_THREADS = 1
+FASTQC_MEMORY_MB = 250
+MAX_QC_THREADS = 8
+MAX_QC_MEMORY_MB = 4096
+
+# rq job timeouts in seconds. FastQC runs for hours on large FastQs,
+# well past the 180 seconds rq allows a job by default.
+QC_FASTQC_JOB_TIMEOUT = 6 * 60 * 60
+QC_MULTIQC_JOB_TIMEOUT = 60 * 60
+
+# Incremental QC reuses the FastQC output of files whose fingerprint
+# (path, size, mtime and, if QC_CONTENT_HASH is set, a SHA-256 of the
+# file) matches the last successful run instead of running FastQC again.
+QC_INCREMENTAL = True
+QC_CONTENT_HASH = False
+
+# Number of recently finished FastQC tasks used to estimate throughput
+# for the time remaining on a QC run.
+QC_ETA_HISTORY = 200
+
+# QC engine: 'fastqc' runs the FastQC tool on every file, 'quicklook' runs
+# QuickLookQC, a numpy triage of the first QC_QUICKLOOK_MAX_READS reads
+# (None for every read) in batches of QC_QUICKLOOK_BATCH_READS, written in
+# FastQC's format so MultiQC reports it the same way.
+QC_ENGINE = 'fastqc'
+QC_QUICKLOOK_BATCH_READS = 100000
+QC_QUICKLOOK_MAX_READS = 1000000
+
+# Adapter sequences searched for by QuickLookQC, as in FastQC's adapter list
+QC_ADAPTERS = {
+    'Illumina Universal Adapter': 'AGATCGGAAGAG',
+    "Illumina Small RNA 3' Adapter": 'TGGAATTCTCGG',
+    "Illumina Small RNA 5' Adapter": 'GATCGTCGGACT',
+    'Nextera Transposase Sequence': 'CTGTCTCTTATA',
+    'SOLID Small RNA Adapter': 'CGCCTTGGCCGT',
+}
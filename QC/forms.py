@@ -1,5 +1,5 @@
 from django import forms
-from .constants import PROJECT_STORAGE
+from .constants import PROJECT_STORAGE, QC_ENGINE
 import os
 
 class ProjectDirInputForm(forms.Form):
@@ -9,3 +9,14 @@ class ProjectDirInputForm(forms.Form):
         allow_folders=True,
         label="Project Directory"
         )
+    incremental = forms.BooleanField(
+        initial=True,
+        required=False,
+        label="Reuse FastQC results of unchanged files?"
+        )
+    engine = forms.ChoiceField(
+        choices=[('fastqc', 'FastQC'), ('quicklook', 'Quick look')],
+        initial=QC_ENGINE,
+        required=False,
+        label="QC Engine"
+        )
@@ -1,7 +1,13 @@
 from django.db import models
 
+from Transfer.models import Project
+
 class ExecutionStats(models.Model):
-    project_id = models.CharField(max_length=20)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='qc_execution_stats')
 
     ANALYSIS_TYPE = (
         ('FQC', 'FastQC'),
@@ -27,5 +33,70 @@ class ExecutionStats(models.Model):
     )
     details = models.CharField(max_length=256, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'exec_date']),
+        ]
+
     def __str__(self):
         return 'Project: ' + self.project_id
+
+class FastQCJob(models.Model):
+    """FastQC task for a single file of a QC run, updated by the worker
+    running it."""
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='fastqc_jobs')
+    run_output_dir = models.CharField(max_length=256)
+    fastq_path = models.CharField(max_length=256)
+    fastq_size = models.BigIntegerField(null=True)
+    job_id = models.CharField(max_length=64, null=True)
+    TASK_STATUS = (
+        ('QUEUED',  'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE',    'Done'),
+        ('FAILED',  'Failed')
+    )
+    status = models.CharField(
+        max_length=7,
+        choices=TASK_STATUS,
+        default='QUEUED',
+    )
+    reused = models.BooleanField(
+        default=False,
+        help_text="Output linked from an earlier run instead of computed.")
+    enqueued_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'enqueued_at']),
+            models.Index(fields=['project', 'run_output_dir', 'status']),
+            models.Index(fields=['status', 'finished_at']),
+        ]
+
+    def __str__(self):
+        return 'FastQC job: ' + self.fastq_path
+
+class FastQCFingerprint(models.Model):
+    """Last successful FastQC output for a FastQ file, with the file
+    properties it was computed from."""
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='fastqc_fingerprints')
+    fastq_path = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    content_hash = models.CharField(max_length=64, null=True)
+    engine = models.CharField(max_length=10, default='fastqc')
+    fastqc_output_dir = models.CharField(max_length=256)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return 'Fingerprint: ' + self.fastq_path
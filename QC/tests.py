@@ -1,15 +1,24 @@
 import os
+import gzip
 import shutil
+import zipfile
+import unittest
+import itertools
+from unittest import mock
 from time import gmtime, strftime
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory
 from django.urls import reverse, path
 from django.utils import timezone
 
-from .views import QC
-from .models import ExecutionStats
-from .constants import PROJECT_STORAGE
+from .views import QC, signer
+from .utils import qc_progress, status_logger, QuickLookQC, numpy
+from .models import ExecutionStats, FastQCJob
+from .constants import (
+    PROJECT_STORAGE, MAX_QC_THREADS, FASTQC_THREADS, QC_FASTQC_JOB_TIMEOUT, QC_MULTIQC_JOB_TIMEOUT
+    )
 from .forms import ProjectDirInputForm
+from Transfer.models import Project
 
 class QCTest(TestCase):
 
@@ -27,6 +36,162 @@ class QCTest(TestCase):
         form = ProjectDirInputForm(data=form_data)
         self.assertTrue(form.is_valid())
 
+    def test_status_logger_creates_project(self):
+
+        status_logger('QC_Logged_Test', 'OK', 'FQC', details='Logged')
+
+        self.assertTrue(Project.objects.filter(project_id='QC_Logged_Test').exists())
+        self.assertEqual(ExecutionStats.objects.get(project_id='QC_Logged_Test').details, 'Logged')
+
+    def test_fastqc_pool_size(self):
+
+        self.assertEqual(QC.fastqc_pool_size(workers=1), 1)
+        self.assertTrue(QC.fastqc_pool_size(workers=1000) * FASTQC_THREADS <= MAX_QC_THREADS)
+
+    def test_accepts_gzip(self):
+
+        factory = RequestFactory()
+        for accept_encoding, accepted in [
+                ('gzip, deflate', True),
+                ('deflate, GZIP;q=0.5', True),
+                ('gzip;q=0', False),
+                ('gzip; q=0.000, *', False),
+                ('*;q=0.1', True),
+                ('identity', False),
+                ('', False)]:
+            request = factory.get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertEqual(QC.accepts_gzip(request), accepted, accept_encoding)
+
+    def test_largest_files_first(self):
+
+        sizes = [os.path.getsize(path) for path in self.runner.fastq_files()]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+
+    def test_incremental_reuse(self):
+
+        self.assertEqual(self.runner.run_fastqc(), 0)
+
+        rerun = QC(self.proj_id, self.project_directory, self.timestamp + '-rerun')
+        try:
+            rerun.run_fastqc()
+            for out_file in os.listdir(self.runner.fastqc_output_dir):
+                self.assertTrue(os.path.samefile(
+                    os.path.join(self.runner.fastqc_output_dir, out_file),
+                    os.path.join(rerun.fastqc_output_dir, out_file)
+                    ))
+        finally:
+            shutil.rmtree(rerun.run_output_dir)
+
+    def test_enqueue_jobs(self):
+
+        queue = mock.Mock()
+        job_ids = itertools.count()
+        queue.enqueue.side_effect = lambda *args, **kwargs: mock.Mock(id=f'job-{next(job_ids)}')
+
+        fastqc_jobs, multiqc_job = self.runner.enqueue_jobs(queue)
+        fastq_paths = self.runner.fastq_files()
+
+        # One FastQC job per file, MultiQC depending on all of them
+        self.assertEqual(len(fastqc_jobs), len(fastq_paths))
+        fastqc_calls, multiqc_call = queue.enqueue.call_args_list[:-1], queue.enqueue.call_args_list[-1]
+        self.assertEqual([call.args[1] for call in fastqc_calls], fastq_paths)
+        for call in fastqc_calls:
+            self.assertEqual(call.kwargs, {'job_timeout': QC_FASTQC_JOB_TIMEOUT})
+        self.assertEqual(multiqc_call.kwargs, {'depends_on': fastqc_jobs, 'job_timeout': QC_MULTIQC_JOB_TIMEOUT})
+
+        for fastq_path, job in zip(fastq_paths, fastqc_jobs):
+            task = FastQCJob.objects.get(run_output_dir=self.runner.run_output_dir, fastq_path=fastq_path)
+            self.assertEqual(task.job_id, job.id)
+            self.assertEqual(task.status, 'QUEUED')
+
+    def test_fastqc_job_error(self):
+
+        fastq_path = self.runner.fastq_files()[0]
+        self.runner.create_tasks([fastq_path])
+
+        with mock.patch.object(QC, 'run_single_fastqc', side_effect=FileNotFoundError('fastqc')), \
+                mock.patch.object(QC, 'publish_finished') as publish_finished:
+            with self.assertRaises(FileNotFoundError):
+                self.runner.run_fastqc_job(fastq_path)
+
+        self.assertEqual(self.runner.task_records(fastq_path).get().status, 'FAILED')
+        publish_finished.assert_called_once_with('FAILED')
+        self.assertTrue(
+            ExecutionStats.objects.filter(project_id=self.proj_id, exec_status='FAIL', analysis_type='FQC').exists())
+
+    def test_report_without_tasks(self):
+
+        report_path = os.path.join(self.runner.multiqc_output_dir, self.proj_id + '_multiqc_report.html')
+        with open(report_path, 'w') as report:
+            report.write('<html>MultiQC</html>')
+
+        # QC run before FastQCJob rows were kept
+        self.assertFalse(FastQCJob.objects.filter(project_id=self.proj_id).exists())
+        response = Client().get(reverse('show_report', args=[signer.sign(self.proj_id)]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'<html>MultiQC</html>')
+
+    def test_progress_from_tasks(self):
+
+        self.runner.run_fastqc()
+        progress = qc_progress(self.proj_id)
+
+        self.assertEqual(progress['run_output_dir'], self.runner.run_output_dir)
+        self.assertEqual(progress['total'], 2)
+        self.assertEqual(progress['done'], 2)
+        self.assertEqual(progress['percent_complete'], 100)
+        self.assertIsNone(progress['eta_seconds'])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_quicklook(self):
+
+        quicklook = QC(self.proj_id, self.project_directory, self.timestamp + '-quicklook', engine='quicklook')
+        try:
+            self.assertEqual(quicklook.run_fastqc(), 0)
+
+            fastq_path = quicklook.fastq_files()[0]
+            html_name, zip_name = QC.fastqc_output_names(fastq_path)
+            self.assertTrue(os.path.isfile(os.path.join(quicklook.fastqc_output_dir, html_name)))
+
+            with zipfile.ZipFile(os.path.join(quicklook.fastqc_output_dir, zip_name)) as fastqc_zip:
+                fastqc_data = fastqc_zip.read(zip_name[:-len('.zip')] + '/fastqc_data.txt').decode()
+            with gzip.open(fastq_path, 'rb') as fastq:
+                read_count = len(fastq.read().splitlines()) // 4
+
+            self.assertTrue(fastqc_data.startswith('##FastQC'))
+            self.assertIn(f'Total Sequences\t{read_count}\n', fastqc_data)
+            for module_name in ['Per base sequence quality', 'Per base N content', 'Adapter Content']:
+                self.assertIn(f'>>{module_name}\t', fastqc_data)
+
+            # FastQC output is never reused for a quick look or the other way around
+            self.assertFalse(self.runner.reuse_fastqc_output(fastq_path))
+        finally:
+            shutil.rmtree(quicklook.run_output_dir)
+
+    def test_quicklook_statistics(self):
+
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+
+        quicklook = QuickLookQC('reads.fastq.gz', batch_reads=2)
+        quicklook.add_batch([b'ACGTAGATCGGAAGAG', b'GGCCN'], [b'IIIIIIIIIIIIIIII', b'!!!!!'])
+        quicklook.add_batch([b'AAAA'], [b'5555'])
+        modules = {module[0]: module for module in quicklook.modules()}
+
+        self.assertEqual(quicklook.read_count, 3)
+        base_quality = modules['Per base sequence quality'][3]
+        self.assertEqual(len(base_quality), 16)
+        # Cycle 1 holds qualities 40, 0 and 20
+        self.assertEqual(base_quality[0][1], 20.0)
+        self.assertEqual(base_quality[0][2], 20)
+        self.assertEqual(modules['Sequence Length Distribution'][3], [[4, 1.0], [5, 1.0], [16, 1.0]])
+        # One read in three has the universal adapter from position 5
+        adapter_rows = modules['Adapter Content'][3]
+        self.assertEqual(adapter_rows[3][1], 0.0)
+        self.assertAlmostEqual(adapter_rows[4][1], 100 / 3, places=3)
+        self.assertEqual(modules['Adapter Content'][1], 'fail')
+
     def test_qc_run(self):
 
         # Test FastQC
@@ -64,6 +229,32 @@ class QCTest(TestCase):
         response = c.get('/QC/reports/' + id_hash)
         self.assertEqual(response.status_code, 200)
 
+        # Test conditional and compressed report fetching
+        self.assertTrue(os.path.isfile(expected_report_path + '.gz'))
+
+        identity_etag = response['ETag']
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        response = c.get('/QC/reports/' + id_hash, HTTP_IF_NONE_MATCH=identity_etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        response = c.get('/QC/reports/' + id_hash, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertNotEqual(response['ETag'], identity_etag)
+        with open(expected_report_path, 'rb') as report:
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), report.read())
+
+        # The identity ETag does not validate the gzip copy
+        response = c.get('/QC/reports/' + id_hash, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=identity_etag)
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get('/QC/reports/' + id_hash, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['ETag'], identity_etag)
+
 
     def tearDown(self):
         if os.path.exists(self.runner.run_output_dir):
@@ -4,5 +4,7 @@ from QC import views
 urlpatterns = [
     path('run_qc', views.run_qc_handler, name='run_qc_handler'),
     path('reports', views.list_projects),
-    path('reports/<str:proj_id_hash>/', views.show_report, name='show_report')
+    path('reports/<str:proj_id_hash>/', views.show_report, name='show_report'),
+    path('reports/<str:proj_id_hash>/progress', views.report_progress, name='report_progress'),
+    path('reports/<str:proj_id_hash>/events', views.report_events, name='report_events')
 ]
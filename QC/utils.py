@@ -1,20 +1,38 @@
 import os
+import re
+import gzip
+import html
+import zipfile
+import itertools
 import subprocess
 import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import gmtime, strftime
 import django_rq
 
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from django.shortcuts import render
 from django.views.generic.edit import FormView
 from django.utils import timezone
+from django.db.models import Count, Max, Q, Subquery, Sum
 
-from .constants import PROJECT_STORAGE
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .constants import *
 from .forms import ProjectDirInputForm
-from .models import ExecutionStats
+from .models import ExecutionStats, FastQCJob, FastQCFingerprint
+from Transfer.models import Project
+from Transfer.utils import FastQCatalog, open_fastq, progress_channel, publish_progress
 
 def status_logger(project_id, status, analysis_type, details=None, exec_time=None):
     """Creates a timestamped log for every step of the analysis."""
+    Project.objects.get_or_create(project_id=project_id)
     ExecutionStats.objects.create(
         project_id = project_id,
         exec_status = status,
@@ -23,6 +41,54 @@ def status_logger(project_id, status, analysis_type, details=None, exec_time=Non
         exec_date = exec_time if exec_time != None else timezone.now()
     )
 
+def qc_progress(project_id):
+    """Progress of the most recent QC run of a project.
+
+    Counts come from a single aggregate over the run's FastQCJob rows. The
+    ETA divides the bytes still to process by the throughput of recently
+    computed (not reused) tasks, spread over the tasks currently running.
+    """
+
+    latest_run = FastQCJob.objects.filter(
+        project_id=project_id
+        ).order_by('-enqueued_at').values('run_output_dir')[:1]
+
+    progress = FastQCJob.objects.filter(
+        project_id=project_id,
+        run_output_dir=Subquery(latest_run)
+        ).aggregate(
+            run_output_dir=Max('run_output_dir'),
+            total=Count('id'),
+            queued=Count('id', filter=Q(status='QUEUED')),
+            running=Count('id', filter=Q(status='RUNNING')),
+            done=Count('id', filter=Q(status='DONE')),
+            failed=Count('id', filter=Q(status='FAILED')),
+            remaining_bytes=Sum('fastq_size', filter=Q(status__in=['QUEUED', 'RUNNING']))
+        )
+
+    progress['percent_complete'] = (
+        100 * progress['done'] / progress['total'] if progress['total'] else 0
+        )
+
+    history = FastQCJob.objects.filter(
+        status='DONE',
+        reused=False,
+        duration__gt=0
+        ).order_by('-finished_at').values_list('fastq_size', 'duration')[:QC_ETA_HISTORY]
+
+    processed_bytes = sum(fastq_size or 0 for fastq_size, duration in history)
+    processed_seconds = sum(duration for fastq_size, duration in history)
+
+    if progress['remaining_bytes'] and processed_bytes:
+        bytes_per_second = processed_bytes / processed_seconds
+        progress['eta_seconds'] = (
+            progress['remaining_bytes'] / bytes_per_second / max(1, progress['running'])
+            )
+    else:
+        progress['eta_seconds'] = None
+
+    return progress
+
 class QC(object):
     """Run FastQC on all the FastQ files in a given directory.
 
@@ -32,16 +98,22 @@ class QC(object):
 
     Exceptions with underlying 'runner' will be handled and logged by the
     runner - see QC.utils.FastQC for details.
+
+    With the 'quicklook' engine every file is analysed by QuickLookQC in
+    place of FastQC, see QC_ENGINE.
     """
 
-    def __init__(self, project_id, proj_dir, timestamp):
+    def __init__(self, project_id, proj_dir, timestamp, incremental=QC_INCREMENTAL, engine=QC_ENGINE):
         """Defines paths and creates directories for analysis output."""
 
         self.project_id = project_id
         self.timestamp = timestamp
         self.project_dir = proj_dir
+        self.incremental = incremental
+        self.engine = engine
 
         self.run_output_dir = os.path.join(proj_dir, 'QC_Output_at_' + timestamp)
+        self.progress_channel = progress_channel('qc', project_id)
 
         self.fastqc_output_dir = os.path.join(self.run_output_dir, 'FastQC')
         self.multiqc_input_dir = self.fastqc_output_dir
@@ -60,53 +132,331 @@ class QC(object):
 
         return 1 # Failure
 
-    def run_fastqc(self):
+    def enqueue_jobs(self, queue):
+        """Fans the analysis out as one rq job per FastQ file.
+
+        MultiQC is enqueued last, depending on every FastQC job, so it only
+        starts once all of them have succeeded. Each FastQC job ID is saved
+        as a FastQCJob. Returns the FastQC jobs and the MultiQC job.
+        """
+
+        fastqc_jobs = []
+        fastq_paths = self.fastq_files()
+        self.create_tasks(fastq_paths)
+
+        for fastq_path in fastq_paths:
+            job = queue.enqueue(self.run_fastqc_job, fastq_path, job_timeout=QC_FASTQC_JOB_TIMEOUT)
+            fastqc_jobs.append(job)
+            self.task_records(fastq_path).update(job_id=job.id)
+
+        multiqc_job = queue.enqueue(
+            self.run_multiqc_job,
+            depends_on=fastqc_jobs or None,
+            job_timeout=QC_MULTIQC_JOB_TIMEOUT
+            )
+
+        return fastqc_jobs, multiqc_job
+
+    def run_fastqc_job(self, fastq_path):
+        """rq job for a single file, raises on failure so that the
+        dependent MultiQC job is not run.
+
+        The file's FastQCJob is marked FAILED whatever the failure, a
+        missing fastqc binary or rq's job timeout included, so that it is
+        not reported as running forever.
+        """
+
+        if self.incremental and self.reuse_fastqc_output(fastq_path):
+            self.finish_task(fastq_path, 'DONE', reused=True)
+            return 0
+
+        started_at = timezone.now()
+        self.task_records(fastq_path).update(status='RUNNING', started_at=started_at)
+
+        try:
+            fastqc_proc = self.run_single_fastqc(fastq_path)
+        except Exception as e:
+            self.finish_task(fastq_path, 'FAILED', started_at)
+            status_logger(self.project_id, 'FAIL', 'FQC', details=repr(e))
+            self.publish_finished('FAILED')
+            raise
+
+        if fastqc_proc.returncode != 0:
+            self.finish_task(fastq_path, 'FAILED', started_at)
+            status_logger(self.project_id, 'FAIL', 'FQC', details=fastqc_proc.stderr)
+            self.publish_finished('FAILED')
+            raise Exception(f'FastQC failed on {fastq_path}: {fastqc_proc.stderr}')
+
+        self.finish_task(fastq_path, 'DONE', started_at)
+        self.save_fingerprint(fastq_path)
+
+        return fastqc_proc.returncode
+
+    def run_multiqc_job(self):
+        """rq job run after every FastQC job of the run has succeeded."""
+
+        status_logger(self.project_id, 'OK', 'FQC', details='FastQC successful.')
+        return self.run_multiqc()
+
+    def create_tasks(self, fastq_paths):
+        """Records every file of this run as a queued FastQCJob."""
+
+        enqueued_at = timezone.now()
+        FastQCJob.objects.bulk_create([
+            FastQCJob(
+                project_id = self.project_id,
+                run_output_dir = self.run_output_dir,
+                fastq_path = fastq_path,
+                fastq_size = os.path.getsize(fastq_path),
+                enqueued_at = enqueued_at
+            )
+            for fastq_path in fastq_paths
+        ])
+
+    def task_records(self, fastq_path):
+        return FastQCJob.objects.filter(run_output_dir=self.run_output_dir, fastq_path=fastq_path)
+
+    def finish_task(self, fastq_path, status, started_at=None, finished_at=None, reused=False):
+        finished_at = finished_at or timezone.now()
+        started_at = started_at or finished_at
+        duration = (finished_at - started_at).total_seconds()
+
+        self.task_records(fastq_path).update(
+            status = status,
+            reused = reused,
+            started_at = started_at,
+            finished_at = finished_at,
+            duration = duration
+        )
+
+        publish_progress(
+            self.progress_channel, 'file_finished',
+            fastq_path=fastq_path, status=status, reused=reused, duration=duration,
+            progress=qc_progress(self.project_id)
+            )
+
+    def publish_finished(self, status):
+        """Tells event streams the run is over, see QC.views.report_events."""
+
+        publish_progress(
+            self.progress_channel, 'job_finished',
+            status=status, run_output_dir=self.run_output_dir
+            )
+
+    def fastq_files(self):
+        """All 'fastq.gz' files in the project directory, largest first.
+
+        Paths and sizes come from the FastQ catalog, see
+        Transfer.utils.FastQCatalog.
+        """
+
+        catalog = FastQCatalog()
+        catalog.refresh(self.project_dir)
+
+        return list(
+            catalog.files_in(self.project_dir).order_by('-size').values_list('path', flat=True)
+            )
+
+    @staticmethod
+    def fastqc_output_names(fastq_path):
+        """Names of the report files FastQC writes for a FastQ file."""
+
+        basename = os.path.basename(fastq_path)
+        for extension in ('.fastq.gz', '.fq.gz', '.gz'):
+            if basename.endswith(extension):
+                basename = basename[:-len(extension)]
+                break
+
+        return [basename + '_fastqc.html', basename + '_fastqc.zip']
+
+    @staticmethod
+    def file_hash(path, chunk_size=4 * 1024 * 1024):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file_obj:
+            for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def fingerprint(self, fastq_path):
+        """Properties that must be unchanged for FastQC output to be reused."""
+
+        stat = os.stat(fastq_path)
+        return {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'content_hash': self.file_hash(fastq_path) if QC_CONTENT_HASH else None
+        }
+
+    def reuse_fastqc_output(self, fastq_path):
+        """Links the last FastQC output of an unchanged file into this run.
+
+        Returns False if the file has no fingerprint, has changed since, or
+        the earlier output is gone, in which case FastQC has to run again.
+        Falls back to copying when a hard link is not possible.
+        """
+
+        try:
+            cached = FastQCFingerprint.objects.get(fastq_path=fastq_path)
+        except FastQCFingerprint.DoesNotExist:
+            return False
+
+        if cached.engine != self.engine:
+            return False
+
+        current = self.fingerprint(fastq_path)
+        if cached.size != current['size'] or cached.mtime != current['mtime']:
+            return False
+        if cached.content_hash and current['content_hash'] and cached.content_hash != current['content_hash']:
+            return False
+
+        output_names = self.fastqc_output_names(fastq_path)
+        for output_name in output_names:
+            if not os.path.isfile(os.path.join(cached.fastqc_output_dir, output_name)):
+                return False
+
+        for output_name in output_names:
+            source = os.path.join(cached.fastqc_output_dir, output_name)
+            destination = os.path.join(self.fastqc_output_dir, output_name)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copy2(source, destination)
+
+        # Point at the newest copy so older runs can be deleted
+        cached.fastqc_output_dir = self.fastqc_output_dir
+        cached.save()
+
+        print(f"Reused FastQC output for {fastq_path}")
+        return True
+
+    def save_fingerprint(self, fastq_path):
+        FastQCFingerprint.objects.update_or_create(
+            fastq_path = fastq_path,
+            defaults = dict(
+                project_id = self.project_id,
+                fastqc_output_dir = self.fastqc_output_dir,
+                engine = self.engine,
+                updated_at = timezone.now(),
+                **self.fingerprint(fastq_path)
+            )
+        )
+
+    @staticmethod
+    def fastqc_pool_size(workers=FASTQC_WORKERS):
+        """Number of concurrent FastQC processes allowed by the QC limits."""
+
+        return max(1, min(
+            workers,
+            MAX_QC_THREADS // FASTQC_THREADS,
+            MAX_QC_MEMORY_MB // (FASTQC_MEMORY_MB * FASTQC_THREADS)
+            ))
+
+    def timed_fastqc(self, fastq_path):
+        """Runs fastqc on one file, also returning its start and end time."""
+
+        started_at = timezone.now()
+        fastqc_proc = self.run_single_fastqc(fastq_path)
+        return fastqc_proc, started_at, timezone.now()
+
+    def run_single_fastqc(self, fastq_path):
+        """Runs fastqc on one file and returns the completed process."""
+
+        publish_progress(
+            self.progress_channel, 'file_started',
+            fastq_path=fastq_path, fastq_size=os.path.getsize(fastq_path)
+            )
+
+        if self.engine == 'quicklook':
+            return self.run_quicklook(fastq_path)
+
+        fastqc_command = [
+            "fastqc",
+            fastq_path,
+            "-o",
+            self.fastqc_output_dir,
+            "-t",
+            str(FASTQC_THREADS)
+            ]
+
+        try:
+            return subprocess.run(
+                fastqc_command,
+                stderr=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                encoding='utf-8'
+                )
+        except FileNotFoundError:
+            print(
+                "No FastQC executable on your system path."
+                "Please check FastQC is downloaded and "
+                "callable with 'fastqc'."
+                )
+            raise
+
+    def run_quicklook(self, fastq_path):
+        """Runs QuickLookQC on one file, reporting like a fastqc process."""
+
+        try:
+            QuickLookQC(fastq_path).run().write(self.fastqc_output_dir)
+        except Exception as error:
+            return subprocess.CompletedProcess(['quicklook', fastq_path], 1, '', str(error))
+
+        return subprocess.CompletedProcess(['quicklook', fastq_path], 0, '', '')
+
+    def run_fastqc(self, workers=FASTQC_WORKERS):
         """ Runs fastqc on all 'fastq.gz' files in given directory.
 
         FastQC has to be callable with 'fastqc' on your system for the
-        subprocess call to work.
+        subprocess call to work. Files are processed in parallel, largest
+        first, see 'fastqc_pool_size' for the limits. The first failure is
+        logged and stops any files that have not started yet. In incremental
+        mode unchanged files reuse their previous output instead.
         """
 
-        for root, dirs, files in os.walk(self.project_dir):
-            for filename in files:
-                if filename.endswith('fastq.gz'):
-                    fastq_path = os.path.join(root, filename)
+        fastq_paths = self.fastq_files()
+        self.create_tasks(fastq_paths)
 
-                    fastqc_command = [
-                        "fastqc",
-                        fastq_path,
-                        "-o",
-                        self.fastqc_output_dir
-                        ]
+        # Task records are only written from this thread, workers just
+        # time their FastQC process
+        pending_paths = []
+        for fastq_path in fastq_paths:
+            if self.incremental and self.reuse_fastqc_output(fastq_path):
+                self.finish_task(fastq_path, 'DONE', reused=True)
+            else:
+                pending_paths.append(fastq_path)
 
-                    try:
-                        fastqc_proc = subprocess.run(
-                            fastqc_command,
-                            stderr=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            encoding='utf-8'
-                            )
-                    except FileNotFoundError:
-                        print(
-                            "No FastQC executable on your system path."
-                            "Please check FastQC is downloaded and "
-                            "callable with 'fastqc'."
-                            )
-                        raise
-
-                    if fastqc_proc.returncode != 0:
-                        print(fastqc_proc.std_err)
-                        status_logger(self.project_id, 'FAIL', 'FQC', details=fastqc_proc.stderr)
-                        return fastqc_proc.returncode
+        with ThreadPoolExecutor(max_workers=self.fastqc_pool_size(workers)) as executor:
+            futures = {
+                executor.submit(self.timed_fastqc, fastq_path): fastq_path
+                for fastq_path in pending_paths
+                }
+
+            for future in as_completed(futures):
+                fastqc_proc, started_at, finished_at = future.result()
+                fastq_path = futures[future]
+
+                if fastqc_proc.returncode != 0:
+                    for pending in futures:
+                        pending.cancel()
+                    self.finish_task(fastq_path, 'FAILED', started_at, finished_at)
+                    print(fastqc_proc.stderr)
+                    status_logger(self.project_id, 'FAIL', 'FQC', details=fastqc_proc.stderr)
+                    self.publish_finished('FAILED')
+                    return fastqc_proc.returncode
+
+                self.finish_task(fastq_path, 'DONE', started_at, finished_at)
+                self.save_fingerprint(fastq_path)
 
         print('FastQC successful.')
         status_logger(self.project_id, 'OK', 'FQC', details='FastQC successful.')
 
-        return fastqc_proc.returncode
+        return 0
 
     def run_multiqc(self):
         """Runs MultiQC on the fastqc files generated during this analysis."""
 
+        publish_progress(self.progress_channel, 'stage', stage='multiqc')
+
         multiqc_command = [
             "multiqc",
             self.multiqc_input_dir,
@@ -124,16 +474,330 @@ class QC(object):
             )
 
         if multiqc_proc.returncode == 0:
+            report_path = os.path.join(
+                self.multiqc_output_dir, self.project_id + '_multiqc_report.html'
+                )
+            if os.path.isfile(report_path):
+                self.compress_report(report_path)
             status_logger(self.project_id, 'OK', 'MQC', details=multiqc_proc.stdout)
+            self.publish_finished('DONE')
         else:
             status_logger(self.project_id, 'FAIL', 'MQC', details=multiqc_proc.stderr)
+            self.publish_finished('FAILED')
 
         return multiqc_proc.returncode
 
     @staticmethod
-    def display_multiqc(path):
-        """Opens and serves a MultiQC report."""
+    def compress_report(report_path):
+        """Writes a gzip copy of a report next to it for display_multiqc."""
+
+        gzip_path = report_path + '.gz'
+        with open(report_path, 'rb') as report_file, \
+             gzip.open(gzip_path + '.tmp', 'wb') as gzip_file:
+            shutil.copyfileobj(report_file, gzip_file)
+        os.replace(gzip_path + '.tmp', gzip_path)
+
+        return gzip_path
+
+    @staticmethod
+    def accepts_gzip(request):
+        """Whether the request's Accept-Encoding allows gzip, honouring
+        q-values so that 'gzip;q=0' refuses it."""
+
+        qvalues = {}
+        for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            name, *params = [part.strip() for part in coding.split(';')]
+            if not name:
+                continue
+            qvalue = 1.0
+            for param in params:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            qvalues[name.lower()] = qvalue
+
+        for name in ('gzip', 'x-gzip', '*'):
+            if name in qvalues:
+                return qvalues[name] > 0
+        return False
+
+    @staticmethod
+    def display_multiqc(request, path):
+        """Streams a MultiQC report from disk.
+
+        The ETag and Last-Modified headers come from the report's mtime and
+        size so repeat views are answered with a 304. Clients accepting
+        gzip get the copy written by 'compress_report' when it is current,
+        under its own ETag as the bytes differ from the report's.
+        """
+
+        stat = os.stat(path)
+        gzip_path = path + '.gz'
+        use_gzip = QC.accepts_gzip(request) and os.path.isfile(gzip_path) and \
+                   os.path.getmtime(gzip_path) >= stat.st_mtime
+
+        etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+        if use_gzip:
+            etag += '-gz'
+        etag = quote_etag(etag)
+
+        not_modified = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=int(stat.st_mtime)
+            )
+        if not_modified is not None:
+            patch_vary_headers(not_modified, ('Accept-Encoding',))
+            return not_modified
+
+        if use_gzip:
+            response = FileResponse(open(gzip_path, 'rb'), content_type='text/html')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = FileResponse(open(path, 'rb'), content_type='text/html')
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        return response
+
+class QuickLookQC(object):
+    """Vectorized triage QC of a FastQ, written in FastQC's output format.
+
+    Reads are loaded QC_QUICKLOOK_BATCH_READS at a time into uint8 base and
+    quality matrices, padded to the longest read of the batch, and reduced
+    with numpy into running histograms: quality by cycle, base by cycle,
+    mean read quality, read GC and read length. Adapter hits are the first
+    position of each QC_ADAPTERS sequence in each read.
+
+    'write' produces '<name>_fastqc.zip' with a fastqc_data.txt and
+    summary.txt, which MultiQC's FastQC module reads, and a short
+    '<name>_fastqc.html'.
+    """
+
+    max_quality = 94
+    # Row of each base in the base counts, anything else counts as N
+    base_codes = bytes.maketrans(b'ACGT', b'\x00\x01\x02\x03')
+
+    def __init__(self, fastq_path, max_reads=QC_QUICKLOOK_MAX_READS, batch_reads=QC_QUICKLOOK_BATCH_READS):
+        if numpy is None:
+            raise Exception('The quick look QC engine requires numpy')
+
+        self.fastq_path = fastq_path
+        self.max_reads = max_reads
+        self.batch_reads = batch_reads
+
+        self.read_count = 0
+        self.quality_counts = numpy.zeros((0, self.max_quality), dtype=numpy.uint64)
+        self.base_counts = numpy.zeros((0, 5), dtype=numpy.uint64)
+        self.read_quality_counts = numpy.zeros(self.max_quality, dtype=numpy.uint64)
+        self.gc_counts = numpy.zeros(101, dtype=numpy.uint64)
+        self.length_counts = numpy.zeros(0, dtype=numpy.uint64)
+        self.adapter_counts = {name: numpy.zeros(0, dtype=numpy.uint64) for name in QC_ADAPTERS}
+
+    @staticmethod
+    def grow(counts, length):
+        if counts.shape[0] >= length:
+            return counts
+        padding = numpy.zeros((length - counts.shape[0],) + counts.shape[1:], dtype=counts.dtype)
+        return numpy.concatenate([counts, padding])
+
+    @staticmethod
+    def matrix(lines, width, fill):
+        """Lines as rows of a uint8 matrix, padded to 'width' with 'fill'."""
+
+        return numpy.frombuffer(
+            b''.join(line[:width].ljust(width, fill) for line in lines), dtype=numpy.uint8
+            ).reshape(len(lines), width)
+
+    def add_batch(self, sequences, qualities):
+        lengths = numpy.fromiter(map(len, sequences), dtype=numpy.int64, count=len(sequences))
+        width = int(lengths.max())
+        valid = numpy.arange(width) < lengths[:, None]
+
+        self.quality_counts = self.grow(self.quality_counts, width)
+        self.base_counts = self.grow(self.base_counts, width)
+        self.length_counts = self.grow(self.length_counts, width + 1)
+        self.length_counts += numpy.bincount(lengths, minlength=self.length_counts.shape[0]).astype(numpy.uint64)
+
+        # Quality by cycle, as one bincount over (cycle, quality) cells
+        quality = self.matrix(qualities, width, b'!').astype(numpy.int64) - 33
+        quality = numpy.clip(quality, 0, self.max_quality - 1)
+        cells = numpy.arange(width) * self.max_quality + quality
+        self.quality_counts[:width] += numpy.bincount(
+            cells[valid], minlength=width * self.max_quality
+            ).reshape(width, self.max_quality).astype(numpy.uint64)
+
+        read_quality = numpy.rint((quality * valid).sum(axis=1) / numpy.maximum(lengths, 1)).astype(numpy.int64)
+        self.read_quality_counts += numpy.bincount(read_quality, minlength=self.max_quality).astype(numpy.uint64)
+
+        # Base by cycle, A C G T N
+        bases = self.matrix([sequence.translate(self.base_codes) for sequence in sequences], width, b'\x04')
+        bases = numpy.minimum(bases, 4).astype(numpy.int64)
+        cells = numpy.arange(width) * 5 + bases
+        self.base_counts[:width] += numpy.bincount(
+            cells[valid], minlength=width * 5
+            ).reshape(width, 5).astype(numpy.uint64)
+
+        gc = ((bases == 1) | (bases == 2)) & valid
+        read_gc = numpy.rint(100 * gc.sum(axis=1) / numpy.maximum(lengths, 1)).astype(numpy.int64)
+        self.gc_counts += numpy.bincount(read_gc, minlength=101).astype(numpy.uint64)
+
+        # First adapter hit in each read, found in the joined batch
+        joined = b'\n'.join(sequences)
+        starts = numpy.concatenate([[0], numpy.cumsum(lengths + 1)[:-1]])
+        for name, adapter in QC_ADAPTERS.items():
+            hits = numpy.fromiter(
+                (match.start() for match in re.finditer(re.escape(adapter.encode()), joined)),
+                dtype=numpy.int64
+                )
+            counts = self.grow(self.adapter_counts[name], width)
+            if hits.size:
+                reads = numpy.searchsorted(starts, hits, side='right') - 1
+                reads, first = numpy.unique(reads, return_index=True)
+                positions = hits[first] - starts[reads]
+                counts[:width] += numpy.bincount(positions, minlength=width)[:width].astype(numpy.uint64)
+            self.adapter_counts[name] = counts
+
+        self.read_count += len(sequences)
+
+    def run(self):
+        with open_fastq(self.fastq_path) as fastq_file_obj:
+            while self.max_reads is None or self.read_count < self.max_reads:
+                batch_reads = self.batch_reads
+                if self.max_reads is not None:
+                    batch_reads = min(batch_reads, self.max_reads - self.read_count)
+
+                lines = [line.rstrip(b'\r\n') for line in itertools.islice(fastq_file_obj, 4 * batch_reads)]
+                lines = lines[:len(lines) - len(lines) % 4]
+                if not lines:
+                    break
+                self.add_batch(lines[1::4], lines[3::4])
+
+        return self
+
+    @staticmethod
+    def quantile(counts, fraction):
+        """Quality at 'fraction' of the way through a histogram."""
+
+        total = counts.sum()
+        if total == 0:
+            return 0
+        return int(numpy.searchsorted(numpy.cumsum(counts), fraction * total))
+
+    @staticmethod
+    def grade(value, warn, fail):
+        return 'fail' if value >= fail else 'warn' if value >= warn else 'pass'
+
+    def modules(self):
+        """(name, grade, header, rows) of every FastQC module written."""
+
+        cycles = range(self.quality_counts.shape[0])
+        reads_at_cycle = numpy.maximum(self.quality_counts.sum(axis=1), 1).astype(float)
+        qualities = numpy.arange(self.max_quality)
+
+        base_quality = []
+        for cycle in cycles:
+            counts = self.quality_counts[cycle]
+            base_quality.append([cycle + 1, round(float((counts * qualities).sum() / reads_at_cycle[cycle]), 2)] + [
+                self.quantile(counts, fraction) for fraction in (0.5, 0.25, 0.75, 0.1, 0.9)
+                ])
+        lowest_lower_quartile = min((row[3] for row in base_quality), default=0)
+        lowest_median = min((row[2] for row in base_quality), default=0)
+        quality_grade = (
+            'fail' if lowest_lower_quartile < 5 or lowest_median < 20 else
+            'warn' if lowest_lower_quartile < 10 or lowest_median < 25 else 'pass'
+            )
+
+        base_percent = 100 * self.base_counts / reads_at_cycle[:, None]
+        n_percent = base_percent[:, 4] if len(cycles) else numpy.zeros(0)
+
+        lengths = [(length, int(count)) for length, count in enumerate(self.length_counts) if count]
+        total_gc = self.base_counts[:, 1:3].sum()
+        total_bases = self.base_counts.sum()
+
+        adapter_rows = []
+        adapter_percent = {
+            name: 100 * numpy.cumsum(counts) / max(self.read_count, 1)
+            for name, counts in self.adapter_counts.items()
+            }
+        for cycle in cycles:
+            adapter_rows.append([cycle + 1] + [
+                round(float(percent[cycle]), 4) if cycle < len(percent) else 0.0
+                for percent in adapter_percent.values()
+                ])
+        highest_adapter = max((max(row[1:]) for row in adapter_rows), default=0)
+
+        return [
+            ('Basic Statistics', 'pass', ['Measure', 'Value'], [
+                ['Filename', os.path.basename(self.fastq_path)],
+                ['File type', 'Conventional base calls'],
+                ['Encoding', 'Sanger / Illumina 1.9'],
+                ['Total Sequences', self.read_count],
+                ['Sequences flagged as poor quality', 0],
+                ['Sequence length', (
+                    f'{lengths[0][0]}-{lengths[-1][0]}' if lengths and lengths[0][0] != lengths[-1][0]
+                    else lengths[0][0] if lengths else 0)],
+                ['%GC', int(round(100 * total_gc / total_bases)) if total_bases else 0],
+                ]),
+            ('Per base sequence quality', quality_grade,
+             ['Base', 'Mean', 'Median', 'Lower Quartile', 'Upper Quartile', '10th Percentile', '90th Percentile'],
+             base_quality),
+            ('Per sequence quality scores', 'pass', ['Quality', 'Count'], [
+                [quality, int(count)] for quality, count in enumerate(self.read_quality_counts) if count
+                ]),
+            ('Per base sequence content', 'pass', ['Base', 'G', 'A', 'T', 'C'], [
+                [cycle + 1] + [round(float(base_percent[cycle, base]), 2) for base in (2, 0, 3, 1)]
+                for cycle in cycles
+                ]),
+            ('Per sequence GC content', 'pass', ['GC Content', 'Count'], [
+                [gc, float(count)] for gc, count in enumerate(self.gc_counts)
+                ]),
+            ('Per base N content', self.grade(max(n_percent, default=0), 5, 20), ['Base', 'N-Count'], [
+                [cycle + 1, round(float(n_percent[cycle]), 2)] for cycle in cycles
+                ]),
+            ('Sequence Length Distribution', 'pass', ['Length', 'Count'], [
+                [length, float(count)] for length, count in lengths
+                ]),
+            ('Adapter Content', self.grade(highest_adapter, 5, 10), ['Position'] + list(QC_ADAPTERS), adapter_rows),
+            ]
+
+    def write(self, output_dir):
+        """Writes the FastQC style zip and html for this file into output_dir."""
+
+        name = QC.fastqc_output_names(self.fastq_path)[0][:-len('_fastqc.html')] + '_fastqc'
+        modules = self.modules()
+
+        data_lines = ['##FastQC\t0.11.9']
+        summary_lines = []
+        for module_name, module_grade, header, rows in modules:
+            data_lines.append(f'>>{module_name}\t{module_grade}')
+            data_lines.append('#' + '\t'.join(header))
+            data_lines.extend('\t'.join(str(value) for value in row) for row in rows)
+            data_lines.append('>>END_MODULE')
+            summary_lines.append(f'{module_grade.upper()}\t{module_name}\t{os.path.basename(self.fastq_path)}')
+
+        zip_path = os.path.join(output_dir, name + '.zip')
+        with zipfile.ZipFile(zip_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as fastqc_zip:
+            fastqc_zip.writestr(f'{name}/fastqc_data.txt', '\n'.join(data_lines) + '\n')
+            fastqc_zip.writestr(f'{name}/summary.txt', '\n'.join(summary_lines) + '\n')
+        os.replace(zip_path + '.tmp', zip_path)
+
+        html_path = os.path.join(output_dir, name + '.html')
+        with open(html_path, 'w') as html_file:
+            html_file.write(
+                f'<html><head><title>{name} quick look QC</title></head><body>'
+                f'<h1>{html.escape(os.path.basename(self.fastq_path))}</h1>'
+                f'<p>Quick look QC of {self.read_count} reads</p><table>'
+                + ''.join(
+                    f'<tr><td>{module_grade.upper()}</td><td>{module_name}</td></tr>'
+                    for module_name, module_grade, header, rows in modules
+                    )
+                + '</table></body></html>'
+                )
 
-        myfile = open(path)
-        data = myfile.read()
-        return HttpResponse(data)
+        return [html_path, zip_path]
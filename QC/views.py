@@ -2,7 +2,7 @@ import os
 from time import gmtime, strftime
 import glob
 
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.generic.edit import FormView
 from django.utils import timezone
@@ -11,10 +11,12 @@ from django.core.signing import Signer
 import redis
 import django_rq
 
-from .constants import PROJECT_STORAGE
+from .constants import PROJECT_STORAGE, QC_ENGINE
 from .forms import ProjectDirInputForm
 from .models import ExecutionStats
-from .utils import QC, status_logger
+from .utils import QC, status_logger, qc_progress
+from Transfer.models import CatalogDirectory
+from Transfer.utils import FastQCatalog, progress_channel, progress_events
 
 ## Instantiate redis queue, the following 2 commands must be run
 ## to init the message broker and worker.
@@ -27,8 +29,9 @@ def run_qc_handler(request):
     """Run FastQC on all the FastQ files in a given directory.
 
     The form collects the fastq directory and associated work order ID.
-    It will loop through all the fastq files and add them to the queue
-    specified above.
+    Every fastq file is added to the queue specified above as its own
+    job, followed by a MultiQC job that depends on all of them, so the
+    work spreads over every running rqworker.
 
     Exceptions with underlying 'runner' will be handled and logged by the
     runner - see QC.utils.FastQC for details.
@@ -40,16 +43,18 @@ def run_qc_handler(request):
         # check whether it's valid:
         if form.is_valid():
             project_dir = form.cleaned_data['project_directory']
+            incremental = form.cleaned_data['incremental']
+            engine = form.cleaned_data['engine'] or QC_ENGINE
             project_id = project_dir.split('/')[-1]
             timestamp = strftime("%Y-%m-%d-%H-%M-%S", gmtime())
 
             try:
-                runner = QC(project_id, project_dir, timestamp)
+                runner = QC(project_id, project_dir, timestamp, incremental=incremental, engine=engine)
             except Exception as error:
                 return HttpResponse(error)
 
             try:
-                fastqc_result = q.enqueue(runner.run_aggregated_qc)
+                fastqc_jobs, multiqc_job = runner.enqueue_jobs(q)
             except redis.exceptions.ConnectionError as error:
                 return HttpResponse(
                     "Redis could not connect to a queue, please ensure "
@@ -60,13 +65,13 @@ def run_qc_handler(request):
                 project_id,
                 'ENQD',
                 'QD',
-                f'Job ID: {fastqc_result.id}'
+                f'FastQC jobs: {len(fastqc_jobs)}, MultiQC Job ID: {multiqc_job.id}'
                 )
 
             return HttpResponse(
-                "Successfully added files for processing. "
+                f"Successfully added {len(fastqc_jobs)} files for processing. "
                 "Please come back later to view report. "
-                f"Job ID: {fastqc_result.id}"
+                f"MultiQC Job ID: {multiqc_job.id}"
                 )
 
         else:
@@ -80,54 +85,111 @@ def run_qc_handler(request):
 def list_projects(request):
     """Simple function for displaying all projects. """
 
+    # Only relists project storage itself, and only if it has changed
+    FastQCatalog().refresh(PROJECT_STORAGE, recursive=False)
+
     proj_dirs = []
-    for proj_dir in os.listdir(PROJECT_STORAGE):
+    for proj_path in CatalogDirectory.objects.filter(
+        parent__path=PROJECT_STORAGE
+        ).order_by('path').values_list('path', flat=True):
+        proj_dir = os.path.basename(proj_path)
         proj_dirs.append([proj_dir, signer.sign(proj_dir)])
     return render(request, 'QC/all_projects.html', {'dirlist' : proj_dirs})
 
+def legacy_report_path(project_id):
+    """MultiQC report of the most recent 'QC_Output' run in the project
+    directory that has one, None if there is none."""
+
+    project_dir = os.path.join(PROJECT_STORAGE, project_id)
+    if not os.path.isdir(project_dir):
+        return None
+
+    all_analyses = sorted(
+        (dir for dir in os.listdir(project_dir) if dir.startswith('QC_Output')),
+        reverse=True
+        )
+    for analysis in all_analyses:
+        for root, dirs, files in os.walk(os.path.join(project_dir, analysis)):
+            for filename in files:
+                if filename.endswith('multiqc_report.html'):
+                    return os.path.join(root, filename)
+
+    return None
+
 def show_report(request, proj_id_hash):
     """ Retrieve MultiQC report for a projectself.
 
-    Takes a hashed project id, unsigns it and finds project directory.
-    It will then find the most recent analysis performed and return the
-    MultiQC report. If the analysis is still underway, it will return
-    a (rough) percentage complete.
+    Takes a hashed project id, unsigns it and looks up the most recent
+    analysis performed from its task records, then returns the MultiQC
+    report. Projects without task records fall back to the report of
+    their most recent 'QC_Output' directory. If the analysis is still underway, it will return the
+    percentage complete and an estimate of the time remaining, kept up to
+    date from 'report_events' and reloaded once the run is over.
     """
 
     project_id = signer.unsign(proj_id_hash)
-    project_dir = os.path.join(PROJECT_STORAGE, project_id)
+    progress = qc_progress(project_id)
+
+    if progress['total'] == 0:
+        # Runs from before task records were kept
+        report_path = legacy_report_path(project_id)
+        if report_path is not None:
+            print(f"Report Path: {report_path}")
+            return QC.display_multiqc(request, report_path)
+        return HttpResponse('No analyses found for Project ' + str(project_id))
+
+    report_path = os.path.join(
+        progress['run_output_dir'], 'MultiQC', project_id + '_multiqc_report.html'
+        )
 
-    all_analyses = [dir for dir in os.listdir(project_dir) if dir.startswith('QC_Output')]
+    if os.path.isfile(report_path):
+        print(f"Report Path: {report_path}")
+        return QC.display_multiqc(request, report_path)
 
-    if len(all_analyses) == 0:
-        return HttpResponse('No analyses found for Project ' + str(project_id))
-    elif len(all_analyses) == 1:
-        most_recent_analysis = os.path.join(project_dir, all_analyses[0])
-    else:
-        sorted_analyses = all_analyses.sort()
-        most_recent_analysis = os.path.join(project_dir, sorted_analyses[-1])
-
-    total_fastq = 0
-    total_fastqc = 0
-
-    for root, dirs, files in os.walk(project_dir):
-        for filename in files:
-            if filename.endswith('fastq.gz'):
-                total_fastq += 1
-
-    for root, dirs, files in os.walk(most_recent_analysis):
-        for filename in files:
-            if filename.endswith('fastqc.html'):
-                total_fastqc += 1
-            if filename.endswith('multiqc_report.html'):
-                report_path = os.path.join(root, filename)
-                print(f"Report Path: {report_path}")
-                return HttpResponse(QC.display_multiqc(report_path))
-                break
-
-    progress = total_fastqc / total_fastq
-
-    return HttpResponse(
-        "MultiQC report not yet ready. "
-        f"FastQC is still processing with {progress*100} percent completion."
+    if progress['failed']:
+        return HttpResponse(
+            f"FastQC failed on {progress['failed']} of {progress['total']} files."
+            )
+
+    eta = ""
+    if progress['eta_seconds'] is not None:
+        eta = f" Estimated time remaining: {round(progress['eta_seconds'] / 60)} minutes."
+
+    return render(request, 'QC/report_progress.html', {
+        'message': (
+            "MultiQC report not yet ready. "
+            f"FastQC is still processing with {progress['percent_complete']:.0f} percent completion."
+            + eta
+            ),
+        'proj_id_hash': proj_id_hash
+        })
+
+def report_progress(request, proj_id_hash):
+    """JSON progress of the most recent QC run, see QC.utils.qc_progress."""
+
+    project_id = signer.unsign(proj_id_hash)
+    return JsonResponse(qc_progress(project_id))
+
+def report_events(request, proj_id_hash):
+    """Server-sent events with the live progress of the most recent QC run.
+
+    The first event holds 'qc_progress', then every file started and
+    finished by the workers is relayed until the run is over.
+    """
+
+    project_id = signer.unsign(proj_id_hash)
+
+    def snapshot():
+        progress = qc_progress(project_id)
+        if progress['total'] == 0 or progress['failed'] or os.path.isfile(os.path.join(
+                progress['run_output_dir'], 'MultiQC', project_id + '_multiqc_report.html')):
+            progress['event'] = 'job_finished'
+        return progress
+
+    response = StreamingHttpResponse(
+        progress_events(progress_channel('qc', project_id), snapshot),
+        content_type='text/event-stream'
         )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
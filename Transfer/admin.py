@@ -2,7 +2,7 @@ from django.contrib import admin
 
 # Register your models here.
 # from import_export import resources
-from .models import ComponentInformation, TubeInformation, CoreData, ExecutionStats
+from .models import Project, ComponentInformation, TubeInformation, CoreData, ExecutionStats, ImportJob
 
 class TubeSampleInline(admin.TabularInline):
     model = TubeInformation
@@ -16,6 +16,10 @@ class CoreSampleInline(admin.TabularInline):
     model = CoreData
     fields = ['pool_id', 'sample_id', 'i5_index_sequence', 'i7_index_sequence']
 
+class ProjectAdmin(admin.ModelAdmin):
+    list_display = ('project_id', 'i5_orientation')
+    inlines = [TubeSampleInline, CompSampleInline, CoreSampleInline]
+
 class TubeSampleAdmin(admin.ModelAdmin):
     list_display = ('tube_id', 'pool_id')
 
@@ -26,9 +30,14 @@ class CoreDataAdmin(admin.ModelAdmin):
     list_display = ('sample_id', 'i7_index_sequence', 'i5_index_sequence')
 
 class ExecutionStatsAdmin(admin.ModelAdmin):
-    list_display = ('project_id', 'exec_date', 'exec_status', 'fail_reason')
+    list_display = ('project', 'exec_date', 'exec_status', 'fail_reason')
     
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('project', 'sheet_path', 'status', 'stage', 'enqueued_at', 'finished_at')
+
+admin.site.register(Project, ProjectAdmin)
 admin.site.register(CoreData, CoreDataAdmin)
 admin.site.register(ComponentInformation, ComponentAdmin)
 admin.site.register(TubeInformation, TubeSampleAdmin)
 admin.site.register(ExecutionStats, ExecutionStatsAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from Transfer.transfer_settings import collision_max_distance
+from Transfer.utils import LaneCollisionAnalysis, lane_collisions
+
+
+class Command(BaseCommand):
+    """Reports index collisions between projects pooled on the same lane.
+
+    Analyses one flowcell lane when given, otherwise every lane holding
+    more than one project, or only those of --project.
+    """
+
+    help = "Finds libraries of different projects on a flowcell lane whose indexes are within range."
+
+    def add_arguments(self, parser):
+        parser.add_argument('flowcell_id', nargs='?')
+        parser.add_argument('lane', nargs='?')
+        parser.add_argument(
+            '--project',
+            help="Only analyse the lanes this project shares.")
+        parser.add_argument(
+            '--max-distance', type=int, default=collision_max_distance,
+            help="Substitutions on each index within which two libraries collide.")
+
+    def handle(self, *args, **options):
+        if options['flowcell_id'] and options['lane']:
+            analysis = LaneCollisionAnalysis(
+                options['flowcell_id'], options['lane'], options['max_distance'])
+            analysis.analyse()
+            self.stdout.write(analysis.report())
+            return
+
+        report = lane_collisions(options['project'], options['max_distance'])
+        self.stdout.write(report or "No lanes are shared between projects")
@@ -0,0 +1,38 @@
+import django_rq
+from django.core.management.base import BaseCommand
+
+from Transfer.transfer_settings import fastq_import_processes
+from Transfer.utils import UndeterminedMiner, mine_undetermined
+
+
+class Command(BaseCommand):
+    """Reports which unmatched customer indexes show up in Undetermined reads.
+
+    Runs the UndeterminedMiner in place, or with --enqueue as an rq job on
+    the default queue.
+    """
+
+    help = "Matches the most common Undetermined barcodes against a project's unmatched customer indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id')
+        parser.add_argument(
+            'fastq_directory',
+            help="Directory holding the Undetermined FastQs of the run.")
+        parser.add_argument(
+            '--processes', type=int, default=fastq_import_processes,
+            help="Undetermined files streamed in parallel.")
+        parser.add_argument(
+            '--enqueue', action='store_true',
+            help="Run as an rq job instead of waiting for the result.")
+
+    def handle(self, *args, **options):
+        if options['enqueue']:
+            job = django_rq.get_queue('default').enqueue(
+                mine_undetermined, options['project_id'], options['fastq_directory'])
+            self.stdout.write(f"Queued Undetermined mining job {job.id}")
+            return
+
+        miner = UndeterminedMiner(
+            options['project_id'], options['fastq_directory'], options['processes'])
+        self.stdout.write(miner.mine())
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from Transfer.transfer_settings import fastq_import_processes
+from Transfer.utils import FastQCatalog
+
+
+class Command(BaseCommand):
+    """Scans catalogued FastQs that have no current FastQScan."""
+
+    help = "Computes checksums, read counts and per-cycle quality for FastQs in one pass each."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            help="Directory to scan, defaults to all of project storage.")
+        parser.add_argument(
+            '--processes', type=int, default=fastq_import_processes,
+            help="Files scanned in parallel.")
+
+    def handle(self, *args, **options):
+        scanned = FastQCatalog().scan(options['path'], processes=options['processes'])
+        self.stdout.write(f"Scanned {scanned} FastQ files")
@@ -0,0 +1,168 @@
+import os
+import time
+from time import gmtime, strftime
+
+import django_rq
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from QC.utils import QC, status_logger
+from Transfer.models import CatalogDirectory, FastQFile
+from Transfer.transfer_settings import watch_interval, watch_settle_seconds
+from Transfer.utils import FastQCatalog, import_fastq_headers, scan_fastq_files
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class Command(BaseCommand):
+    """Polls project storage and queues new FastQ deliveries.
+
+    Every poll refreshes the FastQ catalog and looks for 'FastQ_Files'
+    directories holding files the watcher has not queued yet. Once all of
+    the files in such a directory have settled - unchanged for
+    'settle' seconds and the same size as at the previous poll - a scan
+    job, a header import job depending on it and the QC jobs for the
+    project are enqueued.
+
+    The first time the watcher runs, every FastQ already in project
+    storage is marked as ingested so that only later deliveries are
+    queued, unless --backfill is given.
+
+    With inotify_simple installed, file events in project storage wake
+    the watcher up before the poll interval is over.
+    """
+
+    help = "Watches project storage and queues header import and QC for new FastQ deliveries."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=watch_interval,
+            help="Seconds between polls of project storage.")
+        parser.add_argument(
+            '--settle', type=int, default=watch_settle_seconds,
+            help="Seconds a file must be unchanged before it is queued.")
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Poll once and exit.")
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help="On the first run, queue the FastQs already in storage instead of skipping them.")
+
+    def handle(self, *args, **options):
+        self.catalog = FastQCatalog()
+        self.queue = django_rq.get_queue('default')
+        self.last_sizes = {}
+        self.watched = set()
+        self.notifier = inotify_simple.INotify() if inotify_simple else None
+
+        if not options['backfill']:
+            self.baseline()
+
+        while True:
+            self.poll(options['settle'])
+            if options['once']:
+                break
+            self.wait(options['interval'])
+
+    def baseline(self):
+        """Marks every catalogued FastQ as ingested if the watcher has
+        never queued anything."""
+
+        if FastQFile.objects.filter(ingested_at__isnull=False).exists():
+            return
+
+        self.catalog.refresh()
+        marked = FastQFile.objects.filter(ingested_at__isnull=True).update(ingested_at=timezone.now())
+        self.stdout.write(f"Marked {marked} FastQ files already in storage as ingested")
+
+    def poll(self, settle):
+        self.catalog.refresh()
+
+        pending_directories = CatalogDirectory.objects.filter(
+            path__endswith=os.sep + 'FastQ_Files',
+            fastq_files__ingested_at__isnull=True
+            ).distinct()
+
+        for directory in pending_directories:
+            # Restat the files, a file still being written keeps its
+            # directory mtime
+            self.catalog.refresh(directory.path, recursive=False, full=True)
+            fastq_files = list(directory.fastq_files.all())
+
+            if fastq_files and self.settled(fastq_files, settle):
+                self.ingest(directory, fastq_files)
+
+    def settled(self, fastq_files, settle):
+        now = time.time()
+        settled = True
+
+        for fastq_file in fastq_files:
+            last_size = self.last_sizes.get(fastq_file.path)
+            if now - fastq_file.mtime < settle:
+                settled = False
+            elif last_size is not None and last_size != fastq_file.size:
+                settled = False
+            self.last_sizes[fastq_file.path] = fastq_file.size
+
+        return settled
+
+    def ingest(self, directory, fastq_files):
+        project_id = fastq_files[0].project_id
+        if project_id is None:
+            return
+
+        project_dir = os.path.dirname(directory.path)
+        timestamp = strftime("%Y-%m-%d-%H-%M-%S", gmtime())
+
+        # The import reads its indexes from the scan, so each delivery is
+        # only decompressed once
+        scan_job = self.queue.enqueue(scan_fastq_files, directory.path)
+        import_job = self.queue.enqueue(
+            import_fastq_headers, project_id, directory.path, depends_on=scan_job
+            )
+
+        runner = QC(project_id, project_dir, timestamp)
+        fastqc_jobs, multiqc_job = runner.enqueue_jobs(self.queue)
+
+        status_logger(
+            project_id,
+            'ENQD',
+            'QD',
+            f'Watcher queued {len(fastq_files)} files, MultiQC Job ID: {multiqc_job.id}'
+            )
+
+        FastQFile.objects.filter(
+            pk__in=[fastq_file.pk for fastq_file in fastq_files]
+            ).update(ingested_at=timezone.now())
+
+        for fastq_file in fastq_files:
+            self.last_sizes.pop(fastq_file.path, None)
+
+        self.stdout.write(
+            f"Queued {project_id}: header import {import_job.id}, scan {scan_job.id}, "
+            f"{len(fastqc_jobs)} FastQC jobs, MultiQC {multiqc_job.id}"
+            )
+
+    def wait(self, interval):
+        if self.notifier is None:
+            time.sleep(interval)
+            return
+
+        # Watch project storage, the projects and their FastQ directories
+        mask = (
+            inotify_simple.flags.CREATE | inotify_simple.flags.CLOSE_WRITE |
+            inotify_simple.flags.MOVED_TO | inotify_simple.flags.DELETE
+            )
+        for path in CatalogDirectory.objects.values_list('path', flat=True):
+            depth = os.path.relpath(path, self.catalog.root).count(os.sep)
+            if path not in self.watched and (path == self.catalog.root or depth <= 1):
+                try:
+                    self.notifier.add_watch(path, mask)
+                    self.watched.add(path)
+                except OSError:
+                    pass
+
+        self.notifier.read(timeout=interval * 1000)
@@ -1,9 +1,32 @@
+import json
+
 from django.db import models
+from django.utils import timezone
 from .constants import PROJECT_STORAGE
 
 
+class Project(models.Model):
+    project_id = models.CharField(max_length=20, primary_key=True)
+    I5_ORIENTATIONS = (
+        ('forward', 'Forward'),
+        ('reverse_complement', 'Reverse complement')
+    )
+    i5_orientation = models.CharField(
+        max_length=18,
+        choices=I5_ORIENTATIONS,
+        null=True,
+        help_text=(
+            "Orientation of the customer i5 sequences that matched the "
+            "core data, null until a comparison has matched any."))
+
+    def __str__(self):
+        return 'Project ID: ' + self.project_id
+
 class TubeInformation(models.Model):
-    project_id = models.CharField(max_length=20)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id')
     tube_id = models.CharField(max_length=40)
     pool_id = models.CharField(
         max_length=30,
@@ -21,7 +44,10 @@ class TubeInformation(models.Model):
         return 'Tube ID: ' + self.tube_id
 
 class ComponentInformation(models.Model):
-    project_id = models.CharField(max_length=20)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id')
     pool_id = models.CharField(
         max_length=30,
         help_text=(
@@ -37,11 +63,19 @@ class ComponentInformation(models.Model):
     i7_index_sequence = models.CharField(max_length=40, null=True)
     i5_index_sequence = models.CharField(max_length=40, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'i7_index_sequence', 'i5_index_sequence']),
+        ]
+
     def __str__(self):
         return 'Sample ID: ' + self.sample_id
 
 class CoreData(models.Model):
-    project_id = models.CharField(max_length=20)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id')
     pool_id = models.CharField(
         max_length=30,
         help_text=(
@@ -62,12 +96,155 @@ class CoreData(models.Model):
     i7_index_sequence = models.CharField(max_length=40)
     i5_index_sequence = models.CharField(max_length=40, null = True)
     filename = models.CharField(max_length=100)
+    reads_scanned = models.BigIntegerField(
+        null=True,
+        help_text=(
+            "Reads streamed by the barcode analysis, null if it did not run."))
+    expected_index_fraction = models.FloatField(
+        null=True,
+        help_text=(
+            "Fraction of reads whose indexes are in range of the "
+            "file's consensus index."))
+    index_n_rate = models.FloatField(
+        null=True,
+        help_text=(
+            "Fraction of index bases called as N."))
+    unexpected_barcodes = models.TextField(
+        null=True,
+        help_text=(
+            "JSON list of the most common other [barcode, reads] pairs, "
+            "read counts are upper bounds."))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'i7_index_sequence', 'i5_index_sequence']),
+            models.Index(fields=['project', 'flowcell_id', 'lane']),
+        ]
 
     def __str__(self):
         return 'Filename: ' + self.filename
 
+class CatalogDirectory(models.Model):
+    """A directory visited by the FastQ catalog.
+
+    'mtime' is the directory mtime when its entries were last listed, or
+    null if they never have been.
+    """
+    path = models.CharField(max_length=255, unique=True)
+    parent = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        related_name='subdirectories',
+        null=True)
+    mtime = models.FloatField(null=True)
+    scanned_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return 'Directory: ' + self.path
+
+class FastQFile(models.Model):
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='fastq_files',
+        null=True,
+        help_text=(
+            "Null for files outside of project storage."))
+    directory = models.ForeignKey(
+        CatalogDirectory,
+        on_delete=models.CASCADE,
+        related_name='fastq_files')
+    path = models.CharField(max_length=255, unique=True)
+    filename = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    inode = models.BigIntegerField()
+    sample_id = models.CharField(max_length=30, null=True)
+    lane = models.CharField(max_length=30, null=True)
+    read = models.CharField(max_length=30, null=True)
+    ingested_at = models.DateTimeField(
+        null=True,
+        help_text=(
+            "When the delivery watcher last queued this file, "
+            "reset whenever the file changes."))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'filename']),
+        ]
+
+    def __str__(self):
+        return 'FastQ: ' + self.path
+
+class FastQScan(models.Model):
+    """Statistics from one streaming pass over a catalogued FastQ.
+
+    'size' and 'mtime' are those of the file when it was scanned, the scan
+    is out of date once they differ from its FastQFile.
+    """
+    fastq_file = models.OneToOneField(
+        FastQFile,
+        on_delete=models.CASCADE,
+        related_name='scan')
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    md5 = models.CharField(max_length=32)
+    sha256 = models.CharField(max_length=64)
+    read_count = models.BigIntegerField()
+    length_histogram = models.TextField(
+        help_text=(
+            "JSON object of read length to number of reads."))
+    cycle_mean_quality = models.TextField(
+        help_text=(
+            "JSON list of the mean Phred quality at each cycle."))
+    index_summary = models.TextField(
+        help_text=(
+            "JSON object with the most common barcodes and the "
+            "N rate of index bases."))
+    duration = models.FloatField()
+    scanned_at = models.DateTimeField(auto_now=True)
+
+    def is_current(self):
+        return (self.size, self.mtime) == (self.fastq_file.size, self.fastq_file.mtime)
+
+    def __str__(self):
+        return 'Scan: ' + self.fastq_file.path
+
+class ComparisonResult(models.Model):
+    """Cached result of a DataComparison, see DataComparison.compare_data.
+
+    'fingerprint' hashes the project's compared CoreData and
+    ComponentInformation rows with the comparison settings, a result is
+    only reused while none of them have changed.
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='comparison_results')
+    fingerprint = models.CharField(max_length=64)
+    result = models.TextField(
+        help_text=(
+            "JSON object of the match counts, matched and unmatched "
+            "index pairs, flagged core files and comparison output."))
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'fingerprint']),
+            models.Index(fields=['last_used_at']),
+        ]
+
+    def __str__(self):
+        return 'Comparison: ' + self.project_id
+
 class ExecutionStats(models.Model):
-    project_id = models.CharField(max_length=20)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id')
     exec_date = models.DateTimeField()
     EXEC_STATUS = (
         ('INIT', 'Initial State'),
@@ -81,5 +258,110 @@ class ExecutionStats(models.Model):
     )
     fail_reason = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'exec_date']),
+        ]
+
     def __str__(self):
         return 'Project ID: ' + self.project_id
+
+class ImportJob(models.Model):
+    """Import and comparison of a submission sheet, run as an rq job.
+
+    The worker records the stage it is in and the seconds spent in every
+    finished stage so that the status endpoint can be polled while the
+    job runs. The project is only known once the sheet has been parsed.
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        db_column='project_id',
+        related_name='import_jobs',
+        null=True)
+    job_id = models.CharField(max_length=64, null=True)
+    sheet_path = models.CharField(max_length=256)
+    fastq_directory = models.CharField(max_length=256)
+    delete_previous = models.BooleanField(default=False)
+    JOB_STATUS = (
+        ('QUEUED',  'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE',    'Done'),
+        ('FAILED',  'Failed')
+    )
+    status = models.CharField(
+        max_length=7,
+        choices=JOB_STATUS,
+        default='QUEUED',
+    )
+    STAGES = (
+        ('sheet',   'Submission sheet'),
+        ('fastq',   'FastQ headers'),
+        ('compare', 'Comparison')
+    )
+    stage = models.CharField(
+        max_length=7,
+        choices=STAGES,
+        null=True,
+    )
+    stage_started_at = models.DateTimeField(null=True)
+    stage_timings = models.TextField(
+        default='{}',
+        help_text=(
+            "JSON object of finished stage to seconds spent in it."))
+    result = models.TextField(
+        null=True,
+        help_text=(
+            "Comparison output, or the reason the job failed."))
+    enqueued_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'enqueued_at']),
+            models.Index(fields=['status', 'enqueued_at']),
+        ]
+
+    def close_stage(self, now):
+        if self.stage is not None:
+            timings = json.loads(self.stage_timings)
+            timings[self.stage] = (now - self.stage_started_at).total_seconds()
+            self.stage_timings = json.dumps(timings)
+
+    def enter_stage(self, stage):
+        now = timezone.now()
+        self.close_stage(now)
+        self.stage = stage
+        self.stage_started_at = now
+        self.save(update_fields=['project', 'stage', 'stage_started_at', 'stage_timings'])
+
+    def finish(self, status, result):
+        now = timezone.now()
+        self.close_stage(now)
+        self.status = status
+        self.result = result
+        self.finished_at = now
+        self.save()
+
+    def progress(self):
+        """JSON-serialisable state for the status endpoint."""
+
+        progress = {
+            'import_job': self.pk,
+            'job_id': self.job_id,
+            'project_id': self.project_id,
+            'status': self.status,
+            'stage': self.stage,
+            'stage_timings': json.loads(self.stage_timings),
+            'enqueued_at': self.enqueued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+        }
+        if self.status == 'RUNNING' and self.stage_started_at:
+            progress['stage_seconds'] = (timezone.now() - self.stage_started_at).total_seconds()
+        return progress
+
+    def __str__(self):
+        return 'Import job: ' + self.sheet_path
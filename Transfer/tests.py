@@ -1,13 +1,40 @@
+import io
 import os
-
-from django.test import TestCase
+import gzip
+import zlib
+import itertools
+import json
+import hashlib
+import shutil
+import time
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from django.utils import timezone
 
 from .transfer_settings import *
 from .forms import ImportCompareForm
-from .views import SubmissionExcelParser, FastQParser, DataComparison
+from .views import SubmissionExcelParser, FastQParser, DataComparison, run_import_job, delete_preexisting_wo_objects
+from .utils import (
+    FastQHeaderSampler, FastQReadSampler, GzipSeekIndex, SavedGzipSeekIndex, SpaceSaving, CountMinSketch,
+    FastQCatalog, FastQScanner, IndexMatcher, PackedIndexArray, UndeterminedMiner, PipedGzipReader,
+    LaneCollisionAnalysis, open_fastq, is_bgzf, decompression_backend, numpy, indexed_gzip, fast_gzip,
+    progress_events, error_logger
+    )
 from .constants import PROJECT_STORAGE
-from .models import TubeInformation, ComponentInformation, CoreData, ExecutionStats
+from .models import (
+    Project, TubeInformation, ComponentInformation, CoreData, ExecutionStats, FastQFile, FastQScan, ImportJob,
+    ComparisonResult, CatalogDirectory
+    )
+from .management.commands.watch_deliveries import Command
 
 sample_project_path = os.path.join(PROJECT_STORAGE, 'Transfer_Test')
 
@@ -254,6 +281,144 @@ class IndividualSubmissionExcelParserTest(TestCase):
             self.assertEqual(actual_i5_seq, row[10])
 
 
+class ReadOnlySubmissionExcelParserTest(TestCase):
+
+    sheet_names = ['Sample_Submission_Sheet_Indiv.xlsx', 'Sample_Submission_Sheet_Pool.xlsx']
+
+    def test_modes_agree(self):
+
+        for sheet_name in self.sheet_names:
+            sheet_path = os.path.join(sample_project_path, 'Sample_Sheet', sheet_name)
+            streamed = SubmissionExcelParser(sheet_path, read_only=True)
+            loaded = SubmissionExcelParser(sheet_path, read_only=False)
+            streamed.find_columns()
+            loaded.find_columns()
+
+            self.assertEqual(streamed.submission_type, loaded.submission_type)
+            self.assertEqual(streamed.project_id_from_sheet, loaded.project_id_from_sheet)
+            self.assertEqual(streamed.header_coordinates, loaded.header_coordinates)
+
+            for header, (column, row) in loaded.header_coordinates.items():
+                for data_row in range(row, row + 5):
+                    self.assertEqual(
+                        streamed.value_in_column(data_row, header),
+                        loaded.value_in_column(data_row, header)
+                        )
+
+    def test_closed_on_error(self):
+
+        sheet_path = os.path.join(sample_project_path, 'Sample_Sheet', self.sheet_names[0])
+        with mock.patch('Transfer.utils.load_workbook') as load_workbook, \
+                mock.patch.object(SubmissionExcelParser, 'read_rows', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                SubmissionExcelParser(sheet_path, read_only=True)
+
+        load_workbook.return_value.close.assert_called_once_with()
+
+class ProjectTest(TestCase):
+    """Every project keyed table points at Project through a 'project_id'
+    column, rows are still filtered and built by project ID."""
+
+    def test_parsers_create_project(self):
+
+        self.assertFalse(Project.objects.exists())
+
+        parser = SubmissionExcelParser(
+            os.path.join(sample_project_path, 'Sample_Sheet', 'Sample_Submission_Sheet_Pool.xlsx'))
+        parser.find_columns()
+        parser.parse_pool_submission()
+        self.assertTrue(Project.objects.filter(project_id=parser.project_id_from_sheet).exists())
+
+        FastQParser(os.path.join(sample_project_path, 'FastQ_Files'), 'Project_Test').parse_fastq_files(processes=1)
+        self.assertTrue(Project.objects.filter(project_id='Project_Test').exists())
+
+    def test_logger_creates_project(self):
+
+        error_logger('Logged_Test', 'FAIL', 'Test failure')
+
+        self.assertTrue(Project.objects.filter(project_id='Logged_Test').exists())
+        self.assertEqual(ExecutionStats.objects.get(project_id='Logged_Test').fail_reason, 'Test failure')
+
+    def test_project_id_lookups(self):
+
+        project = Project.objects.create(project_id='Lookup_Test')
+        CoreData.objects.create(
+            project_id='Lookup_Test', sample_id='SAM1', flowcell_id='HMKJCCCXY', lane='L001', read='R1',
+            i7_index_sequence='ACGTACGT', filename='SAM1_S1_L001_R1_001.fastq.gz')
+        ComponentInformation.objects.bulk_create([
+            ComponentInformation(project_id='Lookup_Test', sample_id='SAM1', i7_index_sequence='ACGTACGT')
+            ])
+
+        core_data = CoreData.objects.get(project_id='Lookup_Test')
+        self.assertEqual(core_data.project, project)
+        self.assertEqual(core_data.project_id, 'Lookup_Test')
+        self.assertEqual(
+            list(ComponentInformation.objects.filter(project_id='Lookup_Test').values_list('project_id', flat=True)),
+            ['Lookup_Test']
+            )
+        self.assertEqual(project.coredata_set.get(), core_data)
+        self.assertEqual(CoreData.objects.filter(project__project_id='Lookup_Test').get(), core_data)
+
+        # Rows go with their project
+        project.delete()
+        self.assertFalse(CoreData.objects.exists())
+        self.assertFalse(ComponentInformation.objects.exists())
+
+class BulkCreateTest(TestCase):
+    """Batched bulk inserts save the same rows as one save() per object."""
+
+    sheet_path = os.path.join(sample_project_path, 'Sample_Sheet', 'Sample_Submission_Sheet_Pool.xlsx')
+    fastq_directory = os.path.join(sample_project_path, 'FastQ_Files')
+
+    @staticmethod
+    def saved_rows(model, project_id):
+        rows = list(model.objects.filter(project_id=project_id).order_by('pk').values())
+        for row in rows:
+            row.pop('id', None)
+        return rows
+
+    @staticmethod
+    def save_each(objects, batch_size=None):
+        for obj in objects:
+            obj.save()
+        return objects
+
+    def import_project(self):
+        parser = SubmissionExcelParser(self.sheet_path)
+        parser.find_columns()
+        parser.parse_pool_submission()
+        FastQParser(self.fastq_directory, parser.project_id_from_sheet).parse_fastq_files(processes=1)
+        return parser.project_id_from_sheet
+
+    def test_batches_match_per_row_saves(self):
+
+        models = [TubeInformation, ComponentInformation, CoreData]
+
+        with mock.patch.object(TubeInformation.objects, 'bulk_create', side_effect=self.save_each), \
+                mock.patch.object(ComponentInformation.objects, 'bulk_create', side_effect=self.save_each), \
+                mock.patch.object(CoreData.objects, 'bulk_create', side_effect=self.save_each):
+            project_id = self.import_project()
+        per_row = {model: self.saved_rows(model, project_id) for model in models}
+        for model in models:
+            model.objects.filter(project_id=project_id).delete()
+
+        # Two rows per batch, the sheet has three components and the
+        # directory three FastQs
+        self.assertGreater(len(per_row[ComponentInformation]), 2)
+        self.assertGreater(len(per_row[CoreData]), 2)
+        with mock.patch('Transfer.utils.bulk_create_batch_size', 2), \
+                CaptureQueriesContext(connection) as queries:
+            self.import_project()
+
+        for model in models:
+            self.assertEqual(self.saved_rows(model, project_id), per_row[model])
+
+            inserts = [
+                query for query in queries.captured_queries
+                if query['sql'].startswith(f'INSERT INTO "{model._meta.db_table}"')
+                ]
+            self.assertEqual(len(inserts), -(-len(per_row[model]) // 2))
+
 class ImportFastQTest(TestCase):
 
     fastq_files_in_folder = 1
@@ -301,6 +466,534 @@ class ImportFastQTest(TestCase):
         actual_i5_seq = core_data_object.i5_index_sequence
         self.assertEqual(str(actual_i5_seq), self.single_fastq_values[2])
 
+class ParallelImportFastQTest(TestCase):
+
+    fastq_files_in_folder = 3
+
+    def setUp(self):
+
+        self.importer = FastQParser(os.path.join(sample_project_path, 'FastQ_Files'), 'Transfer_Test')
+        self.numof_files_parsed = self.importer.parse_fastq_files(processes=2)
+
+    def test_made_one_object_per_fastq(self):
+
+        self.assertEqual(self.numof_files_parsed, self.fastq_files_in_folder)
+        self.assertEqual(CoreData.objects.all().count(), self.fastq_files_in_folder)
+
+    def test_per_file_timings(self):
+
+        self.assertEqual(len(self.importer.file_timings), self.fastq_files_in_folder)
+        self.assertEqual(len(self.importer.bytes_read), self.fastq_files_in_folder)
+
+    def test_failed_file_writes_nothing(self):
+
+        CoreData.objects.all().delete()
+
+        with tempfile.TemporaryDirectory() as fastq_directory:
+            for fastq_file in os.listdir(self.importer.fastq_directory):
+                shutil.copy(os.path.join(self.importer.fastq_directory, fastq_file), fastq_directory)
+            with gzip.open(os.path.join(fastq_directory, 'BAD_S1_L001_R1_001.fastq.gz'), 'wb') as bad_file:
+                bad_file.write(b'@E00558:209:HMKJCCCXY:5:1101:1:1 1:N:0:ACGTXCGT\nA\n+\n#\n' * 2)
+
+            importer = FastQParser(fastq_directory, 'Transfer_Test')
+            with self.assertRaises(Exception):
+                importer.parse_fastq_files(processes=2)
+
+        self.assertEqual(CoreData.objects.all().count(), 0)
+
+def bgzf_compress(data, block_size=60000):
+    """BGZF blocks of 'data' followed by the empty end of file block."""
+
+    blocks = []
+    for start in range(0, len(data) + 1, block_size):
+        chunk = data[start:start + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        block_size_field = (18 + len(deflated) + 8 - 1).to_bytes(2, 'little')
+        blocks.append(
+            b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + block_size_field +
+            deflated + zlib.crc32(chunk).to_bytes(4, 'little') + len(chunk).to_bytes(4, 'little')
+            )
+    return b''.join(blocks)
+
+class FastQDecompressionTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.content = b''.join(
+            f'@E00558:209:HMKJCCCXY:1:1101:{record_num}:1 1:N:0:ACGTACGT\n{"ACGT" * 30}\n+\n{"F" * 120}\n'.encode()
+            for record_num in range(5000)
+            )
+        cls.gzip_path = os.path.join(cls.directory, 'SAM1_S1_L001_R1_001.fastq.gz')
+        with open(cls.gzip_path, 'wb') as fastq:
+            fastq.write(gzip.compress(cls.content))
+        cls.bgzf_path = os.path.join(cls.directory, 'SAM2_S2_L001_R1_001.fastq.gz')
+        with open(cls.bgzf_path, 'wb') as fastq:
+            fastq.write(bgzf_compress(cls.content))
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+        super().tearDownClass()
+
+    def read_all(self, fastq_path, backend, threads=2):
+
+        compressed = []
+        with open_fastq(fastq_path, backend, threads, on_compressed=compressed.append) as fastq:
+            content = fastq.read()
+        with open(fastq_path, 'rb') as fastq:
+            self.assertEqual(b''.join(compressed), fastq.read())
+        return content
+
+    def test_backends(self):
+
+        backends = ['zlib'] + (['library'] if fast_gzip is not None else [])
+        for backend in backends:
+            self.assertEqual(self.read_all(self.gzip_path, backend), self.content)
+            self.assertEqual(self.read_all(self.bgzf_path, backend), self.content)
+
+        self.assertEqual(self.read_all(self.bgzf_path, 'bgzf'), self.content)
+
+    def test_bgzf_detection(self):
+
+        self.assertTrue(is_bgzf(self.bgzf_path))
+        self.assertFalse(is_bgzf(self.gzip_path))
+        self.assertEqual(decompression_backend(self.bgzf_path, threads=4), 'bgzf')
+        self.assertNotEqual(decompression_backend(self.bgzf_path, threads=1), 'bgzf')
+
+        with self.assertRaises(Exception):
+            self.read_all(self.gzip_path, 'bgzf')
+
+    def test_lines(self):
+
+        with open_fastq(self.bgzf_path, 'bgzf', threads=3) as fastq:
+            headers = list(itertools.islice(fastq, 0, None, 4))
+
+        self.assertEqual(len(headers), 5000)
+        self.assertTrue(headers[-1].startswith(b'@E00558:209:HMKJCCCXY:1:1101:4999:1'))
+
+    @unittest.skipIf(shutil.which('gzip') is None, 'gzip is not on the PATH')
+    def test_pipe(self):
+
+        for on_compressed in [None, lambda block: None]:
+            with io.BufferedReader(PipedGzipReader(self.gzip_path, ['gzip', '-dc'], on_compressed)) as fastq:
+                self.assertEqual(fastq.read(), self.content)
+
+        # Closing early stops the process
+        reader = PipedGzipReader(self.gzip_path, ['gzip', '-dc'])
+        with io.BufferedReader(reader, buffer_size=16) as fastq:
+            self.assertEqual(fastq.readline(), self.content.split(b'\n')[0] + b'\n')
+        self.assertIsNotNone(reader.process.returncode)
+
+class FastQHeaderSamplerTest(TestCase):
+
+    fastq_path = os.path.join(sample_project_path, 'Single_FastQ', '17127FL-27-01-dd06-A2_S105_L004_R1_001.fastq.gz')
+
+    def setUp(self):
+
+        self.sampler = FastQHeaderSampler(self.fastq_path)
+        self.headers = self.sampler.sample()
+
+    def test_sample_size(self):
+
+        self.assertEqual(len(self.headers), fastq_header_sample_size)
+
+    def test_headers_are_identifiers(self):
+
+        for header in self.headers:
+            self.assertTrue(header.startswith(b'@E00558:209:HMKJCCCXY:4'))
+            self.assertTrue(header.endswith(b'NGTACTAG+NTAGTCGA'))
+
+    def test_bytes_read(self):
+
+        self.assertTrue(0 < self.sampler.bytes_read <= os.path.getsize(self.fastq_path))
+
+class FastQReadSamplerTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        super().setUpClass()
+        # Two concatenated gzip members, index reads differ from the
+        # consensus by one base in every tenth record
+        cls.directory = tempfile.mkdtemp()
+        cls.fastq_path = os.path.join(cls.directory, 'SAM1_S1_L001_R1_001.fastq.gz')
+        generator = random.Random(0)
+        records = []
+        for record_num in range(20000):
+            index = 'ACGTACGA' if record_num % 10 == 0 else 'ACGTACGT'
+            sequence = ''.join(generator.choices('ACGT', k=100))
+            quality = ''.join(generator.choices('#,:FF', k=100))
+            records.append(
+                f'@E00558:209:HMKJCCCXY:1:1101:{record_num}:1 1:N:0:{index}+TTGGCCAA\n'
+                f'{sequence}\n+\n{quality}\n'.encode()
+                )
+        with open(cls.fastq_path, 'wb') as fastq:
+            fastq.write(gzip.compress(b''.join(records[:12000])))
+            fastq.write(gzip.compress(b''.join(records[12000:])))
+        cls.content = b''.join(records)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        if indexed_gzip is not None:
+            for num_points in [fastq_read_sample_size, 32]:
+                index_path = SavedGzipSeekIndex(cls.fastq_path, num_points).cache_path()
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+        shutil.rmtree(cls.directory)
+        super().tearDownClass()
+
+    def test_read_at(self):
+
+        index = GzipSeekIndex(self.fastq_path, 16).build()
+
+        self.assertEqual(index.size, len(self.content))
+        self.assertGreater(len(index.access_points()), 8)
+        for offset in [0, 1000, len(self.content) // 2, len(self.content) - 100]:
+            self.assertEqual(index.read_at(offset, 500), self.content[offset:offset + 500])
+
+    @unittest.skipIf(indexed_gzip is None, 'indexed_gzip is not installed')
+    def test_saved_index(self):
+
+        index = SavedGzipSeekIndex(self.fastq_path).build()
+        index_path = index.cache_path()
+        self.assertTrue(os.path.exists(index_path))
+        index.close()
+
+        index = SavedGzipSeekIndex(self.fastq_path).build()
+        self.assertEqual(index.bytes_read, 0)
+        self.assertEqual(index.read_at(len(self.content) // 2, 500), self.content[len(self.content) // 2:][:500])
+        index.close()
+
+    @unittest.skipIf(indexed_gzip is None, 'indexed_gzip is not installed')
+    def test_prune_cache(self):
+
+        with mock.patch('Transfer.utils.gzip_index_cache', self.directory):
+            index = SavedGzipSeekIndex(self.fastq_path, 16).build()
+            index.close()
+            index_path = index.cache_path()
+            self.assertTrue(os.path.exists(index_path))
+
+            SavedGzipSeekIndex.prune_cache(os.path.getsize(index_path))
+            self.assertTrue(os.path.exists(index_path))
+            SavedGzipSeekIndex.prune_cache(0)
+            self.assertFalse(os.path.exists(index_path))
+
+    def test_import_reads_headers_only(self):
+
+        core_field_dict, bytes_read, elapsed = FastQParser(
+            self.directory, 'Sampler_Test'
+            ).parse_fastq_file(os.path.basename(self.fastq_path))
+
+        self.assertEqual(core_field_dict['flowcell_id'], 'HMKJCCCXY')
+        self.assertLess(bytes_read, os.path.getsize(self.fastq_path) // 10)
+
+    @mock.patch('Transfer.utils.indexed_gzip', None)
+    @mock.patch('Transfer.utils.fastq_read_sampling', True)
+    def test_sampling_needs_saved_index(self):
+
+        importer = FastQParser(self.directory, 'Sampler_Test')
+
+        # Without indexed_gzip every process would inflate every file
+        with mock.patch('Transfer.utils.FastQReadSampler', wraps=FastQReadSampler) as read_sampler, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            importer.parse_fastq_files(processes=1)
+        read_sampler.assert_not_called()
+        self.assertIn('WARNING: fastq_read_sampling needs indexed_gzip', stdout.getvalue())
+
+        with mock.patch('Transfer.utils.fastq_read_sampling_in_memory', True), \
+                mock.patch('Transfer.utils.FastQReadSampler', wraps=FastQReadSampler) as read_sampler:
+            importer.parse_fastq_file(os.path.basename(self.fastq_path))
+        read_sampler.assert_called_once_with(self.fastq_path)
+
+    def test_sample_spans_file(self):
+
+        sampler = FastQReadSampler(self.fastq_path, 32)
+        headers = sampler.sample()
+
+        self.assertGreater(len(headers), 8)
+        for header in headers:
+            self.assertTrue(header.startswith(b'@E00558:209:HMKJCCCXY:1:1101:'))
+        record_nums = [int(header.split(b':')[5]) for header in headers]
+        self.assertLess(min(record_nums), 2000)
+        self.assertGreater(max(record_nums), 18000)
+
+        # The index is reused while the file is unchanged
+        sampler.sample()
+        self.assertLess(sampler.bytes_read, os.path.getsize(self.fastq_path))
+
+    def test_consensus_index(self):
+
+        parser = FastQParser(self.directory, 'Sampler_Test')
+        core_field_dict = parser.parse_illumina_fastq_content(
+            FastQReadSampler(self.fastq_path, 32).sample(), {}
+            )
+
+        self.assertEqual(core_field_dict['i7_index_sequence'], 'ACGTACGT')
+        self.assertEqual(core_field_dict['i5_index_sequence'], 'TTGGCCAA')
+        self.assertEqual(core_field_dict['flowcell_id'], 'HMKJCCCXY')
+
+    def test_mixed_indexes_rejected(self):
+
+        headers = [b'@E00558:209:HMKJCCCXY:1:1101:1:1 1:N:0:ACGTACGT'] * 5
+        headers += [b'@E00558:209:HMKJCCCXY:1:1101:1:1 1:N:0:TTTTCCCC'] * 3
+
+        with self.assertRaises(Exception):
+            FastQParser(self.directory, 'Sampler_Test').parse_illumina_fastq_content(headers, {})
+
+class BarcodeAnalysisTest(TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.fastq_path = os.path.join(self.directory, 'SAM1_S1_L001_R1_001.fastq.gz')
+        barcodes = (
+            ['ACGTACGT+TTGGCCAA'] * 940 + ['ACGTACGA+TTGGCCAA'] * 30 +
+            ['GGGGAAAA+CCCCTTTT'] * 20 + ['NNNNNNNN+TTGGCCAA'] * 10
+            )
+        records = [
+            f'@E00558:209:HMKJCCCXY:1:1101:{record_num}:1 1:N:0:{barcode}\nACGT\n+\nFFFF\n'
+            for record_num, barcode in enumerate(barcodes)
+            ]
+        with gzip.open(self.fastq_path, 'wb') as fastq:
+            fastq.write(''.join(records).encode())
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_space_saving(self):
+
+        sketch = SpaceSaving(4)
+        stream = ['a'] * 50 + ['b'] * 30 + [str(item) for item in range(40)] + ['a'] * 10
+
+        for item in stream:
+            sketch.update(item)
+
+        top = sketch.top(2)
+        self.assertEqual(sketch.total, len(stream))
+        self.assertEqual([item for item, count, error in top], ['a', 'b'])
+        for item, count, error in top:
+            self.assertTrue(count - error <= stream.count(item) <= count)
+
+    def test_analyse_barcodes(self):
+
+        core_field_dict = FastQParser.analyse_barcodes(
+            self.fastq_path,
+            {'i7_index_sequence': 'ACGTACGT', 'i5_index_sequence': 'TTGGCCAA'}
+            )
+
+        self.assertEqual(core_field_dict['reads_scanned'], 1000)
+        self.assertAlmostEqual(core_field_dict['expected_index_fraction'], 0.97)
+        self.assertAlmostEqual(core_field_dict['index_n_rate'], 80 / 16000)
+        self.assertEqual(
+            json.loads(core_field_dict['unexpected_barcodes']),
+            [['GGGGAAAA+CCCCTTTT', 20], ['NNNNNNNN+TTGGCCAA', 10]]
+            )
+
+    def test_parse_with_analysis(self):
+
+        FastQParser(self.directory, 'Barcode_Test', barcode_analysis=True).parse_fastq_files()
+        core_data = CoreData.objects.get(project_id='Barcode_Test')
+
+        self.assertEqual(core_data.i7_index_sequence, 'ACGTACGT')
+        self.assertEqual(core_data.reads_scanned, 1000)
+
+    def test_parse_from_scan(self):
+
+        FastQCatalog(self.directory).scan(self.directory)
+
+        # A current scan stands in for the file itself
+        importer = FastQParser(self.directory, 'Barcode_Test', barcode_analysis=True)
+        with mock.patch('Transfer.utils.open_fastq') as open_fastq, \
+                mock.patch('Transfer.utils.FastQHeaderSampler') as header_sampler:
+            importer.parse_fastq_files()
+        open_fastq.assert_not_called()
+        header_sampler.assert_not_called()
+        self.assertEqual(importer.bytes_read, {'SAM1_S1_L001_R1_001.fastq.gz': 0})
+
+        core_data = CoreData.objects.get(project_id='Barcode_Test')
+        self.assertEqual(core_data.i7_index_sequence, 'ACGTACGT')
+        self.assertEqual(core_data.i5_index_sequence, 'TTGGCCAA')
+        self.assertEqual(core_data.flowcell_id, 'HMKJCCCXY')
+        self.assertEqual(core_data.reads_scanned, 1000)
+        self.assertAlmostEqual(core_data.expected_index_fraction, 0.97)
+        self.assertAlmostEqual(core_data.index_n_rate, 80 / 16000)
+        self.assertEqual(
+            json.loads(core_data.unexpected_barcodes),
+            [['GGGGAAAA+CCCCTTTT', 20], ['NNNNNNNN+TTGGCCAA', 10]]
+            )
+
+    def test_parse_with_stale_scan(self):
+
+        FastQCatalog(self.directory).scan(self.directory)
+        with open(self.fastq_path, 'ab') as fastq:
+            fastq.write(gzip.compress(b'@E00558:209:HMKJCCCXY:1:1101:0:2 1:N:0:ACGTACGT+TTGGCCAA\nACGT\n+\nFFFF\n'))
+        FastQCatalog(self.directory).refresh(full=True)
+
+        importer = FastQParser(self.directory, 'Barcode_Test', barcode_analysis=True)
+        importer.parse_fastq_files()
+
+        self.assertGreater(importer.bytes_read['SAM1_S1_L001_R1_001.fastq.gz'], 0)
+        self.assertEqual(CoreData.objects.get(project_id='Barcode_Test').reads_scanned, 1001)
+
+    def test_parse_after_rewrite(self):
+
+        # Directory mtimes well before the scan, so only a full refresh
+        # or a stat of the file sees the rewrite
+        aged = time.time() - 60
+        os.utime(self.fastq_path, (aged, aged))
+        os.utime(self.directory, (aged, aged))
+        FastQCatalog(self.directory).scan(self.directory)
+
+        records = [
+            f'@E00558:209:HMKJCCCXY:1:1101:{record_num}:1 1:N:0:GGGGAAAA+CCCCTTTT\nACGTACGT\n+\nFFFFFFFF\n'
+            for record_num in range(1000)
+            ]
+        with gzip.open(self.fastq_path, 'wb') as fastq:
+            fastq.write(''.join(records).encode())
+        os.utime(self.directory, (aged, aged))
+
+        FastQParser(self.directory, 'Barcode_Test').parse_fastq_files()
+        core_data = CoreData.objects.get(project_id='Barcode_Test')
+
+        self.assertEqual(core_data.i7_index_sequence, 'GGGGAAAA')
+        self.assertEqual(core_data.i5_index_sequence, 'CCCCTTTT')
+
+class UndeterminedMinerTest(TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        barcodes = (
+            ['AAAACCCC+AAAACCCC'] * 500 + ['TTTAGGGC+ACCCAAAG'] * 300 +
+            [f'GATTACA{base}+CATCATCA' for base in 'ACGT'] * 25
+            )
+        records = ''.join(
+            f'@E00558:209:HMKJCCCXY:1:1101:{record_num}:1 1:N:0:{barcode}\nACGT\n+\nFFFF\n'
+            for record_num, barcode in enumerate(barcodes)
+            ).encode()
+        for fastq_file in ['Undetermined_S0_L001_R1_001.fastq.gz', 'Undetermined_S0_L002_R1_001.fastq.gz',
+                           'Undetermined_S0_L001_R2_001.fastq.gz']:
+            with gzip.open(os.path.join(self.directory, fastq_file), 'wb') as fastq:
+                fastq.write(records)
+
+        project = Project.objects.create(project_id='Miner_Test')
+        ComponentInformation.objects.create(
+            project=project, sample_id='SAMA', i7_index_sequence='AAAACCCC', i5_index_sequence='GGGGTTTT')
+        ComponentInformation.objects.create(
+            project=project, sample_id='SAMB', i7_index_sequence='ACCCAAAG', i5_index_sequence='TTTAGGGC')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_count_min_sketch(self):
+
+        sketch = CountMinSketch(width=64, depth=4, top_k=2)
+        other = CountMinSketch(width=64, depth=4, top_k=2)
+        for item, count in [(b'a', 50), (b'b', 30), (b'c', 5)]:
+            sketch.update(item, count)
+            other.update(item, count)
+        sketch.merge(other)
+
+        self.assertEqual(sketch.total, 170)
+        self.assertGreaterEqual(sketch.estimate(b'a'), 100)
+        self.assertEqual([item for item, count in sketch.most_common()], [b'a', b'b'])
+
+    def test_undetermined_files(self):
+
+        miner = UndeterminedMiner('Miner_Test', self.directory)
+
+        self.assertEqual(
+            [os.path.basename(fastq_path) for fastq_path in miner.undetermined_files()],
+            ['Undetermined_S0_L001_R1_001.fastq.gz', 'Undetermined_S0_L002_R1_001.fastq.gz']
+            )
+
+    def test_mine(self):
+
+        miner = UndeterminedMiner('Miner_Test', self.directory, processes=2)
+        report = miner.mine()
+        findings = [(obj.sample_id, orientation, barcode) for obj, orientation, barcode, reads in miner.findings]
+
+        self.assertEqual(miner.sketch.total, 1800)
+        self.assertEqual(findings, [
+            ('SAMA', 'i5 reverse complemented', 'AAAACCCC+AAAACCCC'),
+            ('SAMB', 'swapped', 'TTTAGGGC+ACCCAAAG'),
+            ])
+        self.assertGreaterEqual(miner.findings[0][3], 1000)
+        self.assertIn('SAMA', report)
+
+class LaneCollisionTest(TestCase):
+
+    # project, sample, flowcell, lane, i7, i5
+    core_libraries = [
+        ('Lane_A', 'A1', 'HMKJCCCXY', 'L001', 'AAAACCCC', 'GGGGTTTT'),
+        ('Lane_A', 'A2', 'HMKJCCCXY', 'L001', 'AAAACCGG', 'GGGGTTTT'),
+        ('Lane_B', 'B1', 'HMKJCCCXY', 'L001', 'AAAACCCA', 'GGGGTTTN'),
+        ('Lane_B', 'B2', 'HMKJCCCXY', 'L001', 'TTTTGGGG', 'CCCCAAAA'),
+        ('Lane_C', 'C1', 'HMKJCCCXY', 'L002', 'AAAACCCC', 'GGGGTTTT'),
+    ]
+
+    def setUp(self):
+
+        for project_id, sample_id, flowcell_id, lane, i7, i5 in self.core_libraries:
+            project, _ = Project.objects.get_or_create(project_id=project_id)
+            CoreData.objects.create(
+                project=project, sample_id=sample_id, flowcell_id=flowcell_id, lane=lane,
+                read='R1', i7_index_sequence=i7, i5_index_sequence=i5, filename=sample_id + '.fastq.gz')
+
+        # Declared by the customer but not in the FastQs
+        ComponentInformation.objects.create(
+            project_id='Lane_B', sample_id='B3', i7_index_sequence='TTTTGGCC', i5_index_sequence='AAAACCGG')
+
+    def collided_samples(self, analysis):
+        return [
+            (library[0], library[3], other[0], other[3], i7_mismatches, i5_mismatches)
+            for library, other, i7_mismatches, i5_mismatches in analysis.collisions
+            ]
+
+    def test_shared_lanes(self):
+
+        self.assertEqual(LaneCollisionAnalysis.shared_lanes(), [('HMKJCCCXY', 'L001')])
+        self.assertEqual(LaneCollisionAnalysis.shared_lanes('Lane_C'), [])
+
+    def test_collisions(self):
+
+        analysis = LaneCollisionAnalysis('HMKJCCCXY', 'L001', max_distance=2)
+        analysis.analyse()
+
+        self.assertEqual(self.collided_samples(analysis), [
+            ('Lane_A', ['A1'], 'Lane_B', ['B1'], 1, 0),
+            ('Lane_A', ['A2'], 'Lane_B', ['B1'], 2, 0),
+        ])
+
+        analysis.max_distance = 0
+        analysis.analyse()
+        self.assertEqual(analysis.collisions, [])
+
+    def test_single_index_library(self):
+
+        ComponentInformation.objects.create(
+            project_id='Lane_A', sample_id='A3', i7_index_sequence='TTTTGGGC', i5_index_sequence=None)
+
+        analysis = LaneCollisionAnalysis('HMKJCCCXY', 'L001', max_distance=1)
+        analysis.analyse()
+
+        self.assertIn(('Lane_A', ['A3'], 'Lane_B', ['B2'], 1, 0), self.collided_samples(analysis))
+
+    def test_command(self):
+
+        output = io.StringIO()
+        call_command('lane_collisions', project='Lane_A', stdout=output)
+
+        self.assertIn('Flowcell HMKJCCCXY lane L001: 5 libraries, 2 cross-project collisions', output.getvalue())
+
 class CompareDataTest(TestCase):
 
     bad_pairs_cust = [('AAAAAAA', 'TTTTTTTT'), ('TTTTTTT', 'AAAAAAA')]
@@ -319,6 +1012,88 @@ class CompareDataTest(TestCase):
         self.comparer = DataComparison('Transfer_Test')
         self.comparer.compare_data()
 
+    def test_flagged_core(self):
+
+        self.assertEqual(self.comparer.flagged_core, [])
+        # Imported without barcode analysis, nothing to report
+        self.assertNotIn('hopped or contaminated', self.comparer.comparison_output)
+
+        core_data = CoreData.objects.filter(project_id='Transfer_Test').first()
+        core_data.expected_index_fraction = 0.5
+        core_data.save()
+        self.comparer.compare_data()
+
+        self.assertEqual(len(self.comparer.flagged_core), 1)
+        self.assertEqual(self.comparer.flagged_core[0][0], core_data.filename)
+        self.assertIn('Core files possibly hopped or contaminated', self.comparer.comparison_output)
+
+    def test_cached_result(self):
+
+        self.assertFalse(self.comparer.cached)
+
+        cached_comparer = DataComparison('Transfer_Test', backend=self.comparer.backend)
+        cached_comparer.compare_data()
+
+        self.assertTrue(cached_comparer.cached)
+        for field in DataComparison.result_fields:
+            self.assertEqual(getattr(cached_comparer, field), getattr(self.comparer, field))
+
+    def test_cache_invalidation(self):
+
+        self.assertTrue(ComparisonResult.objects.filter(project_id='Transfer_Test').exists())
+
+        delete_preexisting_wo_objects('Transfer_Test')
+        self.assertFalse(ComparisonResult.objects.filter(project_id='Transfer_Test').exists())
+
+        self.importer.parse_fastq_files()
+        self.comparer.compare_data()
+        self.assertFalse(self.comparer.cached)
+        self.importer.parse_fastq_files()
+        self.assertFalse(ComparisonResult.objects.filter(project_id='Transfer_Test').exists())
+
+    def test_cache_eviction(self):
+
+        core_data = CoreData.objects.filter(project_id='Transfer_Test').first()
+        core_data.i7_index_sequence = 'ACGTACGT'
+        core_data.save()
+
+        with mock.patch('Transfer.utils.comparison_cache_size', 1):
+            self.comparer.compare_data()
+
+        self.assertFalse(self.comparer.cached)
+        self.assertEqual(ComparisonResult.objects.count(), 1)
+
+    def test_i5_orientation(self):
+
+        self.assertEqual(self.comparer.i5_orientation, 'forward')
+        self.assertEqual(Project.objects.get(project_id='Transfer_Test').i5_orientation, 'forward')
+
+        project = Project.objects.create(project_id='Orientation_Test')
+        for sample_id, i7, i5 in [('S1', 'AAAACCCC', 'GGGATTTT'), ('S2', 'CCCCAAAA', 'TTTAGGGG'),
+                                  ('S3', 'ACGTACGT', 'GGGGGGGG')]:
+            CoreData.objects.create(
+                project=project, sample_id=sample_id, flowcell_id='HMKJCCCXY', lane='L001', read='R1',
+                i7_index_sequence=i7, i5_index_sequence=i5, filename=sample_id + '.fastq.gz')
+        # i5 as written for the other chemistry, S2 with a sequencing error
+        for sample_id, i7, i5 in [('S1', 'AAAACCCC', 'AAAATCCC'), ('S2', 'CCCCAAAA', 'CCCCTAAT'),
+                                  ('S3', 'ACGTACGT', 'CCCCCCCC')]:
+            ComponentInformation.objects.create(
+                project=project, sample_id=sample_id, i7_index_sequence=i7, i5_index_sequence=i5)
+
+        comparer = DataComparison('Orientation_Test', backend=self.comparer.backend)
+        comparer.compare_data()
+
+        self.assertEqual(comparer.i5_orientation, 'reverse_complement')
+        self.assertEqual(comparer.match_num, 3)
+        self.assertEqual(comparer.no_match_cust, [])
+        self.assertEqual(Project.objects.get(project_id='Orientation_Test').i5_orientation, 'reverse_complement')
+
+        with mock.patch('Transfer.utils.detect_i5_orientation', False):
+            comparer.compare_data()
+
+        self.assertEqual(comparer.i5_orientation, None)
+        self.assertEqual(comparer.match_num, 0)
+
     def test_match_number(self):
 
         expected_matches = 1
@@ -347,3 +1122,393 @@ class CompareDataTest(TestCase):
 
         self.assertEqual(sorted(expected_bad_matches), sorted(actual_bad_matches))
         self.assertEqual(expected_bad_match_num, actual_bad_match_num)
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class VectorizedCompareDataTest(CompareDataTest):
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.comparer = DataComparison('Transfer_Test', backend='numpy')
+        self.comparer.compare_data()
+
+    def test_distance_matrix_shape(self):
+
+        self.assertEqual(self.comparer.distance_matrix.shape, (3, 3))
+
+    def test_packed_distances(self):
+
+        customer = PackedIndexArray(['ACGTACGT', 'GGGGGGGG', 'None'])
+        core = PackedIndexArray(['NCGTACGA', 'GGGGGGG', 'None'])
+        distances = customer.distances(core)
+
+        self.assertEqual(distances[0][0], 1)
+        self.assertEqual(distances[1][0], 5)
+        self.assertEqual(distances[1][1], PackedIndexArray.max_length + 1)
+        self.assertEqual(distances[2][2], 0)
+
+class ImportJobTest(TestCase):
+
+    sheet_path = os.path.join(sample_project_path, 'Sample_Sheet', 'Sample_Submission_Sheet_Indiv.xlsx')
+
+    def setUp(self):
+
+        self.import_job = ImportJob.objects.create(
+            sheet_path = self.sheet_path,
+            fastq_directory = os.path.join(sample_project_path, 'FastQ_Files'),
+            enqueued_at = timezone.now()
+        )
+
+    def test_run_import_job(self):
+
+        comparison_output = run_import_job(self.import_job.pk)
+        self.import_job.refresh_from_db()
+
+        self.assertEqual(self.import_job.status, 'DONE')
+        self.assertEqual(self.import_job.project_id, 'Transfer_Test')
+        self.assertEqual(self.import_job.result, comparison_output)
+        self.assertIn('Matches: 1', comparison_output)
+        self.assertEqual(
+            sorted(json.loads(self.import_job.stage_timings)), ['compare', 'fastq', 'sheet'])
+        self.assertEqual(
+            ExecutionStats.objects.get(project_id='Transfer_Test').exec_status, 'OK')
+
+    def test_duplicate_project_fails(self):
+
+        run_import_job(self.import_job.pk)
+        duplicate_job = ImportJob.objects.create(
+            sheet_path = self.sheet_path,
+            fastq_directory = self.import_job.fastq_directory,
+            enqueued_at = timezone.now()
+        )
+
+        with self.assertRaises(Exception):
+            run_import_job(duplicate_job.pk)
+        duplicate_job.refresh_from_db()
+
+        self.assertEqual(duplicate_job.status, 'FAILED')
+        self.assertEqual(duplicate_job.stage, 'sheet')
+        self.assertTrue(
+            ExecutionStats.objects.filter(project_id='Transfer_Test', exec_status='FAIL').exists())
+
+    def test_status_endpoint(self):
+
+        response = Client().get(reverse('import_status', args=[self.import_job.pk]))
+        self.assertEqual(response.json()['status'], 'QUEUED')
+
+        run_import_job(self.import_job.pk)
+        progress = Client().get(reverse('import_status', args=[self.import_job.pk])).json()
+
+        self.assertEqual(progress['status'], 'DONE')
+        self.assertEqual(progress['stage'], 'compare')
+        self.assertEqual(set(progress['stage_timings']), {'sheet', 'fastq', 'compare'})
+
+    def test_comparison_endpoint(self):
+
+        comparison_output = run_import_job(self.import_job.pk)
+        comparison_url = Client().get(reverse('import_status', args=[self.import_job.pk])).json()['comparison']
+
+        result = Client().get(comparison_url).json()
+
+        # The import's comparison is served from the cache
+        self.assertTrue(result['cached'])
+        self.assertEqual(result['match_num'], 1)
+        self.assertTrue(comparison_output.startswith(result['comparison_output']))
+
+        self.assertEqual(Client().get(reverse('comparison_result', args=['Missing'])).status_code, 404)
+
+@mock.patch('Transfer.utils.progress_paused_until', 0)
+@mock.patch('Transfer.utils.django_rq.get_connection')
+class ProgressEventsTest(TestCase):
+
+    def setUp(self):
+
+        self.import_job = ImportJob.objects.create(
+            sheet_path = os.path.join(sample_project_path, 'Sample_Sheet', 'Sample_Submission_Sheet_Indiv.xlsx'),
+            fastq_directory = os.path.join(sample_project_path, 'FastQ_Files'),
+            enqueued_at = timezone.now()
+        )
+
+    def published(self, get_connection):
+        return [
+            json.loads(data) for channel, data in
+            (publish.args for publish in get_connection.return_value.publish.call_args_list)
+            ]
+
+    def test_import_job_events(self, get_connection):
+
+        run_import_job(self.import_job.pk)
+        events = self.published(get_connection)
+
+        self.assertEqual(
+            [event['event'] for event in events],
+            ['job_started', 'stage', 'stage', 'stage', 'job_finished']
+            )
+        self.assertEqual([event['stage'] for event in events[1:4]], ['sheet', 'fastq', 'compare'])
+        self.assertEqual(events[3]['fastq_files'], len(os.listdir(self.import_job.fastq_directory)))
+        self.assertEqual(events[-1]['status'], 'DONE')
+
+    def test_relay(self, get_connection):
+
+        messages = [None, {'data': b'{"event": "stage"}'}, {'data': b'{"event": "job_finished"}'}]
+        get_connection.return_value.pubsub.return_value.get_message.side_effect = messages
+
+        stream = list(progress_events('channel', lambda: {'status': 'RUNNING'}))
+
+        self.assertEqual(json.loads(stream[0][len('data: '):]), {'event': 'snapshot', 'status': 'RUNNING'})
+        self.assertEqual(stream[1], ": keepalive\n\n")
+        self.assertEqual(stream[2:], ['data: {"event": "stage"}\n\n', 'data: {"event": "job_finished"}\n\n'])
+        get_connection.return_value.pubsub.return_value.subscribe.assert_called_once_with('channel')
+
+    def test_finished_job_stream(self, get_connection):
+
+        run_import_job(self.import_job.pk)
+        response = Client().get(reverse('import_events', args=[self.import_job.pk]))
+        stream = list(response.streaming_content)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(len(stream), 1)
+        self.assertEqual(json.loads(stream[0][len('data: '):])['status'], 'DONE')
+        get_connection.return_value.pubsub.return_value.get_message.assert_not_called()
+
+class IndexMatcherTest(TestCase):
+
+    def setUp(self):
+
+        self.matcher = IndexMatcher(max_mismatches=1)
+        self.matcher.add('NCTCGCTA', 'core1')
+        self.matcher.add('GGGGGGGG', 'core2')
+
+    def test_exact_and_wildcard_match(self):
+
+        self.assertEqual(self.matcher.lookup('ACTCGCTA'), {'core1'})
+        self.assertEqual(self.matcher.lookup('GGGGGGGG'), {'core2'})
+
+    def test_single_mismatch_match(self):
+
+        self.assertEqual(self.matcher.lookup('TCTCGCTT'), {'core1'})
+        self.assertEqual(self.matcher.lookup('GGGAGGGG'), {'core2'})
+
+    def test_two_mismatches_no_match(self):
+
+        self.assertEqual(self.matcher.lookup('GGGAAGGG'), set())
+        self.assertEqual(self.matcher.lookup('GGGGGGG'), set())
+
+class FastQCatalogTest(TestCase):
+
+    source_directory = os.path.join(sample_project_path, 'FastQ_Files')
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.fastq_directory = os.path.join(self.root, 'Catalog_Test', 'FastQ_Files')
+        os.makedirs(self.fastq_directory)
+        for fastq_file in os.listdir(self.source_directory):
+            shutil.copy(os.path.join(self.source_directory, fastq_file), self.fastq_directory)
+        # Directories written well before their first listing
+        for path in [self.root, os.path.dirname(self.fastq_directory), self.fastq_directory]:
+            os.utime(path, (time.time() - 60, time.time() - 60))
+
+        self.catalog = FastQCatalog(self.root)
+        self.first_refresh = self.catalog.refresh()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.root)
+
+    def test_files_catalogued(self):
+
+        self.assertEqual(self.first_refresh['added'], 3)
+        self.assertEqual(self.catalog.files_in(self.root).count(), 3)
+
+        fastq_file = FastQFile.objects.get(filename='SAM1_S217_L005_R2_001.fastq.gz')
+        self.assertEqual(fastq_file.project_id, 'Catalog_Test')
+        self.assertEqual(fastq_file.sample_id, 'SAM1')
+        self.assertEqual(fastq_file.lane, 'L005')
+        self.assertEqual(fastq_file.read, 'R2')
+        self.assertEqual(fastq_file.size, os.path.getsize(fastq_file.path))
+
+    def test_unchanged_directories_not_listed(self):
+
+        self.assertEqual(self.catalog.refresh()['listed'], 0)
+
+    def test_new_and_removed_files(self):
+
+        os.remove(os.path.join(self.fastq_directory, 'SAM1_S217_L005_R2_001.fastq.gz'))
+        shutil.copy(
+            os.path.join(sample_project_path, 'Single_FastQ', '17127FL-27-01-dd06-A2_S105_L004_R1_001.fastq.gz'),
+            self.fastq_directory
+            )
+        refresh = self.catalog.refresh()
+
+        self.assertEqual(refresh['listed'], 1)
+        self.assertEqual(refresh['added'], 1)
+        self.assertEqual(refresh['removed'], 1)
+        self.assertEqual(self.catalog.files_in(self.fastq_directory).count(), 3)
+
+    def test_change_in_listing_tick(self):
+
+        # Same mtime as the last listing, but too recent to trust
+        mtime = time.time()
+        os.utime(self.fastq_directory, (mtime, mtime))
+        self.catalog.refresh()
+        shutil.copy(
+            os.path.join(sample_project_path, 'Single_FastQ', '17127FL-27-01-dd06-A2_S105_L004_R1_001.fastq.gz'),
+            self.fastq_directory
+            )
+        os.utime(self.fastq_directory, (mtime, mtime))
+
+        self.assertEqual(self.catalog.refresh()['added'], 1)
+        self.assertEqual(self.catalog.files_in(self.fastq_directory).count(), 4)
+
+    def test_removed_project_non_recursive(self):
+
+        shutil.rmtree(os.path.join(self.root, 'Catalog_Test'))
+        self.catalog.refresh(recursive=False)
+
+        self.assertFalse(CatalogDirectory.objects.filter(parent__path=self.root).exists())
+        self.assertEqual(self.catalog.files_in(self.root).count(), 0)
+
+    def test_removed_directory(self):
+
+        shutil.rmtree(os.path.join(self.root, 'Catalog_Test'))
+        self.catalog.refresh()
+
+        self.assertEqual(self.catalog.files_in(self.root).count(), 0)
+
+    def test_changed_file_needs_ingest(self):
+
+        FastQFile.objects.update(ingested_at=timezone.now())
+        fastq_path = os.path.join(self.fastq_directory, 'SAM1_S217_L005_R2_001.fastq.gz')
+        with open(fastq_path, 'ab') as fastq:
+            fastq.write(b'\n')
+
+        self.catalog.refresh(self.fastq_directory, full=True)
+
+        self.assertEqual(FastQFile.objects.filter(ingested_at__isnull=True).count(), 1)
+
+    def test_scan(self):
+
+        self.assertEqual(self.catalog.scan(), 3)
+
+        fastq_file = FastQFile.objects.get(filename='SAM1_S217_L005_R2_001.fastq.gz')
+        with open(fastq_file.path, 'rb') as fastq:
+            self.assertEqual(fastq_file.scan.md5, hashlib.md5(fastq.read()).hexdigest())
+        with gzip.open(fastq_file.path, 'rb') as fastq:
+            lines = fastq.read().splitlines()
+        self.assertEqual(fastq_file.scan.read_count, len(lines) // 4)
+        self.assertEqual(sum(json.loads(fastq_file.scan.length_histogram).values()), len(lines) // 4)
+        self.assertEqual(
+            len(json.loads(fastq_file.scan.cycle_mean_quality)),
+            max(len(line) for line in lines[3::4])
+            )
+
+        # Only files changed since their last scan are read again
+        self.assertEqual(self.catalog.scan(), 0)
+        with open(fastq_file.path, 'ab') as fastq:
+            fastq.write(gzip.compress(lines[0] + b'\nACGT\n+\nFFFF\n'))
+        self.catalog.refresh(full=True)
+        self.assertEqual(self.catalog.scan(), 1)
+        self.assertEqual(FastQScan.objects.get(fastq_file=fastq_file).read_count, len(lines) // 4 + 1)
+
+    def test_scan_blocks(self):
+
+        fastq_path = os.path.join(self.fastq_directory, 'SAM1_S217_L005_R2_001.fastq.gz')
+        whole = FastQScanner(fastq_path).scan()
+
+        # Records split across small blocks, and per-cycle sums without numpy
+        with mock.patch('Transfer.utils.fastq_scan_buffer_size', 64), mock.patch('Transfer.utils.numpy', None):
+            blocks = FastQScanner(fastq_path).scan()
+
+        for field in ['md5', 'sha256', 'read_count', 'length_histogram', 'cycle_mean_quality', 'index_summary']:
+            self.assertEqual(whole[field], blocks[field])
+
+
+class WatchDeliveriesTest(TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.fastq_directory = os.path.join(self.root, 'Watch_Test', 'FastQ_Files')
+        os.makedirs(self.fastq_directory)
+
+        self.command = Command(stdout=io.StringIO())
+        self.command.catalog = FastQCatalog(self.root)
+        self.command.queue = mock.Mock()
+        self.command.last_sizes = {}
+
+        patcher = mock.patch('Transfer.management.commands.watch_deliveries.QC')
+        self.qc = patcher.start()
+        self.qc.return_value.enqueue_jobs.return_value = ([], mock.Mock(id='multiqc'))
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.root)
+
+    def deliver(self, filename, age=600):
+        path = os.path.join(self.fastq_directory, filename)
+        with gzip.open(path, 'wb') as fastq:
+            fastq.write(b'@E00558:209:HMKJCCCXY:1:1101:1:1 1:N:0:ACGTACGT\nACGT\n+\nFFFF\n')
+        os.utime(path, (time.time() - age, time.time() - age))
+        # New entries show in the directory mtime on any timestamp granularity
+        os.utime(self.fastq_directory, (time.time() - age, time.time() - age))
+
+    def queued_functions(self):
+        return [call.args[0].__name__ for call in self.command.queue.enqueue.call_args_list]
+
+    def test_poll_ingests_settled_delivery(self):
+
+        self.deliver('SAM1_S1_L001_R1_001.fastq.gz')
+        with mock.patch('Transfer.management.commands.watch_deliveries.status_logger'):
+            self.command.poll(300)
+
+        self.assertEqual(self.queued_functions(), ['scan_fastq_files', 'import_fastq_headers'])
+        scan_call, import_call = self.command.queue.enqueue.call_args_list
+        self.assertEqual(import_call.args[1:], ('Watch_Test', self.fastq_directory))
+        self.assertEqual(import_call.kwargs, {'depends_on': self.command.queue.enqueue.return_value})
+        self.qc.return_value.enqueue_jobs.assert_called_once_with(self.command.queue)
+        self.assertFalse(FastQFile.objects.filter(ingested_at__isnull=True).exists())
+
+        # Nothing new on the next poll
+        self.command.poll(300)
+        self.assertEqual(len(self.queued_functions()), 2)
+
+    def test_poll_waits_for_writes(self):
+
+        self.deliver('SAM1_S1_L001_R1_001.fastq.gz', age=0)
+        self.command.poll(300)
+
+        self.command.queue.enqueue.assert_not_called()
+        self.assertTrue(FastQFile.objects.filter(ingested_at__isnull=True).exists())
+
+    def test_baseline(self):
+
+        self.deliver('SAM1_S1_L001_R1_001.fastq.gz')
+        self.command.baseline()
+        self.command.poll(300)
+        self.command.queue.enqueue.assert_not_called()
+
+        # Only runs before anything has been ingested
+        self.deliver('SAM2_S2_L001_R1_001.fastq.gz')
+        self.command.baseline()
+        with mock.patch('Transfer.management.commands.watch_deliveries.status_logger'):
+            self.command.poll(300)
+
+        self.assertEqual(self.queued_functions(), ['scan_fastq_files', 'import_fastq_headers'])
+
+    def test_settled(self):
+
+        command = self.command
+        fastq_file = FastQFile(path='/tmp/A_S1_L001_R1_001.fastq.gz', size=10, mtime=time.time() - 600)
+
+        # First sighting of an old file relies on its mtime alone
+        self.assertTrue(command.settled([fastq_file], 300))
+
+        fastq_file.size = 20
+        self.assertFalse(command.settled([fastq_file], 300))
+        self.assertTrue(command.settled([fastq_file], 300))
+
+        fastq_file.mtime = time.time()
+        self.assertFalse(command.settled([fastq_file], 300))
@@ -7,6 +7,141 @@ general_sheet_length = 40
 max_sheet_width = 14
 max_sheet_length = 152
 
+# Open submission sheets read-only and read each worksheet in a single
+# streaming pass instead of looking cells up one at a time.
+sheet_read_only = True
+
+# Number of leading records read from each FastQ to find its sequence
+# identifiers. Reading stops as soon as this many headers are collected.
+fastq_header_sample_size = 2
+
+# With fastq_read_sampling, fastq_read_sample_size reads are sampled from
+# evenly spaced points across each FastQ during import, through a gzip
+# seek index, to check its index and flowcell are consistent throughout
+# the file. Building the index decompresses the whole file once, so this
+# is off by default and only the leading fastq_header_sample_size records
+# are read. A file whose saved index already exists is always sampled.
+# Without indexed_gzip the index cannot be saved and every process would
+# inflate every file again, so sampling is then skipped with a warning
+# unless fastq_read_sampling_in_memory is also set.
+fastq_read_sampling = False
+fastq_read_sampling_in_memory = False
+fastq_read_sample_size = 64
+
+# Fraction of sampled reads that must carry the file's consensus index, up
+# to index_max_mismatches substitutions, for the FastQ to count as
+# demultiplexed.
+fastq_index_consensus = 0.9
+
+# Decompressed bytes read at each sample point to find a complete record.
+fastq_resync_bytes = 16384
+
+# Gzip seek indexes hold about one access point per sampled read. With
+# indexed_gzip installed the index is saved in gzip_index_cache (None: a
+# directory under the system temp directory) and access points are at
+# least gzip_index_min_spacing uncompressed bytes apart. Otherwise the
+# index is kept in memory. gzip_index_cache_size indexes are kept open
+# per process. Saved indexes least recently used are deleted once the
+# cache holds more than gzip_index_cache_bytes.
+gzip_index_min_spacing = 64 * 1024
+gzip_index_cache = None
+gzip_index_cache_size = 32
+gzip_index_cache_bytes = 2 * 1024 ** 3
+
+# Stream every header of each FastQ during import to measure the fraction
+# of reads carrying the file's index, the N rate of index bases and the
+# most common unexpected barcodes. Reads the whole file.
+fastq_barcode_analysis = False
+
+# Distinct barcodes counted per file by the barcode analysis sketch, and
+# how many of the most common unexpected ones are stored.
+barcode_sketch_capacity = 256
+unexpected_barcodes_reported = 10
+
+# DataComparison flags FastQs whose expected index fraction is below this
+# as possibly index hopped or contaminated.
+hopping_flag_threshold = 0.95
+
+# Undetermined reads miner: a count-min sketch of width x depth counters
+# estimates how often each barcode was seen, and the most common
+# undetermined_top_barcodes are matched against customer indexes with no
+# match in the core data. Headers are tallied in batches of
+# undetermined_batch_reads before their distinct barcodes enter the sketch.
+undetermined_sketch_width = 2 ** 16
+undetermined_sketch_depth = 4
+undetermined_top_barcodes = 100
+undetermined_batch_reads = 1000000
+
+# Decompression of whole FastQs, see Transfer.utils.open_fastq. 'auto'
+# picks, in order: 'bgzf' block parallel inflating on
+# fastq_decompression_threads threads for BGZF files, 'library' when isal
+# or zlib-ng is installed, a 'pigz' or 'igzip' pipe when either is on the
+# PATH and finally 'zlib' through the gzip module.
+fastq_decompression = 'auto'
+fastq_decompression_threads = 4
+
+# Fused FastQ scans: compressed bytes read per call. The index summary
+# keeps every barcode of the scan's barcode_sketch_capacity sketch, so
+# that imports can take their indexes and barcode analysis from it.
+fastq_scan_buffer_size = 4 * 1024 * 1024
+
+# Worker processes used to read FastQ headers during import.
+# 1 parses files one after another in the calling process.
+fastq_import_processes = 1
+
+# Delivery watcher: seconds between polls of project storage, and how long
+# every file in a FastQ_Files directory must be unchanged before the
+# delivery is considered complete and queued.
+watch_interval = 60
+watch_settle_seconds = 300
+
+# The FastQ catalog lists a directory again whenever its mtime is within
+# catalog_mtime_slack seconds of its last listing. Entries added in the
+# same timestamp tick as a listing, common on coarse clock and NFS
+# storage, do not move the mtime.
+catalog_mtime_slack = 2
+
+# Job progress is published to redis channels starting with
+# progress_channel_prefix, on the connection of the 'default' RQ queue.
+# Event streams send a keepalive comment after progress_keepalive seconds
+# without an event so that proxies keep the connection open. After redis
+# fails, events are dropped for progress_retry_seconds rather than waiting
+# on the connection again for every one.
+progress_channel_prefix = 'jambio:progress:'
+progress_keepalive = 15
+progress_retry_seconds = 60
+
+# Rows per INSERT when saving parsed sheet and FastQ objects
+bulk_create_batch_size = 500
+
+# Substitutions allowed between a customer and core index sequence.
+# N bases are wildcards and never count as a substitution, but sequences
+# with more N's than index_max_wildcards compare them as literal bases.
+index_max_mismatches = 1
+index_max_wildcards = 3
+
+# Backend used by DataComparison: 'hash' for IndexMatcher lookups or
+# 'numpy' for a vectorized distance matrix (requires numpy).
+comparison_backend = 'hash'
+
+# Also match customer i5 sequences reverse complemented, as given by
+# sheets written for the other i5 chemistry. The orientation matching
+# most core indexes is used for the whole project.
+detect_i5_orientation = True
+
+# Libraries of different projects sharing a flowcell lane collide when
+# both their i7 and their i5 are within collision_max_distance
+# substitutions, see Transfer.utils.LaneCollisionAnalysis.
+collision_max_distance = 2
+
+# DataComparison results are saved as ComparisonResult rows and reused
+# while the project's compared rows and these settings are unchanged.
+# Results unused for comparison_cache_ttl seconds are dropped, as are the
+# least recently used ones beyond comparison_cache_size.
+comparison_cache = True
+comparison_cache_ttl = 7 * 24 * 60 * 60
+comparison_cache_size = 1000
+
 # Variables for storing column names in submission sheet
 STR_SAMPLE_TYPE     = 'Sample Type:'
 STR_PROJECT_ID      = 'Project ID:'
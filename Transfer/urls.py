@@ -2,5 +2,8 @@ from django.urls import path
 from Transfer import views
 
 urlpatterns = [
-    path('', views.import_and_compare_handler, name='import_and_compare_handler')
+    path('', views.import_and_compare_handler, name='import_and_compare_handler'),
+    path('imports/<int:import_job_id>', views.import_status, name='import_status'),
+    path('imports/<int:import_job_id>/events', views.import_events, name='import_events'),
+    path('projects/<str:project_id>/comparison', views.comparison_result, name='comparison_result')
 ]
@@ -1,13 +1,54 @@
+import io
 import os
 import gzip
+import array
+import shutil
+import threading
+import subprocess
+import time
+import zlib
+import bisect
+import hashlib
+import tempfile
+import json
+import heapq
+import functools
+import collections
 import datetime
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django_rq
+import redis
 
 from django.db import IntegrityError, transaction
-from fuzzywuzzy import fuzz
+from django.db.models import Count, Q
+from django.utils import timezone
 from openpyxl import load_workbook
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+try:
+    from isal import igzip as fast_gzip, isal_zlib as fast_zlib
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as fast_gzip, zlib_ng as fast_zlib
+    except ImportError:
+        fast_gzip = fast_zlib = None
+
 from .transfer_settings import *
-from .models import ComponentInformation, TubeInformation, CoreData, ExecutionStats
+from .models import (
+    Project, ComponentInformation, TubeInformation, CoreData, ExecutionStats,
+    CatalogDirectory, FastQFile, FastQScan, ComparisonResult
+    )
 from .constants import PROJECT_STORAGE
 
 class SubmissionExcelParser(object):
@@ -21,11 +62,37 @@ class SubmissionExcelParser(object):
     """
 
 
-    def __init__(self, sub_sheet_path):
-        """Finds Project ID and submission type. """
+    def __init__(self, sub_sheet_path, read_only=sheet_read_only):
+        """Finds Project ID and submission type.
+
+        In read-only mode both worksheets are streamed once with iter_rows
+        and the workbook is closed before returning, even when the sheet
+        cannot be read, all later lookups use the values kept in memory.
+        """
 
         self.sub_sheet_path = sub_sheet_path
-        self.wb = load_workbook(filename=sub_sheet_path)
+        self.read_only = read_only
+        self.wb = load_workbook(filename=sub_sheet_path, read_only=read_only)
+
+        if self.read_only:
+            try:
+                self.general_info_ws = self.wb['General Information']
+                general_rows = self.read_rows(self.general_info_ws, general_sheet_length, general_sheet_width)
+
+                for row, row_values in enumerate(general_rows):
+                    for column, gen_val in enumerate(row_values):
+
+                        if gen_val == STR_SAMPLE_TYPE:
+                            self.submission_type = self.row_value(general_rows, row + 1, column)
+                        if gen_val == STR_PROJECT_ID:
+                            self.project_id_from_sheet = self.row_value(general_rows, row + 1, column)
+
+                self.detail_rows = self.read_rows(self.wb[self.submission_type], max_sheet_length, max_sheet_width)
+            finally:
+                # Read-only workbooks keep the file open until closed
+                self.wb.close()
+            return
+
         self.general_info_ws = self.wb['General Information']
 
         for row in range(1, general_sheet_length):
@@ -47,13 +114,48 @@ class SubmissionExcelParser(object):
                         column=column
                         ).value
 
+    @staticmethod
+    def read_rows(worksheet, sheet_length, sheet_width):
+        """Reads the searched area of a worksheet in one pass."""
+        return list(worksheet.iter_rows(
+            min_row=1,
+            max_row=sheet_length - 1,
+            max_col=sheet_width - 1,
+            values_only=True
+            ))
+
+    @staticmethod
+    def row_value(rows, row, column):
+        """Zero based lookup that treats cells outside the area as empty."""
+        if row < len(rows) and column < len(rows[row]):
+            return rows[row][column]
+        return None
 
     def find_columns(self):
-        """Loads correct worksheet and pulls x, y column coordinates. """
+        """Loads correct worksheet and pulls x, y column coordinates.
+
+        In read-only mode the coordinates come from one scan of the cached
+        rows and every header's column is kept as an array of values.
+        """
 
-        self.submission_detail_ws = self.wb[self.submission_type]
         self.header_coordinates = {}
 
+        if self.read_only:
+            for row, row_values in enumerate(self.detail_rows, start=1):
+                for column, value in enumerate(row_values, start=1):
+                    if value in column_headers:
+                        self.header_coordinates[value] = (column, row)
+
+            self.header_columns = {}
+            for header, (column, row) in self.header_coordinates.items():
+                self.header_columns[header] = [
+                    self.row_value(self.detail_rows, row_index, column - 1)
+                    for row_index in range(len(self.detail_rows))
+                    ]
+            return
+
+        self.submission_detail_ws = self.wb[self.submission_type]
+
         for row in range(1, max_sheet_length):
             for column in range(1, max_sheet_width):
 
@@ -65,6 +167,10 @@ class SubmissionExcelParser(object):
                             self.header_coordinates[header] = (column, row)
 
     def value_in_column(self, row, column_header):
+        if self.read_only:
+            column_values = self.header_columns[column_header]
+            return column_values[row - 1] if row <= len(column_values) else None
+
         return self.submission_detail_ws.cell(
         column=self.header_coordinates[column_header][0],
         row=row
@@ -81,6 +187,9 @@ class SubmissionExcelParser(object):
         empty cells in the sample column.
         """
 
+        tube_objects = []
+        component_objects = []
+
         data_start_row = self.header_coordinates[INDIV_ANCHOR][1] + 2
         for row in range(data_start_row, max_sheet_length):
 
@@ -93,7 +202,7 @@ class SubmissionExcelParser(object):
             tube_field_dict['volume']        = self.value_in_column(row, STR_VOLUME)
             tube_field_dict['concentration'] = self.value_in_column(row, STR_CONCENTRATION)
 
-            data = TubeInformation.objects.create(**tube_field_dict)
+            tube_objects.append(TubeInformation(**tube_field_dict))
 
             component_field_dict = {}
 
@@ -104,7 +213,12 @@ class SubmissionExcelParser(object):
             component_field_dict['i5_index_name']     = self.value_in_column(row, STR_I5_INDEX_NAME)
             component_field_dict['i5_index_sequence'] = self.value_in_column(row, STR_I5_INDEX_SEQ)
 
-            data = ComponentInformation.objects.create(**component_field_dict)
+            component_objects.append(ComponentInformation(**component_field_dict))
+
+        Project.objects.get_or_create(project_id=self.project_id_from_sheet)
+        TubeInformation.objects.bulk_create(tube_objects, batch_size=bulk_create_batch_size)
+        ComponentInformation.objects.bulk_create(component_objects, batch_size=bulk_create_batch_size)
+        invalidate_comparisons(self.project_id_from_sheet)
 
     @transaction.atomic
     def parse_pool_submission(self):
@@ -117,6 +231,9 @@ class SubmissionExcelParser(object):
          empty cells in the sample column.
         """
 
+        tube_objects = []
+        component_objects = []
+
         data_start_row = self.header_coordinates[POOL_ANCHOR][1] + 2
         for row in range(data_start_row, max_sheet_length):
 
@@ -134,7 +251,7 @@ class SubmissionExcelParser(object):
             tube_field_dict['buffer']              = self.value_in_column(row, STR_BUFFER)
             tube_field_dict['organism']            = self.value_in_column(row, STR_ORGANISM)
 
-            data = TubeInformation.objects.create(**tube_field_dict)
+            tube_objects.append(TubeInformation(**tube_field_dict))
 
         data_start_row = self.header_coordinates[INDEX_ANCHOR][1] + 2
         for row in range(data_start_row, max_sheet_length):
@@ -150,17 +267,805 @@ class SubmissionExcelParser(object):
             component_field_dict['i5_index_name']     = self.value_in_column(row, STR_I5_INDEX_NAME)
             component_field_dict['i5_index_sequence'] = self.value_in_column(row, STR_I5_INDEX_SEQ)
 
-            data = ComponentInformation.objects.create(**component_field_dict)
+            component_objects.append(ComponentInformation(**component_field_dict))
+
+        Project.objects.get_or_create(project_id=self.project_id_from_sheet)
+        TubeInformation.objects.bulk_create(tube_objects, batch_size=bulk_create_batch_size)
+        ComponentInformation.objects.bulk_create(component_objects, batch_size=bulk_create_batch_size)
+        invalidate_comparisons(self.project_id_from_sheet)
+
+class CompressedTap(io.RawIOBase):
+    """Reads a file, handing every block read to 'callback' as well."""
+
+    def __init__(self, path, callback=None):
+        self.file_obj = open(path, 'rb')
+        self.callback = callback
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.file_obj.readinto(buffer)
+        if count and self.callback is not None:
+            self.callback(bytes(memoryview(buffer)[:count]))
+        return count
+
+    def close(self):
+        self.file_obj.close()
+        super().close()
+
+class GzipModuleReader(io.RawIOBase):
+    """Decompresses with a gzip compatible module: gzip, isal or zlib-ng."""
+
+    def __init__(self, path, gzip_module, on_compressed=None):
+        self.source = CompressedTap(path, on_compressed)
+        self.gzip_file = gzip_module.open(self.source, 'rb')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.gzip_file.readinto(buffer)
+
+    def close(self):
+        self.gzip_file.close()
+        self.source.close()
+        super().close()
+
+class PipedGzipReader(io.RawIOBase):
+    """Decompresses in a separate process, such as 'pigz -dc'.
+
+    The command reads the file itself unless the compressed bytes are
+    wanted through 'on_compressed', then a thread feeds it the file.
+    Closing before the end of the output stops the process.
+    """
+
+    def __init__(self, path, command, on_compressed=None):
+        self.path = path
+        self.command = command
+        self.feeder = None
+
+        if on_compressed is None:
+            self.process = subprocess.Popen(
+                command + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            self.process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.feeder = threading.Thread(target=self.feed, args=(on_compressed,), daemon=True)
+            self.feeder.start()
+
+    def feed(self, on_compressed):
+        try:
+            with open(self.path, 'rb') as gzip_file_obj:
+                for block in iter(lambda: gzip_file_obj.read(fastq_scan_buffer_size), b''):
+                    on_compressed(block)
+                    self.process.stdin.write(block)
+        except (BrokenPipeError, ValueError):
+            # The reader was closed early
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.process.stdout.readinto(buffer)
+        if count == 0 and self.process.wait() != 0:
+            raise Exception(
+                f'{self.command[0]} failed on {self.path}: '
+                f'{self.process.stderr.read().decode(errors="replace")}')
+        return count
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        if self.feeder is not None:
+            self.feeder.join()
+        super().close()
+
+def is_bgzf(path):
+    """True if the file starts with a BGZF block, a gzip member whose extra
+    field holds its compressed size."""
+
+    with open(path, 'rb') as gzip_file_obj:
+        header = gzip_file_obj.read(16)
+
+    return header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+class BGZFReader(io.RawIOBase):
+    """Decompresses BGZF blocks on a thread pool.
+
+    Every block of a BGZF file is a gzip member of at most 64KB whose size
+    is in its header, so blocks can be split off without inflating them and
+    inflated independently. zlib releases the GIL while inflating, and up to
+    four blocks per thread are in flight at once, returned in file order.
+    """
+
+    def __init__(self, path, threads=fastq_decompression_threads, on_compressed=None):
+        self.path = path
+        self.file_obj = open(path, 'rb')
+        self.on_compressed = on_compressed
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.window = 4 * threads
+        self.pending = collections.deque()
+        self.blocks = self.read_blocks()
+        self.output = memoryview(b'')
+
+    def read_blocks(self):
+        while True:
+            header = self.file_obj.read(12)
+            if not header:
+                return
+            if header[:4] != b'\x1f\x8b\x08\x04':
+                raise Exception(f'{self.path} is not BGZF at byte {self.file_obj.tell() - len(header)}')
+
+            extra_length = int.from_bytes(header[10:12], 'little')
+            extra = self.file_obj.read(extra_length)
+
+            block_size = None
+            position = 0
+            while position + 4 <= len(extra):
+                subfield_length = int.from_bytes(extra[position + 2:position + 4], 'little')
+                if extra[position:position + 2] == b'BC':
+                    block_size = int.from_bytes(extra[position + 4:position + 6], 'little') + 1
+                position += 4 + subfield_length
+            if block_size is None:
+                raise Exception(f'{self.path} has a gzip member without a BGZF block size')
+
+            block = header + extra + self.file_obj.read(block_size - 12 - extra_length)
+            if self.on_compressed is not None:
+                self.on_compressed(block)
+            yield block[12 + extra_length:]
+
+    @staticmethod
+    def inflate_block(block):
+        """Inflates the deflate data of a block, then checks its trailer."""
+
+        output = (fast_zlib or zlib).decompress(block[:-8], -zlib.MAX_WBITS)
+        if len(output) != int.from_bytes(block[-4:], 'little') or \
+           zlib.crc32(output) != int.from_bytes(block[-8:-4], 'little'):
+            raise Exception('BGZF block failed its size or CRC check')
+        return output
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.output:
+            for block in itertools.islice(self.blocks, self.window - len(self.pending)):
+                self.pending.append(self.executor.submit(self.inflate_block, block))
+            if not self.pending:
+                return 0
+            self.output = memoryview(self.pending.popleft().result())
+
+        count = min(len(buffer), len(self.output))
+        buffer[:count] = self.output[:count]
+        self.output = self.output[count:]
+        return count
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.file_obj.close()
+        super().close()
+
+# Commands for the pipe backends, the path is appended
+decompression_pipes = {
+    'pigz': ['pigz', '-dc'],
+    'igzip': ['igzip', '-dc'],
+}
+
+def decompression_backend(path, threads=fastq_decompression_threads):
+    """Fastest backend available for 'path', see fastq_decompression."""
+
+    if threads > 1 and is_bgzf(path):
+        return 'bgzf'
+    if fast_gzip is not None:
+        return 'library'
+    for backend, command in decompression_pipes.items():
+        if shutil.which(command[0]):
+            return backend
+    return 'zlib'
+
+def open_fastq(path, backend=fastq_decompression, threads=fastq_decompression_threads, on_compressed=None):
+    """Opens a gzipped FastQ for reading decompressed bytes.
+
+    Returns a buffered binary file whatever the backend, see
+    fastq_decompression. 'on_compressed' is called with the compressed
+    bytes of the file, in order, as they are read.
+    """
+
+    if backend == 'auto':
+        backend = decompression_backend(path, threads)
+
+    if backend == 'bgzf':
+        raw = BGZFReader(path, threads, on_compressed)
+    elif backend in decompression_pipes:
+        raw = PipedGzipReader(path, decompression_pipes[backend], on_compressed)
+    elif backend == 'library':
+        if fast_gzip is None:
+            raise Exception('Neither isal nor zlib-ng is installed')
+        raw = GzipModuleReader(path, fast_gzip, on_compressed)
+    elif backend == 'zlib':
+        raw = GzipModuleReader(path, gzip, on_compressed)
+    else:
+        raise Exception(f'Unknown decompression backend: {backend}')
+
+    return io.BufferedReader(raw, buffer_size=fastq_scan_buffer_size)
+
+class FastQHeaderSampler(object):
+    """Reads the leading sequence identifiers of a gzipped FastQ file.
+
+    Only the first line of every four-line record is kept and reading stops
+    as soon as 'num_records' headers have been collected, so the cost of a
+    file does not depend on its size. The file is read in binary mode and
+    headers are returned as bytes.
+
+    'bytes_read' holds the number of compressed bytes pulled from disk.
+    """
+
+    def __init__(self, fastq_path, num_records=fastq_header_sample_size):
+        self.fastq_path = fastq_path
+        self.num_records = num_records
+        self.bytes_read = 0
+
+    def sample(self):
+        headers = []
+
+        with open(self.fastq_path, 'rb') as raw_file_obj:
+            with gzip.GzipFile(fileobj=raw_file_obj, mode='rb') as fastq_file_obj:
+                for line_num, line in enumerate(fastq_file_obj):
+                    if line_num % 4 == 0:
+                        headers.append(line.rstrip(b'\r\n '))
+                        if len(headers) >= self.num_records:
+                            break
+
+            self.bytes_read = raw_file_obj.tell()
+
+        return headers
+
+class GzipSeekIndex(object):
+    """Access points into a gzip file, zran style.
+
+    An access point pairs an uncompressed offset with the compressed offset
+    and a copy of the decompressor state there, so reading can resume at
+    the point without inflating anything before it. 'num_points' points are
+    placed evenly across the compressed file during one pass over it.
+    Concatenated gzip members are followed. 'bytes_read' counts the
+    compressed bytes read from disk.
+
+    The zlib module cannot resume inflating at an arbitrary bit, so the
+    decompressor states are kept in memory rather than written out - see
+    SavedGzipSeekIndex for an index that is saved between processes.
+    """
+
+    def __init__(self, path, num_points=fastq_read_sample_size):
+        self.path = path
+        self.num_points = max(num_points, 1)
+        self.points = []
+        self.uncompressed_offsets = []
+        self.bytes_read = 0
+        self.reused = False
+
+    @staticmethod
+    def inflate(decompressor, data):
+        """Decompresses 'data', starting a new decompressor for every
+        gzip member that follows the current one."""
+
+        output = [decompressor.decompress(data)]
+        while decompressor.eof and decompressor.unused_data.strip(b'\x00'):
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            output.append(decompressor.decompress(data))
+
+        return decompressor, b''.join(output)
+
+    def build(self):
+        compressed_size = os.path.getsize(self.path)
+        step = max(-(-compressed_size // self.num_points), 1)
+        read_size = min(step, fastq_resync_bytes)
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        compressed_offset = uncompressed_offset = 0
+        next_point = 0
+
+        with open(self.path, 'rb') as gzip_file_obj:
+            while True:
+                if compressed_offset >= next_point:
+                    self.points.append((uncompressed_offset, compressed_offset, decompressor.copy()))
+                    self.uncompressed_offsets.append(uncompressed_offset)
+                    next_point += step
+
+                data = gzip_file_obj.read(read_size)
+                if not data:
+                    break
+                compressed_offset += len(data)
+                self.bytes_read += len(data)
+                decompressor, output = self.inflate(decompressor, data)
+                uncompressed_offset += len(output)
+
+        self.size = uncompressed_offset
+        return self
+
+    def access_points(self):
+        """Uncompressed offsets that can be read from without inflating
+        anything before them."""
+
+        return list(self.uncompressed_offsets)
+
+    def read_at(self, offset, length):
+        position = bisect.bisect_right(self.uncompressed_offsets, offset) - 1
+        uncompressed_offset, compressed_offset, state = self.points[position]
+
+        decompressor = state.copy()
+        skip = offset - uncompressed_offset
+        output = bytearray()
+
+        with open(self.path, 'rb') as gzip_file_obj:
+            gzip_file_obj.seek(compressed_offset)
+            while len(output) < skip + length:
+                data = gzip_file_obj.read(fastq_resync_bytes)
+                if not data:
+                    break
+                self.bytes_read += len(data)
+                decompressor, chunk = self.inflate(decompressor, data)
+                output += chunk
+
+        return bytes(output[skip:skip + length])
+
+    def close(self):
+        pass
+
+class SavedGzipSeekIndex(GzipSeekIndex):
+    """GzipSeekIndex backed by indexed_gzip.
+
+    indexed_gzip keeps the 32KB window at every access point, so its index
+    can be exported and is saved to 'gzip_index_cache' under a name derived
+    from the path, size and mtime of the file. Later processes import it
+    instead of reading the whole file again. The point spacing is chosen
+    from the compressed size so the index holds about 'num_points' points.
+    Only the pass that builds the index is counted in 'bytes_read'.
+    """
+
+    @staticmethod
+    def cache_directory():
+        return gzip_index_cache or os.path.join(tempfile.gettempdir(), 'jambio_gzip_index')
+
+    def cache_path(self):
+        file_stat = os.stat(self.path)
+        key = f'{os.path.abspath(self.path)}:{file_stat.st_size}:{file_stat.st_mtime_ns}:{self.num_points}'
+
+        return os.path.join(self.cache_directory(), hashlib.sha1(key.encode()).hexdigest() + '.gzidx')
+
+    @classmethod
+    def prune_cache(cls, max_bytes=gzip_index_cache_bytes):
+        """Deletes the least recently used saved indexes beyond 'max_bytes'."""
+
+        try:
+            entries = [
+                entry for entry in os.scandir(cls.cache_directory())
+                if entry.name.endswith('.gzidx')
+                ]
+        except FileNotFoundError:
+            return
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        total_bytes = 0
+        for entry in entries:
+            total_bytes += entry.stat().st_size
+            if total_bytes > max_bytes:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def build(self):
+        # FastQ typically compresses about four fold
+        spacing = max(os.path.getsize(self.path) * 4 // self.num_points, gzip_index_min_spacing)
+        self.gzip_file = indexed_gzip.IndexedGzipFile(self.path, spacing=spacing)
+        index_path = self.cache_path()
+
+        if os.path.exists(index_path):
+            self.gzip_file.import_index(index_path)
+            # Marks the index as recently used for prune_cache
+            os.utime(index_path)
+        else:
+            self.gzip_file.build_full_index()
+            self.bytes_read += os.path.getsize(self.path)
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            # Export under a temporary name so readers never import a partial index
+            partial_path = f'{index_path}.{os.getpid()}'
+            self.gzip_file.export_index(partial_path)
+            os.replace(partial_path, index_path)
+            self.prune_cache()
+
+        self.uncompressed_offsets = [0] + [
+            point[0] for point in self.gzip_file.seek_points() if point[0] > 0
+            ]
+        self.size = self.gzip_file.seek(0, os.SEEK_END)
+        return self
+
+    def read_at(self, offset, length):
+        self.gzip_file.seek(offset)
+        return self.gzip_file.read(length)
+
+    def close(self):
+        self.gzip_file.close()
+
+def has_saved_gzip_index(path, num_points=fastq_read_sample_size):
+    """Whether sampling 'path' can reuse a saved index without a full read."""
+
+    return (
+        indexed_gzip is not None and
+        os.path.exists(SavedGzipSeekIndex(path, num_points).cache_path())
+        )
+
+def read_sampling_enabled():
+    """Whether imports sample reads across every FastQ, see
+    fastq_read_sampling."""
+
+    return fastq_read_sampling and (indexed_gzip is not None or fastq_read_sampling_in_memory)
+
+# Seek indexes built by this process, least recently used first
+gzip_indexes = collections.OrderedDict()
+
+def open_gzip_index(path, num_points=fastq_read_sample_size):
+    """Returns a built seek index for 'path', reusing one built earlier by
+    this process while the file is unchanged."""
+
+    file_stat = os.stat(path)
+    key = (os.path.abspath(path), file_stat.st_size, file_stat.st_mtime_ns, num_points)
+
+    if key in gzip_indexes:
+        gzip_indexes.move_to_end(key)
+        gzip_indexes[key].reused = True
+        return gzip_indexes[key]
+
+    index_class = SavedGzipSeekIndex if indexed_gzip is not None else GzipSeekIndex
+    gzip_indexes[key] = index_class(path, num_points).build()
+
+    while len(gzip_indexes) > gzip_index_cache_size:
+        gzip_indexes.popitem(last=False)[1].close()
+
+    return gzip_indexes[key]
+
+class FastQReadSampler(object):
+    """Reads the sequence identifiers of reads spread across a gzipped FastQ.
+
+    Up to 'num_reads' access points of the file's seek index are chosen
+    evenly and 'fastq_resync_bytes' are decompressed at each of them. The
+    first complete four-line record in that window is found and its
+    identifier kept, so the sample covers the whole file while inflating
+    only a small window per read once the index exists.
+    Headers are returned as bytes, like FastQHeaderSampler, and
+    'bytes_read' holds the compressed bytes the index read for the sample,
+    including any pass to build it.
+    """
+
+    def __init__(self, fastq_path, num_reads=fastq_read_sample_size):
+        self.fastq_path = fastq_path
+        self.num_reads = num_reads
+        self.bytes_read = 0
+
+    @staticmethod
+    def first_header(window, at_record_start):
+        """Identifier of the first complete record in 'window'.
+
+        Quality lines may also start with '@', so a header is only accepted
+        when the line two below it is a '+' separator and the sequence and
+        quality lines have the same length.
+        """
+
+        lines = window.split(b'\n')
+        # The last line may be cut short and the first one is only whole at
+        # the start of a record
+        lines = lines[:-1] if at_record_start else lines[1:-1]
+
+        for line_num in range(len(lines) - 3):
+            header, sequence, separator, quality = lines[line_num:line_num + 4]
+            if (header.startswith(b'@') and separator.startswith(b'+')
+                    and len(sequence.rstrip(b'\r')) == len(quality.rstrip(b'\r'))):
+                return header.rstrip(b'\r ')
+
+        return None
+
+    def sample(self):
+        index = open_gzip_index(self.fastq_path, self.num_reads)
+        # A freshly built index has only read the file to build itself
+        bytes_read_before = index.bytes_read if index.reused else 0
+
+        access_points = index.access_points()
+        step = max(len(access_points) / self.num_reads, 1)
+        offsets = sorted({
+            access_points[int(point * step)]
+            for point in range(min(self.num_reads, len(access_points)))
+            })
+
+        headers = []
+        seen = set()
+
+        for offset in offsets:
+            header = self.first_header(index.read_at(offset, fastq_resync_bytes), offset == 0)
+            if header is not None and header not in seen:
+                seen.add(header)
+                headers.append(header)
+
+        self.bytes_read = index.bytes_read - bytes_read_before
+        return headers
+
+class SpaceSaving(object):
+    """Bounded heavy hitters counter (Space-Saving, Metwally et al.).
+
+    At most 'capacity' items are counted. An unseen item takes the place of
+    the item with the lowest count and inherits that count, which is kept
+    as its 'error'. Every count overestimates the true count by at most its
+    error, and any item seen more than total / capacity times is present.
+
+    The heap holds one (count, item) entry per item. Entries are only
+    refreshed when they surface as the minimum, so counting a tracked item
+    is a single dictionary update.
+    """
+
+    def __init__(self, capacity=barcode_sketch_capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+
+    def update(self, item, count=1):
+        self.total += count
+
+        if item in self.counts:
+            self.counts[item] += count
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+            return
+
+        while True:
+            min_count, min_item = heapq.heappop(self.heap)
+            if self.counts[min_item] == min_count:
+                break
+            heapq.heappush(self.heap, (self.counts[min_item], min_item))
+
+        del self.counts[min_item]
+        del self.errors[min_item]
+        self.counts[item] = min_count + count
+        self.errors[item] = min_count
+        heapq.heappush(self.heap, (self.counts[item], item))
+
+    def top(self, num_items=None):
+        """(item, count, error) tuples, most common first."""
+
+        ranked = sorted(self.counts.items(), key=lambda item_count: -item_count[1])
+        return [(item, count, self.errors[item]) for item, count in ranked[:num_items]]
+
+class CountMinSketch(object):
+    """Approximate item counts in fixed memory, with the most common items.
+
+    Each item increments one counter in every one of 'depth' rows of
+    'width' counters, the rows hashed with differently seeded CRC32s so
+    sketches built in different processes can be merged. The smallest of an
+    item's counters is its estimate, never below the true count.
+    Alongside the table the 'top_k' items with the highest estimates are
+    kept in 'top'.
+    """
+
+    def __init__(self, width=undetermined_sketch_width, depth=undetermined_sketch_depth,
+                 top_k=undetermined_top_barcodes):
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.table = [array.array('Q', bytes(8 * width)) for row in range(depth)]
+        self.top = {}
+        self.top_floor = 0
+        self.total = 0
+
+    def positions(self, item):
+        return [zlib.crc32(item, seed) % self.width for seed in range(1, self.depth + 1)]
+
+    def estimate(self, item):
+        return min(row[position] for row, position in zip(self.table, self.positions(item)))
+
+    def update(self, item, count=1):
+        self.total += count
+        estimate = None
+
+        for row, position in zip(self.table, self.positions(item)):
+            row[position] += count
+            if estimate is None or row[position] < estimate:
+                estimate = row[position]
+
+        self.track(item, estimate)
+        return estimate
+
+    def track(self, item, estimate):
+        if item in self.top or len(self.top) < self.top_k:
+            self.top[item] = estimate
+        elif estimate > self.top_floor:
+            del self.top[min(self.top, key=self.top.get)]
+            self.top[item] = estimate
+        else:
+            return
+        if len(self.top) == self.top_k:
+            self.top_floor = min(self.top.values())
+
+    def merge(self, other):
+        """Adds the counts of a sketch with the same dimensions."""
+
+        for row, other_row in zip(self.table, other.table):
+            for position, count in enumerate(other_row):
+                if count:
+                    row[position] += count
+        self.total += other.total
+
+        for item in set(self.top) | set(other.top):
+            self.top.pop(item, None)
+            self.track(item, self.estimate(item))
+
+    def most_common(self, num_items=None):
+        """(item, estimated count) pairs, most common first."""
+
+        ranked = sorted(self.top.items(), key=lambda item_count: -item_count[1])
+        return ranked[:num_items]
+
+class FastQScanner(object):
+    """Collects the statistics of a gzipped FastQ in a single pass.
+
+    The file is read through open_fastq 'fastq_scan_buffer_size' bytes at a
+    time. Its compressed bytes are fed to MD5 and SHA-256 on the way in and
+    the complete records of the output are counted: read lengths, per-cycle quality
+    sums (with numpy when installed), the flowcell IDs and the barcodes of
+    the sequence identifiers, kept in a SpaceSaving sketch.
+    Lines split across blocks are carried over to the next one.
+    """
+
+    def __init__(self, fastq_path):
+        self.fastq_path = fastq_path
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.compressed_bytes = 0
+        self.read_count = 0
+        self.length_histogram = collections.Counter()
+        self.quality_sums = []
+        self.barcodes = SpaceSaving()
+        self.flowcell_ids = set()
+        self.index_bases = 0
+        self.n_bases = 0
+
+    def add_quality_sums(self, qualities):
+        """Adds the quality bytes of a batch of reads to the cycle sums."""
+
+        lengths = set(map(len, qualities))
+        if not lengths:
+            return
+        longest = max(lengths)
+        if len(self.quality_sums) < longest:
+            self.quality_sums.extend([0] * (longest - len(self.quality_sums)))
+
+        if numpy is not None:
+            for length in lengths:
+                same_length = qualities if len(lengths) == 1 else [
+                    quality for quality in qualities if len(quality) == length
+                    ]
+                if length == 0:
+                    continue
+                cycle_sums = numpy.frombuffer(b''.join(same_length), dtype=numpy.uint8).reshape(
+                    -1, length).sum(axis=0, dtype=numpy.uint64)
+                for cycle, cycle_sum in enumerate(cycle_sums.tolist()):
+                    self.quality_sums[cycle] += cycle_sum
+        else:
+            for cycle, column in enumerate(itertools.zip_longest(*qualities, fillvalue=0)):
+                self.quality_sums[cycle] += sum(column)
+
+    def add_records(self, lines):
+        headers = lines[0::4]
+        qualities = lines[3::4]
+
+        self.read_count += len(headers)
+        self.length_histogram.update(map(len, lines[1::4]))
+        self.add_quality_sums(qualities)
+
+        self.flowcell_ids.update(
+            header.split(b':', 3)[2] for header in headers if header.count(b':') >= 3
+            )
+        barcodes = collections.Counter(header.rpartition(b':')[2] for header in headers)
+        for barcode, count in barcodes.items():
+            self.barcodes.update(barcode, count)
+            self.index_bases += count * (len(barcode) - barcode.count(b'+'))
+            self.n_bases += count * barcode.count(b'N')
+
+    def add_compressed(self, block):
+        self.md5.update(block)
+        self.sha256.update(block)
+        self.compressed_bytes += len(block)
+
+    def scan(self):
+        """Scans the file, returning the FastQScan fields."""
+
+        start_time = time.perf_counter()
+        carry = b''
+
+        with open_fastq(self.fastq_path, on_compressed=self.add_compressed) as fastq_file_obj:
+            while True:
+                output = fastq_file_obj.read(fastq_scan_buffer_size)
+                if not output:
+                    break
+
+                lines = (carry + output).split(b'\n')
+                # Hold back the unfinished line and any incomplete record
+                complete = len(lines) - 1
+                complete -= complete % 4
+                self.add_records(lines[:complete])
+                carry = b'\n'.join(lines[complete:])
+
+        # The last record may have no trailing newline
+        lines = carry.rstrip(b'\n').split(b'\n') if carry.strip() else []
+        self.add_records(lines[:len(lines) - len(lines) % 4])
+
+        if self.compressed_bytes != os.path.getsize(self.fastq_path):
+            raise Exception(f'{self.fastq_path} changed while it was scanned')
+
+        reads_at_cycle = [0] * len(self.quality_sums)
+        for length, reads in self.length_histogram.items():
+            for cycle in range(min(length, len(reads_at_cycle))):
+                reads_at_cycle[cycle] += reads
+
+        return {
+            'md5': self.md5.hexdigest(),
+            'sha256': self.sha256.hexdigest(),
+            'read_count': self.read_count,
+            'length_histogram': json.dumps(
+                {str(length): reads for length, reads in sorted(self.length_histogram.items())}),
+            'cycle_mean_quality': json.dumps([
+                round(quality_sum / reads - 33, 2)
+                for quality_sum, reads in zip(self.quality_sums, reads_at_cycle) if reads
+                ]),
+            'index_summary': json.dumps({
+                'barcodes': [
+                    [barcode.decode('ascii'), count, error]
+                    for barcode, count, error in self.barcodes.top()
+                    ],
+                'flowcell_ids': sorted(flowcell_id.decode('ascii') for flowcell_id in self.flowcell_ids),
+                'index_n_rate': self.n_bases / self.index_bases if self.index_bases else None,
+                }),
+            'duration': time.perf_counter() - start_time,
+            }
+
+    @classmethod
+    def scan_file(cls, fastq_path):
+        return cls(fastq_path).scan()
 
 class FastQParser(object):
     """Function to parse the file names and content of Fastq files.
 
     Create database objects out of the information.
     Example file to be parsed is: 17127FL-27-02-bkbk12-A1_S193_L005_R1_001.fastq.gz
+
+    With 'barcode_analysis' every header of each file is also streamed
+    through analyse_barcodes.
+
+    Files with a current FastQScan are not opened at all, their indexes,
+    flowcell and barcode analysis come from the scan's index summary,
+    see parse_scan_summary.
     """
-    def __init__(self, fastq_directory, project_id):
+    def __init__(self, fastq_directory, project_id, barcode_analysis=fastq_barcode_analysis):
         self.fastq_directory = fastq_directory
         self.project_id = project_id
+        self.barcode_analysis = barcode_analysis
+        self.bytes_read = {}
 
     @staticmethod
     def index_match(string):
@@ -170,191 +1075,1404 @@ class FastQParser(object):
             if base not in allowed_characters:
                 raise Exception(f'Non-base character in index: {base}')
 
-    def parse_illumina_fastq_content(self, fastq_file_obj, core_field_dict):
-        """Parser for the contents of any modern Illumina fastQ file
-        'top_seq_identifier' refers to the first sequence identifier, of the form:
-        @E00558:209:HMKJCCCXY:5:1101:10044:1379 1:N:0:NCTCGCTA+NTAGAGAG
+    @staticmethod
+    def consensus_index(index_sequences, index_name):
+        """Most common index among the sampled reads.
+
+        Reads with sequencing errors or N calls in the index are expected in
+        a demultiplexed FastQ, so only a 'fastq_index_consensus' fraction of
+        the reads has to be within index_max_mismatches of the consensus.
+        Ties go to the sequence with the fewest N's. 'index_sequences' may
+        also be a mapping of sequence to read count.
         """
 
-        line_list = []
+        counts = collections.Counter(index_sequences)
+        total = sum(counts.values())
+        consensus = max(counts, key=lambda sequence: (counts[sequence], -sequence.count('N')))
+
+        if len(counts) > 1:
+            matcher = IndexMatcher()
+            matcher.add(consensus, consensus)
+            matching = sum(
+                count for sequence, count in counts.items() if matcher.lookup(sequence)
+                )
+            if matching < fastq_index_consensus * total:
+                raise Exception(
+                    f'{index_name} indexes not demultiplexed: '
+                    f'{matching} of {total} sampled reads match {consensus}')
 
-        # Creates a sub-list of run identifier lines
-        for line in fastq_file_obj:
-           if line.startswith('@') and len(line_list) < 2:
-                line_list.append(line.rstrip('\n '))
+        return consensus
+
+    @staticmethod
+    def parse_illumina_filename(fastq_file):
+        """Sample, lane and read fields from an Illumina FastQ filename."""
+
+        filename_fields = {}
+
+        # Divide filename into components
+        illumina_split = fastq_file.split("_")
+
+        if len(illumina_split) >= 3:
+            # Extract read direction
+            if illumina_split[-2] == 'R1' or illumina_split[-2] == 'R2':
+                filename_fields['read'] = illumina_split[-2]
+            # Extract lane number
+            if illumina_split[-3].startswith('L'):
+                filename_fields['lane'] = illumina_split[-3]
+        # Extract sample ID
+        filename_fields['sample_id'] = illumina_split[0]
+
+        return filename_fields
+
+    def parse_illumina_fastq_content(self, header_lines, core_field_dict):
+        """Parser for the sequence identifiers of any modern Illumina fastQ file
+        'header_lines' are the identifier lines (bytes) from FastQReadSampler
+        or FastQHeaderSampler, of the form:
+        @E00558:209:HMKJCCCXY:5:1101:10044:1379 1:N:0:NCTCGCTA+NTAGAGAG
+        """
+
+        if len(header_lines) == 0:
+            raise Exception('No sequence identifiers found in FastQ')
 
         i7_indexes = []
         i5_indexes = []
         flowcell_ids = []
 
-        for line in line_list:
+        for line in header_lines:
 
             # Split sequencing identifier into a list of components
-            seq_id_list = line.split(":")
+            seq_id_list = line.split(b":")
 
-            flowcell_ids.append(seq_id_list[2].rstrip('\r\n '))
+            flowcell_ids.append(seq_id_list[2].decode('ascii'))
 
             # Check if one or two barcodes are present
-            if "+" in seq_id_list[-1]:
+            if b"+" in seq_id_list[-1]:
 
-                i7_index_seq = seq_id_list[-1].split("+")[0].rstrip('\r\n ')
-                try:
-                    self.index_match(i7_index_seq)
-                except:
-                    raise
+                i7_index_seq = seq_id_list[-1].split(b"+")[0].decode('ascii')
+                self.index_match(i7_index_seq)
                 i7_indexes.append(i7_index_seq)
 
-                i5_index_seq = seq_id_list[-1].split("+")[1].rstrip('\r\n ')
-                try:
-                    self.index_match(i5_index_seq)
-                except:
-                    raise
+                i5_index_seq = seq_id_list[-1].split(b"+")[1].decode('ascii')
+                self.index_match(i5_index_seq)
                 i5_indexes.append(i5_index_seq)
 
             else:
-                i7_index_seq = seq_id_list[-1].rstrip('\r\n ')
-                try:
-                    self.index_match(i7_index_seq)
-                except:
-                    raise
+                i7_index_seq = seq_id_list[-1].decode('ascii')
+                self.index_match(i7_index_seq)
                 i7_indexes.append(i7_index_seq)
 
         # Check if FastQ is demultiplexed
-        if i7_indexes[0] == i7_indexes[1]:
-            core_field_dict['i7_index_sequence'] = i7_indexes[0]
-        else:
-            raise Exception('I7 indexes not demultiplexed.')
+        core_field_dict['i7_index_sequence'] = self.consensus_index(i7_indexes, 'I7')
 
-        if i5_indexes[0] is not None:
-            if i5_indexes[0] == i5_indexes[1]:
-                core_field_dict['i5_index_sequence'] = i5_indexes[0]
-            else:
-                print ('WARNING: I5 indexes not demultiplexed.')
+        if i5_indexes:
+            try:
+                core_field_dict['i5_index_sequence'] = self.consensus_index(i5_indexes, 'I5')
+            except Exception as e:
+                print (f'WARNING: {e}')
 
 
         # Check if flowcell ID's are consistent
-        if flowcell_ids[0] == flowcell_ids[1]:
+        if len(set(flowcell_ids)) == 1:
             core_field_dict['flowcell_id'] = flowcell_ids[0]
         else:
             raise Exception('Flowcell IDs are not consistent in this FastQ')
 
         return core_field_dict
 
+    @staticmethod
+    def expected_barcodes(core_field_dict):
+        """Returns a function telling whether a barcode (bytes) is in range
+        of the file's consensus indexes."""
+
+        i7_matcher = IndexMatcher()
+        i7_matcher.add(core_field_dict['i7_index_sequence'], True)
+        i5_matcher = None
+        if core_field_dict.get('i5_index_sequence'):
+            i5_matcher = IndexMatcher()
+            i5_matcher.add(core_field_dict['i5_index_sequence'], True)
+
+        @functools.lru_cache(maxsize=4096)
+        def expected(barcode):
+            i7_index_seq, _, i5_index_seq = barcode.decode('ascii').partition('+')
+            if not i7_matcher.lookup(i7_index_seq):
+                return False
+            return i5_matcher is None or bool(i5_matcher.lookup(i5_index_seq))
+
+        return expected
+
+    @staticmethod
+    def save_barcode_analysis(core_field_dict, ranked_barcodes, reads, expected_reads, index_n_rate, expected):
+        """Adds the barcode analysis fields, 'ranked_barcodes' being
+        (barcode, count, error) most common first."""
+
+        unexpected = [
+            [barcode.decode('ascii'), count]
+            for barcode, count, error in ranked_barcodes
+            if not expected(barcode)
+            ]
+
+        core_field_dict['reads_scanned'] = reads
+        core_field_dict['expected_index_fraction'] = expected_reads / reads if reads else None
+        core_field_dict['index_n_rate'] = index_n_rate
+        core_field_dict['unexpected_barcodes'] = json.dumps(unexpected[:unexpected_barcodes_reported])
+
+        return core_field_dict
+
+    @classmethod
+    def analyse_barcodes(cls, fastq_path, core_field_dict):
+        """Streams every sequence identifier of a FastQ into a barcode histogram.
+
+        Observed i7+i5 combinations are counted in a SpaceSaving sketch so
+        memory stays fixed whatever the read count. Adds the reads scanned,
+        the fraction of reads in range of the file's consensus indexes, the
+        N rate over index bases and the most common unexpected barcodes
+        (JSON) to 'core_field_dict'.
+        """
+
+        expected = cls.expected_barcodes(core_field_dict)
+        sketch = SpaceSaving()
+        expected_reads = index_bases = n_bases = 0
+
+        with open_fastq(fastq_path) as fastq_file_obj:
+            for header in itertools.islice(fastq_file_obj, 0, None, 4):
+                barcode = header.rstrip(b'\r\n ').rpartition(b':')[2]
+                sketch.update(barcode)
+                index_bases += len(barcode) - barcode.count(b'+')
+                n_bases += barcode.count(b'N')
+                if expected(barcode):
+                    expected_reads += 1
+
+        return cls.save_barcode_analysis(
+            core_field_dict, sketch.top(), sketch.total, expected_reads,
+            n_bases / index_bases if index_bases else None, expected
+            )
+
+    def parse_scan_summary(self, index_summary, core_field_dict):
+        """Fills the fields of parse_illumina_fastq_content, and with
+        'barcode_analysis' those of analyse_barcodes, from the index summary
+        of a FastQScan.
+
+        The consensus indexes are taken over every barcode of the scan's
+        sketch. Sketch counts are upper bounds, so the expected index
+        fraction counts each barcode less its error and is a lower bound.
+        """
+
+        barcodes = [
+            (barcode.encode('ascii'), count, error)
+            for barcode, count, error in index_summary['barcodes']
+            ]
+        if not barcodes:
+            raise Exception('No sequence identifiers found in FastQ')
+
+        i7_counts = collections.Counter()
+        i5_counts = collections.Counter()
+
+        for barcode, count, error in barcodes:
+            i7_index_seq, plus, i5_index_seq = barcode.decode('ascii').partition('+')
+            self.index_match(i7_index_seq)
+            i7_counts[i7_index_seq] += count
+            if plus:
+                self.index_match(i5_index_seq)
+                i5_counts[i5_index_seq] += count
+
+        core_field_dict['i7_index_sequence'] = self.consensus_index(i7_counts, 'I7')
+
+        if i5_counts:
+            try:
+                core_field_dict['i5_index_sequence'] = self.consensus_index(i5_counts, 'I5')
+            except Exception as e:
+                print (f'WARNING: {e}')
+
+        if len(index_summary['flowcell_ids']) == 1:
+            core_field_dict['flowcell_id'] = index_summary['flowcell_ids'][0]
+        else:
+            raise Exception('Flowcell IDs are not consistent in this FastQ')
+
+        if self.barcode_analysis:
+            expected = self.expected_barcodes(core_field_dict)
+            self.save_barcode_analysis(
+                core_field_dict, barcodes, index_summary['read_count'],
+                sum(count - error for barcode, count, error in barcodes if expected(barcode)),
+                index_summary['index_n_rate'], expected
+                )
+
+        return core_field_dict
+
+    def scan_summaries(self, fastq_files):
+        """Index summary of the current FastQScan of each file, None for
+        files without one.
+
+        A scan is only trusted while the file on disk still has the size
+        and mtime it was scanned at, an in-place rewrite leaves the
+        directory mtime and so possibly the catalog row unchanged.
+        """
+
+        scans = {
+            scan.fastq_file.filename: scan for scan in FastQScan.objects.filter(
+                fastq_file__directory__path=os.path.abspath(self.fastq_directory)
+                ).select_related('fastq_file')
+            }
+
+        summaries = []
+        for fastq_file in fastq_files:
+            scan = scans.get(fastq_file)
+            stat = os.stat(os.path.join(self.fastq_directory, fastq_file))
+            if scan is None or not scan.is_current() or \
+               (scan.size, scan.mtime) != (stat.st_size, stat.st_mtime):
+                summaries.append(None)
+                continue
+
+            index_summary = json.loads(scan.index_summary)
+            if 'barcodes' not in index_summary:
+                # Scanned before the index summary kept its barcodes
+                summaries.append(None)
+                continue
+            index_summary['read_count'] = scan.read_count
+            summaries.append(index_summary)
+
+        return summaries
+
+    def parse_fastq_file(self, fastq_file, index_summary=None):
+        """Reads the headers and filename of one FastQ file.
+
+        With the 'index_summary' of a current FastQScan the file itself is
+        not read. Touches no database state so it can run in a worker
+        process. Returns the model fields, compressed bytes read and
+        seconds taken.
+        """
+
+        start_time = time.perf_counter()
+        fastq_path = os.path.join(self.fastq_directory, fastq_file)
+
+        #Dictionary for saving different fields before writing to model
+        core_field_dict = {}
+
+        if index_summary is not None:
+            self.parse_scan_summary(index_summary, core_field_dict)
+            bytes_read = 0
+        else:
+            if read_sampling_enabled() or has_saved_gzip_index(fastq_path):
+                sampler = FastQReadSampler(fastq_path)
+            else:
+                sampler = FastQHeaderSampler(fastq_path)
+
+            # Function defined above
+            self.parse_illumina_fastq_content(sampler.sample(), core_field_dict)
+
+            bytes_read = sampler.bytes_read
+            if self.barcode_analysis:
+                self.analyse_barcodes(fastq_path, core_field_dict)
+                bytes_read += os.path.getsize(fastq_path)
+
+        #Save filename
+        core_field_dict['filename'] = fastq_file
+
+        #Save project_id from chosen work order object
+        core_field_dict['project_id'] = self.project_id
+
+        core_field_dict.update(self.parse_illumina_filename(fastq_file))
+
+        return core_field_dict, bytes_read, time.perf_counter() - start_time
+
+    def parse_fastq_files(self, processes=fastq_import_processes):
+        """Parses every FastQ in the directory and saves one CoreData each.
+
+        With more than one process the files are parsed in a process pool
+        and gathered here. Nothing is written until every file has parsed
+        successfully, then all objects are bulk inserted in a single
+        transaction.
+        Per-file timings are kept in 'file_timings'.
+        """
+
+        if fastq_read_sampling and not read_sampling_enabled():
+            print ('WARNING: fastq_read_sampling needs indexed_gzip to save seek indexes, '
+                   'only leading reads are sampled')
+
+        catalog = FastQCatalog()
+        # Full so that files rewritten in place are seen as changed
+        catalog.refresh(self.fastq_directory, recursive=False, full=True)
+        fastq_files = sorted(
+            catalog.files_in(self.fastq_directory, recursive=False).values_list('filename', flat=True)
+            )
+
+        summaries = self.scan_summaries(fastq_files)
+
+        if processes > 1 and len(fastq_files) > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(self.parse_fastq_file, fastq_files, summaries))
+        else:
+            results = [
+                self.parse_fastq_file(fastq_file, index_summary)
+                for fastq_file, index_summary in zip(fastq_files, summaries)
+                ]
+
+        self.file_timings = {}
+        core_objects = []
+
+        for fastq_file, (core_field_dict, bytes_read, elapsed) in zip(fastq_files, results):
+            self.bytes_read[fastq_file] = bytes_read
+            self.file_timings[fastq_file] = elapsed
+
+            ## Create a model object for this fastq file
+            core_objects.append(CoreData(**core_field_dict))
+
+        with transaction.atomic():
+            Project.objects.get_or_create(project_id=self.project_id)
+            CoreData.objects.bulk_create(core_objects, batch_size=bulk_create_batch_size)
+            invalidate_comparisons(self.project_id)
+
+        return len(results)
+
+class FastQCatalog(object):
+    """Keeps the FastQFile and CatalogDirectory tables in sync with disk.
+
+    A refresh lists a directory with os.scandir only if its mtime differs
+    from the one stored at its last listing, or is too close to the time of
+    that listing to rule out a change within the same timestamp tick, see
+    catalog_mtime_slack. Otherwise the stored subdirectories are walked
+    without touching the directory entries.
+    Adding, removing or renaming a file changes the mtime of its directory,
+    a file rewritten in place does not - use 'full' to restat every file.
+
+    Files are assigned to the project named by their first path component
+    under 'root'.
+    """
+
+    def __init__(self, root=PROJECT_STORAGE):
+        self.root = os.path.abspath(root)
+
+    def project_for(self, path):
+        relative_path = os.path.relpath(path, self.root)
+        if relative_path == '.' or relative_path.startswith('..'):
+            return None
+        return relative_path.split(os.sep)[0]
+
+    @staticmethod
+    def unchanged(directory, mtime):
+        return (
+            directory.mtime == mtime and
+            directory.scanned_at is not None and
+            directory.scanned_at.timestamp() - mtime > catalog_mtime_slack
+            )
+
+    def refresh(self, top=None, recursive=True, full=False):
+        """Brings the catalog up to date for 'top' (default: root).
+
+        Returns counts of directories listed and files added, updated and
+        removed.
+        """
+
+        top = os.path.abspath(top or self.root)
+        stats = {'listed': 0, 'added': 0, 'updated': 0, 'removed': 0}
+
+        if recursive:
+            known = {
+                directory.path: directory for directory in
+                CatalogDirectory.objects.filter(Q(path=top) | Q(path__startswith=top + os.sep))
+                }
+        else:
+            known = {directory.path: directory for directory in CatalogDirectory.objects.filter(path=top)}
+
+        children = {}
+        for directory in known.values():
+            children.setdefault(os.path.dirname(directory.path), []).append(directory.path)
+
+        visited = set()
+        stack = [top]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            visited.add(path)
+            directory = known.get(path)
+
+            if directory is not None and not full and self.unchanged(directory, mtime):
+                if recursive:
+                    stack.extend(children.get(path, []))
+                continue
+
+            directory, subdirectories = self.list_directory(path, mtime, directory, stats)
+            known[path] = directory
+
+            if recursive:
+                stack.extend(subdirectories)
+            else:
+                # Record subdirectories as never listed, so a recursive
+                # refresh lists them rather than trusting their mtime
+                for subdirectory in subdirectories:
+                    if subdirectory not in known:
+                        CatalogDirectory.objects.get_or_create(
+                            path=subdirectory,
+                            defaults={'parent': directory}
+                            )
+
+        if recursive:
+            # Directories that have gone from disk, their files cascade
+            CatalogDirectory.objects.filter(
+                path__in=[path for path in known if path not in visited]
+                ).delete()
+
+        return stats
+
     @transaction.atomic
-    def parse_fastq_files(self):
+    def list_directory(self, path, mtime, directory, stats):
+        """Lists one directory and syncs the FastQFile rows directly in it."""
+
+        subdirectories = []
+        on_disk = {}
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.endswith('.fastq.gz') and entry.is_file():
+                    on_disk[entry.path] = entry.stat()
+
+        if directory is None:
+            parent = CatalogDirectory.objects.filter(path=os.path.dirname(path)).first()
+            directory = CatalogDirectory(path=path, parent=parent)
+        directory.mtime = mtime
+        directory.scanned_at = timezone.now()
+        directory.save()
+
+        # Subdirectories that have gone from disk, their files cascade
+        CatalogDirectory.objects.filter(parent=directory).exclude(path__in=subdirectories).delete()
+
+        in_catalog = {fastq_file.path: fastq_file for fastq_file in directory.fastq_files.all()}
+
+        removed = [file_path for file_path in in_catalog if file_path not in on_disk]
+        FastQFile.objects.filter(path__in=removed).delete()
+        stats['removed'] += len(removed)
+
+        project_id = self.project_for(path)
+        if project_id is not None:
+            Project.objects.get_or_create(project_id=project_id)
+
+        new_files = []
+        for file_path, stat in on_disk.items():
+            fastq_file = in_catalog.get(file_path)
+
+            if fastq_file is None:
+                new_files.append(FastQFile(
+                    project_id = project_id,
+                    directory = directory,
+                    path = file_path,
+                    filename = os.path.basename(file_path),
+                    size = stat.st_size,
+                    mtime = stat.st_mtime,
+                    inode = stat.st_ino,
+                    **FastQParser.parse_illumina_filename(os.path.basename(file_path))
+                ))
+            elif (fastq_file.size, fastq_file.mtime, fastq_file.inode) != \
+                 (stat.st_size, stat.st_mtime, stat.st_ino):
+                fastq_file.size = stat.st_size
+                fastq_file.mtime = stat.st_mtime
+                fastq_file.inode = stat.st_ino
+                fastq_file.ingested_at = None
+                fastq_file.save()
+                stats['updated'] += 1
+
+        FastQFile.objects.bulk_create(new_files, batch_size=bulk_create_batch_size)
+        stats['added'] += len(new_files)
+        stats['listed'] += 1
+
+        return directory, subdirectories
+
+    def scan(self, top=None, processes=fastq_import_processes):
+        """Refreshes 'top' and saves a FastQScan for every file in it
+        without a current one. Returns the number of files scanned."""
+
+        top = os.path.abspath(top or self.root)
+        self.refresh(top)
+
+        fastq_files = [
+            fastq_file for fastq_file in
+            self.files_in(top).select_related('scan').order_by('-size')
+            if not hasattr(fastq_file, 'scan') or not fastq_file.scan.is_current()
+            ]
+        fastq_paths = [fastq_file.path for fastq_file in fastq_files]
+
+        if processes > 1 and len(fastq_paths) > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(FastQScanner.scan_file, fastq_paths))
+        else:
+            results = [FastQScanner.scan_file(fastq_path) for fastq_path in fastq_paths]
+
+        with transaction.atomic():
+            for fastq_file, scan_fields in zip(fastq_files, results):
+                FastQScan.objects.update_or_create(
+                    fastq_file=fastq_file,
+                    defaults=dict(scan_fields, size=fastq_file.size, mtime=fastq_file.mtime)
+                    )
 
-        numof_files_parsed = 0
+        return len(results)
 
-        for fastq_file in os.listdir(self.fastq_directory):
-            if fastq_file.endswith(".fastq.gz"):
-                with gzip.open(self.fastq_directory + "/" + fastq_file, mode='rt') as fastq_file_obj:
+    @staticmethod
+    def files_in(path, recursive=True):
+        """Catalogued FastQ files in a directory, or anywhere below it."""
+
+        path = os.path.abspath(path)
+        if recursive:
+            return FastQFile.objects.filter(path__startswith=path + os.sep)
+        return FastQFile.objects.filter(directory__path=path)
 
-                    #Dictionary for saving different fields before writing to model
-                    core_field_dict = {}
+def progress_channel(*parts):
+    """Redis channel for the progress of one job, e.g. ('qc', project_id)."""
 
-                    # Function defined above
-                    try:
-                        self.parse_illumina_fastq_content(fastq_file_obj, core_field_dict)
-                        numof_files_parsed += 1
-                    except:
-                        raise
+    return progress_channel_prefix + ':'.join(str(part) for part in parts)
 
-                    #Save filename
-                    core_field_dict['filename'] = fastq_file
+# Monotonic time before which events are dropped, set when redis fails
+progress_paused_until = 0
 
-                    #Save project_id from chosen work order object
-                    core_field_dict['project_id'] = self.project_id
+def publish_progress(channel, event, **fields):
+    """Publishes a JSON progress event on 'channel'.
+
+    Progress is a courtesy to whoever is watching, so a job never fails
+    because redis is unreachable, the event is dropped instead.
+    """
 
-                    top_seq_identifier = ""
-                    seq_id_list = []
+    global progress_paused_until
+    if time.monotonic() < progress_paused_until:
+        return
 
-                    ## Filename operations
+    fields.update(event=event, time=time.time())
+    try:
+        django_rq.get_connection('default').publish(channel, json.dumps(fields, default=str))
+    except redis.exceptions.RedisError:
+        progress_paused_until = time.monotonic() + progress_retry_seconds
 
-                    # Divide filename into components
-                    illumina_split = fastq_file.split("_")
+def server_sent_event(data):
+    return f"data: {json.dumps(data, default=str)}\n\n"
+
+def progress_events(channel, snapshot=None, keepalive=progress_keepalive):
+    """Server-sent events relaying the progress published on 'channel'.
+
+    'snapshot' returns the current state from the database, it is called
+    once the channel is subscribed to so that nothing published in between
+    is lost, and sent as the first event. The stream ends after a
+    'job_finished' event, from the channel or the snapshot, or when redis
+    is unreachable.
+    """
+
+    try:
+        pubsub = django_rq.get_connection('default').pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+    except redis.exceptions.RedisError:
+        pubsub = None
+
+    try:
+        if snapshot is not None:
+            state = dict({'event': 'snapshot'}, **snapshot())
+            yield server_sent_event(state)
+            if state['event'] == 'job_finished':
+                return
+
+        while pubsub is not None:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            data = message['data']
+            if isinstance(data, bytes):
+                data = data.decode()
+            yield f"data: {data}\n\n"
+
+            if json.loads(data).get('event') == 'job_finished':
+                return
+    except redis.exceptions.RedisError:
+        return
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+def scan_fastq_files(top):
+    """rq job scanning the FastQs under 'top' that have no current scan."""
+
+    return FastQCatalog().scan(top)
+
+def import_fastq_headers(project_id, fastq_directory):
+    """rq job replacing a project's CoreData with a fresh header import."""
+
+    with transaction.atomic():
+        CoreData.objects.filter(project_id=project_id).delete()
+        invalidate_comparisons(project_id)
+        return FastQParser(fastq_directory, project_id).parse_fastq_files()
+
+# Complements of index bases, N stays N
+complements = str.maketrans('ACGTN', 'TGCAN')
+
+def reverse_complement(sequence):
+    return sequence.translate(complements)[::-1]
+
+class IndexMatcher(object):
+    """Looks up index sequences within a few substitutions of a query.
+
+    Every added sequence is expanded into its mismatch neighborhood - all
+    sequences within 'max_mismatches' substitutions, with N bases expanded
+    to A, C, G and T - and each neighbor is hashed to the added values.
+    A lookup is then one dictionary access per wildcard expansion of the
+    query instead of a comparison against every added sequence.
+    """
+
+    bases = 'ACGT'
+
+    def __init__(self, max_mismatches=index_max_mismatches, max_wildcards=index_max_wildcards):
+        self.max_mismatches = max_mismatches
+        self.max_wildcards = max_wildcards
+        self.neighborhood = {}
+
+    def expand_wildcards(self, sequence):
+        """Yields the sequence and, if it has few enough N's, every base
+        substitution of them."""
+
+        yield sequence
+
+        wildcards = [pos for pos, base in enumerate(sequence) if base == 'N']
+        if not wildcards or len(wildcards) > self.max_wildcards:
+            return
+
+        bases = list(sequence)
+        for replacement in itertools.product(self.bases, repeat=len(wildcards)):
+            for pos, base in zip(wildcards, replacement):
+                bases[pos] = base
+            yield ''.join(bases)
+
+    def mismatch_neighborhood(self, sequence):
+        """All sequences within 'max_mismatches' substitutions of sequence."""
+
+        neighbors = set()
+
+        for expanded in self.expand_wildcards(sequence):
+            for num_mismatches in range(self.max_mismatches + 1):
+                for positions in itertools.combinations(range(len(expanded)), num_mismatches):
+                    choices = [
+                        [base for base in self.bases if base != expanded[pos]]
+                        for pos in positions
+                        ]
+                    bases = list(expanded)
+                    for replacement in itertools.product(*choices):
+                        for pos, base in zip(positions, replacement):
+                            bases[pos] = base
+                        neighbors.add(''.join(bases))
+
+        return neighbors
+
+    def add(self, sequence, value):
+        for neighbor in self.mismatch_neighborhood(sequence):
+            self.neighborhood.setdefault(neighbor, set()).add(value)
+
+    def lookup(self, sequence):
+        """Returns the set of values whose sequences are within range."""
+
+        values = set()
+        for expanded in self.expand_wildcards(sequence):
+            values.update(self.neighborhood.get(expanded, ()))
+        return values
+
+class PackedIndexArray(object):
+    """Index sequences packed 2 bits per base into numpy uint64 words.
+
+    A, C, G and T are coded 00, 01, 10 and 11 with base i in bits 2i and
+    2i + 1. N positions are coded 00 and flagged in a separate mask with
+    both bits set, so they can be ignored when computing distances.
+    Sequences longer than 32 bases or containing anything other than
+    ACGTN (e.g. a missing i5 stored as 'None') are flagged as invalid and
+    only ever equal themselves.
+    """
 
-                    # Extract read direction
-                    if illumina_split[-2] == 'R1' or illumina_split[-2] == 'R2':
-                        core_field_dict['read'] = illumina_split[-2]
-                    # Extract lane number
-                    if illumina_split[-3].startswith('L'):
-                        core_field_dict['lane'] = illumina_split[-3]
-                    # Extract sample ID
-                    core_field_dict['sample_id'] = illumina_split[0]
+    base_codes = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'N': 0}
+    max_length = 32
+    low_bits = 0x5555555555555555
 
-                    ## Create and populate a model object for this fastq file
-                    data = CoreData.objects.create(**core_field_dict)
+    def __init__(self, sequences):
+        if numpy is None:
+            raise Exception("The 'numpy' comparison backend requires numpy to be installed.")
 
-        return numof_files_parsed
+        self.sequences = numpy.array(sequences, dtype=object)
+        self.codes = numpy.zeros(len(sequences), dtype=numpy.uint64)
+        self.n_masks = numpy.zeros(len(sequences), dtype=numpy.uint64)
+        self.lengths = numpy.zeros(len(sequences), dtype=numpy.int64)
+        self.valid = numpy.ones(len(sequences), dtype=bool)
+
+        for row, sequence in enumerate(sequences):
+            if len(sequence) > self.max_length or not set(sequence) <= set(self.base_codes):
+                self.valid[row] = False
+                continue
+
+            code = 0
+            n_mask = 0
+            for pos, base in enumerate(sequence):
+                code |= self.base_codes[base] << (2 * pos)
+                if base == 'N':
+                    n_mask |= 3 << (2 * pos)
+
+            self.codes[row] = code
+            self.n_masks[row] = n_mask
+            self.lengths[row] = len(sequence)
+
+    @staticmethod
+    def popcount(words):
+        if hasattr(numpy, 'bitwise_count'):
+            return numpy.bitwise_count(words).astype(numpy.int64)
+
+        byte_counts = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.int64)
+        return byte_counts[words.view(numpy.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+    def identical(self, other):
+        """Boolean matrix of sequences that are exactly equal, N's included."""
+
+        identical = (
+            (self.codes[:, None] == other.codes[None, :]) &
+            (self.n_masks[:, None] == other.n_masks[None, :]) &
+            (self.lengths[:, None] == other.lengths[None, :]) &
+            self.valid[:, None] & other.valid[None, :]
+            )
+
+        # Invalid sequences are rare, compare those as strings
+        invalid_rows = numpy.flatnonzero(~self.valid)
+        invalid_columns = numpy.flatnonzero(~other.valid)
+        if len(invalid_rows) and len(invalid_columns):
+            identical[numpy.ix_(invalid_rows, invalid_columns)] = (
+                self.sequences[invalid_rows][:, None] ==
+                other.sequences[invalid_columns][None, :]
+                ).astype(bool)
+
+        return identical
+
+    def distances(self, other):
+        """Hamming distance matrix of self (rows) against other (columns).
+
+        Positions that are N in either sequence do not count. Pairs of
+        unequal length, or involving an invalid sequence that is not
+        identical to its partner, get a distance of max_length + 1.
+        """
+
+        xor_words = self.codes[:, None] ^ other.codes[None, :]
+        # One bit per differing base, in the low bit of its 2 bit slot
+        diff_words = (xor_words | (xor_words >> numpy.uint64(1))) & numpy.uint64(self.low_bits)
+        diff_words &= ~(self.n_masks[:, None] | other.n_masks[None, :])
+
+        distances = self.popcount(diff_words)
+
+        comparable = (
+            self.valid[:, None] & other.valid[None, :] &
+            (self.lengths[:, None] == other.lengths[None, :])
+            )
+
+        distances[~comparable] = self.max_length + 1
+        distances[self.identical(other)] = 0
+
+        return distances
+
+def invalidate_comparisons(project_id):
+    """Drops the cached DataComparison results of a project."""
+
+    ComparisonResult.objects.filter(project_id=project_id).delete()
 
 class DataComparison(object):
     """Compares all core data objects to customer sample objects
 
     Comparison based on barcodes - returns list of barcodes with no complement.
-    Uses fuzzy string matching in case first read is N.
+    Exact i7/i5 pairs are matched through a hash lookup, the rest through
+    an IndexMatcher so that N calls and single base errors still match.
+
+    The 'numpy' backend instead computes the full customer by core distance
+    matrix from PackedIndexArray objects and keeps it on the instance as
+    'i7_distances', 'i5_distances' and 'distance_matrix' for diagnostics.
+
+    Core objects from a barcode analysis with fewer than
+    hopping_flag_threshold of their reads on the expected index are listed
+    in 'flagged_core' as possibly hopped or contaminated.
+
+    With detect_i5_orientation, customer i5 sequences are matched both as
+    given and reverse complemented. Every core index pair is looked up in
+    both orientations at once and the orientation matching the most core
+    indexes is used for the whole project, kept in 'i5_orientation' and
+    saved on the Project.
+
+    Results are cached as ComparisonResult rows keyed by a fingerprint of
+    the compared rows, see 'comparison_cache'. 'cached' tells whether the
+    last comparison came from the cache, in which case the numpy
+    diagnostics are not computed.
     """
 
-    def __init__(self, project_to_compare):
-        self.project_to_compare = project_to_compare
-
-    def compare_data(self):
+    result_fields = (
+        'match_num', 'matches', 'no_match_cust', 'no_match_core', 'flagged_core', 'i5_orientation',
+        'comparison_output'
+        )
 
-        core_data_objects = CoreData.objects.filter(project_id=self.project_to_compare)
-        customer_objects = ComponentInformation.objects.filter(project_id=self.project_to_compare)
+    def __init__(self, project_to_compare, backend=comparison_backend, cache=comparison_cache):
+        self.project_to_compare = project_to_compare
+        self.backend = backend
+        self.cache = cache
+        self.cached = False
 
-        core_index_list = []
-        customer_index_list = []
+    @staticmethod
+    def orientations(customer_index_list):
+        """Customer index pairs in every i5 orientation that is matched."""
+
+        orientations = {'forward': customer_index_list}
+        if detect_i5_orientation:
+            orientations['reverse_complement'] = [
+                (i7, reverse_complement(i5) if set(i5) <= set('ACGTN') else i5)
+                for i7, i5 in customer_index_list
+                ]
+        return orientations
+
+    def pick_orientation(self, votes):
+        """Sets 'i5_orientation' to the orientation most core indexes
+        matched in, None if none matched."""
+
+        self.i5_orientation = max(votes, key=votes.get) if any(votes.values()) else None
+        return self.i5_orientation or 'forward'
+
+    def match_hashed(self, customer_index_list, core_index_list):
+        """Returns the matching core position (or None) for each customer."""
+
+        orientations = self.orientations(customer_index_list)
+
+        # One pass over the customers builds the exact pair and neighborhood
+        # lookups of every orientation, only the i5 differs between them
+        exact_customers = {orientation: {} for orientation in orientations}
+        i7_matcher = IndexMatcher()
+        i5_matchers = {orientation: IndexMatcher() for orientation in orientations}
+
+        for position, (cust_i7, cust_i5) in enumerate(customer_index_list):
+            i7_matcher.add(cust_i7, position)
+            for orientation, index_list in orientations.items():
+                exact_customers[orientation].setdefault(index_list[position], []).append(position)
+                i5_matchers[orientation].add(index_list[position][1], position)
+
+        # First core position of each customer, exact pairs before ones in range
+        exact_positions = {orientation: {} for orientation in orientations}
+        range_positions = {orientation: {} for orientation in orientations}
+        votes = dict.fromkeys(orientations, 0)
+
+        for position, core_indexes in enumerate(core_index_list):
+            i7_candidates = i7_matcher.lookup(core_indexes[0])
+            matched_orientations = []
+
+            for orientation in orientations:
+                for customer in exact_customers[orientation].get(core_indexes, ()):
+                    exact_positions[orientation].setdefault(customer, position)
+
+                # Both indexes have to be in range of the same customer
+                candidates = i7_candidates & i5_matchers[orientation].lookup(core_indexes[1])
+                for customer in candidates:
+                    range_positions[orientation].setdefault(customer, position)
+                if candidates:
+                    matched_orientations.append(orientation)
+
+            # Cores matching either way say nothing about the orientation
+            if len(matched_orientations) == 1:
+                votes[matched_orientations[0]] += 1
+
+        orientation = self.pick_orientation(votes)
+
+        return [
+            exact_positions[orientation].get(customer, range_positions[orientation].get(customer))
+            for customer in range(len(customer_index_list))
+            ]
+
+    def match_vectorized(self, customer_index_list, core_index_list):
+        """Returns the matching core position (or None) for each customer."""
+
+        if not customer_index_list or not core_index_list:
+            self.i7_distances = self.i5_distances = self.distance_matrix = None
+            self.i5_orientation = None
+            return [None] * len(customer_index_list)
+
+        cust_i7 = PackedIndexArray([indexes[0] for indexes in customer_index_list])
+        core_i7 = PackedIndexArray([indexes[0] for indexes in core_index_list])
+        core_i5 = PackedIndexArray([indexes[1] for indexes in core_index_list])
+
+        self.i7_distances = cust_i7.distances(core_i7)
+        i7_identical = cust_i7.identical(core_i7)
+
+        i5_distances = {}
+        exact = {}
+        in_range = {}
+        for orientation, index_list in self.orientations(customer_index_list).items():
+            cust_i5 = PackedIndexArray([indexes[1] for indexes in index_list])
+            i5_distances[orientation] = cust_i5.distances(core_i5)
+            exact[orientation] = i7_identical & cust_i5.identical(core_i5)
+            in_range[orientation] = (
+                (self.i7_distances <= index_max_mismatches) &
+                (i5_distances[orientation] <= index_max_mismatches)
+                )
+
+        # Core indexes in range of a customer in exactly one orientation
+        core_matched = {orientation: matrix.any(axis=0) for orientation, matrix in in_range.items()}
+        orientations_matched = sum(matched.astype(int) for matched in core_matched.values())
+        votes = {
+            orientation: int((matched & (orientations_matched == 1)).sum())
+            for orientation, matched in core_matched.items()
+            }
+
+        orientation = self.pick_orientation(votes)
+        self.i5_distances = i5_distances[orientation]
+        self.distance_matrix = self.i7_distances + self.i5_distances
+
+        core_positions = []
+
+        for row in range(len(customer_index_list)):
+            if exact[orientation][row].any():
+                core_positions.append(int(exact[orientation][row].argmax()))
+            elif in_range[orientation][row].any():
+                core_positions.append(int(in_range[orientation][row].argmax()))
+            else:
+                core_positions.append(None)
+
+        return core_positions
+
+    def fingerprint(self, core_rows, customer_rows):
+        """Hash of the compared rows and every setting the result depends on."""
+
+        sha256 = hashlib.sha256(repr((
+            self.backend, index_max_mismatches, index_max_wildcards, hopping_flag_threshold,
+            detect_i5_orientation
+            )).encode())
+        for row in itertools.chain(core_rows, [None], customer_rows):
+            sha256.update(repr(row).encode())
+        return sha256.hexdigest()
+
+    def load_result(self, fingerprint):
+        """Restores a cached result, returns False if there is none."""
+
+        cached_result = ComparisonResult.objects.filter(
+            project_id=self.project_to_compare,
+            fingerprint=fingerprint
+            ).first()
+        if cached_result is None:
+            return False
+
+        cached_result.last_used_at = timezone.now()
+        cached_result.save(update_fields=['last_used_at'])
+
+        result = json.loads(cached_result.result)
+        self.match_num = result['match_num']
+        self.matches = [(tuple(cust), tuple(core)) for cust, core in result['matches']]
+        self.no_match_cust = [tuple(indexes) for indexes in result['no_match_cust']]
+        self.no_match_core = [tuple(indexes) for indexes in result['no_match_core']]
+        self.flagged_core = [tuple(flagged) for flagged in result['flagged_core']]
+        self.i5_orientation = result['i5_orientation']
+        self.comparison_output = result['comparison_output']
+
+        return True
+
+    def save_result(self, fingerprint):
+        """Caches the result, evicting expired and least recently used ones."""
+
+        now = timezone.now()
+        ComparisonResult.objects.create(
+            project_id = self.project_to_compare,
+            fingerprint = fingerprint,
+            result = json.dumps({field: getattr(self, field) for field in self.result_fields}),
+            last_used_at = now
+        )
+
+        ComparisonResult.objects.filter(
+            last_used_at__lt=now - datetime.timedelta(seconds=comparison_cache_ttl)
+            ).delete()
+        least_recently_used = ComparisonResult.objects.order_by(
+            '-last_used_at'
+            ).values_list('pk', flat=True)[comparison_cache_size:]
+        ComparisonResult.objects.filter(pk__in=list(least_recently_used)).delete()
 
-        for obj in core_data_objects:
-            core_index_list.append((str(obj.i7_index_sequence), str(obj.i5_index_sequence)))
+    def compare_data(self):
 
-        for obj in customer_objects:
-            customer_index_list.append((str(obj.i7_index_sequence), str(obj.i5_index_sequence)))
+        core_rows = list(CoreData.objects.filter(
+            project_id=self.project_to_compare
+            ).order_by('pk').values_list(
+                'filename', 'i7_index_sequence', 'i5_index_sequence',
+                'expected_index_fraction', 'unexpected_barcodes'
+                ))
+        customer_rows = list(ComponentInformation.objects.filter(
+            project_id=self.project_to_compare
+            ).order_by('pk').values_list('i7_index_sequence', 'i5_index_sequence'))
+
+        # Nothing to save a result against without any rows
+        use_cache = self.cache and (core_rows or customer_rows)
+        if use_cache:
+            fingerprint = self.fingerprint(core_rows, customer_rows)
+            self.cached = self.load_result(fingerprint)
+            if self.cached:
+                return
+
+        core_index_list = [(str(i7), str(i5)) for filename, i7, i5, fraction, unexpected in core_rows]
+        customer_index_list = [(str(i7), str(i5)) for i7, i5 in customer_rows]
+
+        if self.backend == 'numpy':
+            core_positions = self.match_vectorized(customer_index_list, core_index_list)
+        elif self.backend == 'hash':
+            core_positions = self.match_hashed(customer_index_list, core_index_list)
+        else:
+            raise Exception(f'Unknown comparison backend: {self.backend}')
 
         self.match_num = 0
-        match_list = []
+        self.matches = []
         self.no_match_core = []
         self.no_match_cust = []
+        matched_core_indexes = set()
 
-        for cust_indexes in customer_index_list:
-
-            found_match = False
-
-            for core_indexes in core_index_list:
-                # Matches first and second indexes with an 80% ratio
-                if fuzz.ratio(cust_indexes[0], core_indexes[0]) > 80 and \
-                   fuzz.ratio(cust_indexes[1], core_indexes[1]) > 80:
-                        self.match_num += 1
+        for cust_indexes, position in zip(customer_index_list, core_positions):
 
-                        # Add the customer and core indexes into the match_list
-                        if cust_indexes not in match_list and \
-                           core_indexes not in match_list:
-                            match_list.append(cust_indexes)
-                            match_list.append(core_indexes)
-                        found_match = True
-                        break
-
-            if not found_match:
+            if position is None:
                 # Aggregates indexes with no matches to anything
                 self.no_match_cust.append(cust_indexes)
+            else:
+                self.match_num += 1
+                self.matches.append((cust_indexes, core_index_list[position]))
+                matched_core_indexes.add(core_index_list[position])
 
         for core_indexes in core_index_list:
-            if core_indexes not in match_list:
+            if core_indexes not in matched_core_indexes:
                 self.no_match_core.append(core_indexes)
 
-        self.comparison_output = "\n".join([
+        self.flagged_core = [
+            (filename, fraction, json.loads(unexpected or '[]')[:3])
+            for filename, i7, i5, fraction, unexpected in core_rows
+            if fraction is not None
+            and fraction < hopping_flag_threshold
+            ]
+
+        output_lines = [
             "Cust Indexes: %s" % len(customer_index_list),
             "Core Indexes: %s" % len(core_index_list),
             "Matches: %s" % self.match_num,
+            "Customer i5 orientation: %s" % self.i5_orientation,
             "Customer Indexes with no matches: %s" % self.no_match_cust,
-            "Core Indexes with no matches: %s" % self.no_match_core
-        ])
+            "Core Indexes with no matches: %s" % self.no_match_core,
+        ]
+        # Only files imported with barcode analysis can be flagged
+        if any(fraction is not None for filename, i7, i5, fraction, unexpected in core_rows):
+            output_lines.append("Core files possibly hopped or contaminated: %s" % self.flagged_core)
+        self.comparison_output = "\n".join(output_lines)
+
+        if self.i5_orientation is not None:
+            Project.objects.filter(
+                project_id=self.project_to_compare
+                ).update(i5_orientation=self.i5_orientation)
+
+        if use_cache:
+            self.save_result(fingerprint)
+
+class LaneCollisionAnalysis(object):
+    """Finds index collisions between projects pooled on one flowcell lane.
+
+    The libraries of a lane are the distinct index pairs of its CoreData
+    and of the ComponentInformation of every project with CoreData on it.
+    Indexes are cut to the shortest i7 and i5 on the lane, as that is all
+    demultiplexing can tell apart, so a library without an i5 leaves the
+    lane compared on i7 alone.
+
+    Both indexes are split into max_distance + 1 segments, so two indexes
+    in range share at least one segment exactly. Libraries are hashed on
+    every combination of an i7 and an i5 segment, with N bases expanded,
+    and only libraries sharing a key are compared base by base. Unlike an
+    IndexMatcher neighborhood the keys per library do not grow with the
+    index length or distance. 'collisions' holds (library, library, i7
+    mismatches, i5 mismatches), closest first, each library being
+    (project_id, i7, i5, sample IDs).
+    """
+
+    def __init__(self, flowcell_id, lane, max_distance=collision_max_distance):
+        self.flowcell_id = flowcell_id
+        self.lane = lane
+        self.max_distance = max_distance
+
+    @staticmethod
+    def shared_lanes(project_id=None):
+        """(flowcell_id, lane) of every lane holding more than one project,
+        only those of 'project_id' if given."""
+
+        shared = CoreData.objects.values('flowcell_id', 'lane').annotate(
+            projects=Count('project', distinct=True)
+            ).filter(projects__gt=1).order_by('flowcell_id', 'lane')
+        lanes = [(row['flowcell_id'], row['lane']) for row in shared]
+
+        if project_id is not None:
+            project_lanes = set(CoreData.objects.filter(
+                project_id=project_id
+                ).values_list('flowcell_id', 'lane'))
+            lanes = [lane for lane in lanes if lane in project_lanes]
+
+        return lanes
+
+    @staticmethod
+    def mismatches(sequence, other):
+        """Substitutions between two sequences of equal length, N matches
+        anything."""
+
+        return sum(
+            1 for base, other_base in zip(sequence, other)
+            if base != other_base and base != 'N' and other_base != 'N'
+            )
+
+    def segments(self, sequence):
+        """(segment number, segment) keys of a sequence cut into
+        max_distance + 1 parts, with every base substitution of N's."""
+
+        num_segments = self.max_distance + 1
+        expander = IndexMatcher(max_wildcards=len(sequence))
+        keys = set()
+
+        for number in range(num_segments):
+            segment = sequence[
+                number * len(sequence) // num_segments:(number + 1) * len(sequence) // num_segments
+                ]
+            keys.update((number, expanded) for expanded in expander.expand_wildcards(segment))
+
+        return keys
+
+    def libraries(self):
+        """Distinct (project_id, i7, i5) on the lane mapped to their sample IDs."""
+
+        core_rows = list(CoreData.objects.filter(
+            flowcell_id=self.flowcell_id, lane=self.lane
+            ).values_list('project_id', 'sample_id', 'i7_index_sequence', 'i5_index_sequence'))
+        customer_rows = ComponentInformation.objects.filter(
+            project_id__in=set(project_id for project_id, *fields in core_rows)
+            ).values_list('project_id', 'sample_id', 'i7_index_sequence', 'i5_index_sequence')
+
+        libraries = {}
+        for project_id, sample_id, i7, i5 in itertools.chain(core_rows, customer_rows):
+            i7, i5 = [
+                '' if sequence in (None, 'None') else str(sequence).upper()
+                for sequence in (i7, i5)
+                ]
+            libraries.setdefault((project_id, i7, i5), set()).add(sample_id)
+
+        return libraries
+
+    def analyse(self):
+
+        libraries = self.libraries()
+        i7_length = min((len(i7) for project_id, i7, i5 in libraries), default=0)
+        i5_length = min((len(i5) for project_id, i7, i5 in libraries), default=0)
+
+        # Libraries that look the same once cut down are merged
+        trimmed = {}
+        for (project_id, i7, i5), sample_ids in libraries.items():
+            trimmed.setdefault((project_id, i7[:i7_length], i5[:i5_length]), set()).update(sample_ids)
+        self.libraries_compared = [
+            (project_id, i7, i5, sorted(sample_ids))
+            for (project_id, i7, i5), sample_ids in sorted(trimmed.items())
+            ]
+
+        buckets = {}
+        for position, (project_id, i7, i5, sample_ids) in enumerate(self.libraries_compared):
+            for key in itertools.product(self.segments(i7), self.segments(i5)):
+                buckets.setdefault(key, []).append(position)
+
+        candidates = set()
+        for positions in buckets.values():
+            candidates.update(itertools.combinations(positions, 2))
+
+        self.collisions = []
+        for position, other_position in sorted(candidates):
+            library = self.libraries_compared[position]
+            other = self.libraries_compared[other_position]
+            if library[0] == other[0]:
+                continue
+
+            i7_mismatches = self.mismatches(library[1], other[1])
+            i5_mismatches = self.mismatches(library[2], other[2])
+            if i7_mismatches <= self.max_distance and i5_mismatches <= self.max_distance:
+                self.collisions.append((library, other, i7_mismatches, i5_mismatches))
+
+        self.collisions.sort(key=lambda collision: collision[2] + collision[3])
+
+        return self.collisions
+
+    def report(self):
+
+        lines = [
+            f"Flowcell {self.flowcell_id} lane {self.lane}: "
+            f"{len(self.libraries_compared)} libraries, "
+            f"{len(self.collisions)} cross-project collisions within {self.max_distance} mismatches"
+            ]
+        for library, other, i7_mismatches, i5_mismatches in self.collisions:
+            lines.append(
+                f"  {library[0]} {library[1]}+{library[2]} {library[3]} ~ "
+                f"{other[0]} {other[1]}+{other[2]} {other[3]}: "
+                f"i7 {i7_mismatches}, i5 {i5_mismatches}"
+                )
+
+        return "\n".join(lines)
+
+def lane_collisions(project_id=None, max_distance=collision_max_distance):
+    """Reports the collisions on every lane shared between projects, only
+    the lanes of 'project_id' if given."""
+
+    reports = []
+    for flowcell_id, lane in LaneCollisionAnalysis.shared_lanes(project_id):
+        analysis = LaneCollisionAnalysis(flowcell_id, lane, max_distance)
+        analysis.analyse()
+        reports.append(analysis.report())
+
+    return "\n".join(reports)
+
+class UndeterminedMiner(object):
+    """Looks for a project's unmatched customer indexes in Undetermined reads.
+
+    The R1 Undetermined FastQs in 'fastq_directory' are streamed in a
+    process pool, one file per worker, each counting its barcodes in a
+    CountMinSketch. The sketches are merged and the most common barcodes
+    matched against customer indexes DataComparison could not match,
+    forwards and with either index reverse complemented or i7 and i5
+    swapped, through IndexMatcher.
+    """
+
+    # How the observed (i7, i5) pair relates to the customer's
+    orientations = {
+        'forward': lambda i7, i5: (i7, i5),
+        'i7 reverse complemented': lambda i7, i5: (reverse_complement(i7), i5),
+        'i5 reverse complemented': lambda i7, i5: (i7, reverse_complement(i5)),
+        'both reverse complemented': lambda i7, i5: (reverse_complement(i7), reverse_complement(i5)),
+        'swapped': lambda i7, i5: (i5, i7),
+        'swapped, reverse complemented': lambda i7, i5: (reverse_complement(i5), reverse_complement(i7)),
+        }
+
+    def __init__(self, project_id, fastq_directory, processes=fastq_import_processes):
+        self.project_id = project_id
+        self.fastq_directory = fastq_directory
+        self.processes = processes
+
+    def undetermined_files(self):
+        undetermined = []
+
+        for fastq_file in sorted(os.listdir(self.fastq_directory)):
+            if fastq_file.startswith('Undetermined') and fastq_file.endswith('.fastq.gz'):
+                # Both reads of a pair carry the same barcodes
+                if FastQParser.parse_illumina_filename(fastq_file).get('read', 'R1') == 'R1':
+                    undetermined.append(os.path.join(self.fastq_directory, fastq_file))
+
+        return undetermined
+
+    @staticmethod
+    def count_barcodes(fastq_path):
+        """CountMinSketch of the barcodes of one FastQ.
+
+        Headers are tallied a batch at a time so every distinct barcode
+        touches the sketch once per batch rather than once per read.
+        """
+
+        sketch = CountMinSketch()
+
+        with open_fastq(fastq_path) as fastq_file_obj:
+            headers = itertools.islice(fastq_file_obj, 0, None, 4)
+            while True:
+                batch = collections.Counter(
+                    header.rstrip(b'\r\n ').rpartition(b':')[2]
+                    for header in itertools.islice(headers, undetermined_batch_reads)
+                    )
+                if not batch:
+                    break
+                for barcode, count in batch.items():
+                    sketch.update(barcode, count)
+
+        return sketch
+
+    def count_undetermined(self):
+        fastq_paths = self.undetermined_files()
+
+        if self.processes > 1 and len(fastq_paths) > 1:
+            with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                sketches = list(executor.map(self.count_barcodes, fastq_paths))
+        else:
+            sketches = [self.count_barcodes(fastq_path) for fastq_path in fastq_paths]
+
+        self.sketch = CountMinSketch()
+        for sketch in sketches:
+            self.sketch.merge(sketch)
+
+        return self.sketch
+
+    def unmatched_customers(self):
+        comparer = DataComparison(self.project_id)
+        comparer.compare_data()
+        no_match_cust = set(comparer.no_match_cust)
+
+        return [
+            obj for obj in ComponentInformation.objects.filter(project_id=self.project_id)
+            if (str(obj.i7_index_sequence), str(obj.i5_index_sequence)) in no_match_cust
+            ]
+
+    def mine(self):
+        """Counts the Undetermined barcodes and matches the most common ones.
+
+        Sets 'findings', a list of (customer object, orientation, barcode,
+        estimated reads) tuples ordered by reads, and returns the report.
+        """
 
-def error_logger(error, project_id):
-    """Creates database entries for failed / erroneous runs"""
+        self.count_undetermined()
+
+        i7_matcher = IndexMatcher()
+        i5_matcher = IndexMatcher()
+        customers = self.unmatched_customers()
+
+        for position, obj in enumerate(customers):
+            for orientation, orient in self.orientations.items():
+                i7_index_seq, i5_index_seq = orient(obj.i7_index_sequence or '', obj.i5_index_sequence or '')
+                i7_matcher.add(i7_index_seq, (position, orientation))
+                i5_matcher.add(i5_index_seq, (position, orientation))
+
+        self.findings = []
+
+        for barcode, reads in self.sketch.most_common():
+            i7_index_seq, _, i5_index_seq = barcode.decode('ascii').partition('+')
+            # Both indexes have to be in range of the same customer orientation
+            matched = i7_matcher.lookup(i7_index_seq) & i5_matcher.lookup(i5_index_seq)
+            for position in sorted({position for position, orientation in matched}):
+                # Palindromic indexes match in several orientations, report the first
+                orientation = next(
+                    orientation for orientation in self.orientations
+                    if (position, orientation) in matched
+                    )
+                self.findings.append((customers[position], orientation, barcode.decode('ascii'), reads))
+
+        return self.report()
+
+    def report(self):
+        lines = [
+            "Undetermined reads: %s" % self.sketch.total,
+            "Most common barcodes: %s" % [
+                (barcode.decode('ascii'), reads) for barcode, reads in self.sketch.most_common(10)
+                ],
+            ]
+
+        for obj, orientation, barcode, reads in self.findings:
+            lines.append(
+                "%s (%s+%s) found as %s, %s: ~%s reads" % (
+                    obj.sample_id, obj.i7_index_sequence, obj.i5_index_sequence,
+                    barcode, orientation, reads)
+                )
+
+        if not self.findings:
+            lines.append("No unmatched customer indexes found in Undetermined reads")
+
+        return "\n".join(lines)
+
+def mine_undetermined(project_id, fastq_directory):
+    """rq job reporting where unmatched customer indexes ended up."""
+
+    return UndeterminedMiner(project_id, fastq_directory).mine()
+
+def error_logger(project_id, status, details):
+    """Creates database entries for finished, failed or erroneous runs"""
+    Project.objects.get_or_create(project_id=project_id)
     ExecutionStats.objects.create(
         project_id = project_id,
         exec_date = datetime.datetime.now(),
-        exec_status = 'FAIL',
-        fail_reason = error
+        exec_status = status,
+        fail_reason = details
     )
@@ -1,26 +1,45 @@
 import datetime
+import json
 import os
 import shutil
 
-from django.shortcuts import render
+import django_rq
+import redis
+from django.shortcuts import render, get_object_or_404
 from django.views import generic
 from django.views.generic.list import ListView
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.forms import ModelForm
 from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
 
-from .models import ComponentInformation, TubeInformation, CoreData, ExecutionStats
+from .models import Project, ComponentInformation, TubeInformation, CoreData, ExecutionStats, ImportJob
 from .constants import PROJECT_STORAGE
 from .forms import ImportCompareForm
-from .utils import error_logger, SubmissionExcelParser, FastQParser, DataComparison
+from .utils import (
+    error_logger, SubmissionExcelParser, FastQParser, DataComparison, FastQCatalog,
+    progress_channel, publish_progress, progress_events, invalidate_comparisons, lane_collisions
+    )
+
+## Imports run on the default queue, see QC.views for starting the
+## redis-server and rqworker it needs.
+q = django_rq.get_queue('default')
 
 def import_and_compare_handler(request):
+    """Queues the import and comparison of a submission sheet.
+
+    The uploaded sheet is saved to the project's 'Sample_Sheet' directory
+    and an ImportJob is enqueued for it. The response holds the job and the
+    URLs of its status endpoint and event stream, see 'import_status' and
+    'import_events', the comparison output ends up there once the job is
+    done.
+    """
 
     if request.method == 'POST':
 
         project_dir = ''
         fastq_dir = ''
-        uploadedFilePath = None
 
         form = ImportCompareForm(request.POST,
                                  request.FILES)
@@ -31,47 +50,170 @@ def import_and_compare_handler(request):
                 fastq_dir = os.path.join(project_dir, 'FastQ_Files')
             elif form.cleaned_data['outside_directory']:
                 fastq_dir = form.cleaned_data['outside_directory']
+                project_dir = os.path.dirname(os.path.normpath(fastq_dir))
 
             if not os.path.isdir(fastq_dir):
                 return HttpResponse(f"Invalid Core Facility Data Path: {fastq_dir}")
 
-            fastq_in_dir = 0
-            for root, dirs, files in os.walk(fastq_dir):
-                for file in files:
-                    if file.endswith('.fastq.gz'):
-                        fastq_in_dir += 1
+            catalog = FastQCatalog()
+            catalog.refresh(fastq_dir, full=True)
+            fastq_in_dir = catalog.files_in(fastq_dir).count()
             if fastq_in_dir == 0:
                 return HttpResponse(f"No FastQ files in directory {fastq_dir}")
 
             submissionSheetFile = form.cleaned_data['sub_sheet']
             delete_previous     = form.cleaned_data['delete_previous']
-            uploadedFilePath    = handle_uploaded_file(submissionSheetFile, project_directory)
+            uploadedFilePath    = handle_uploaded_file(submissionSheetFile, project_dir)
+
+            import_job = ImportJob.objects.create(
+                sheet_path = uploadedFilePath,
+                fastq_directory = fastq_dir,
+                delete_previous = delete_previous,
+                enqueued_at = timezone.now()
+            )
 
             try:
-                comparison_output = import_and_compare(submissionSheetFile, fastq_directory, delete_previous)
-            except Exception as fail:
-                error_logger(fail.args[0], 'FAIL', (fail.args[1] + fail.args[2]))
-                return HttpResponse(f"Run failed because of {fail.args}")
+                job = q.enqueue(run_import_job, import_job.pk)
+            except redis.exceptions.ConnectionError as error:
+                import_job.finish('FAILED', "Could not connect to redis.")
+                return HttpResponse(
+                    "Redis could not connect to a queue, please ensure "
+                    "that redis-server is installed and running."
+                    )
+
+            import_job.job_id = job.id
+            import_job.save(update_fields=['job_id'])
 
-            return HttpResponse(comparison_output, content_type="text/plain")
+            return JsonResponse({
+                'import_job': import_job.pk,
+                'job_id': job.id,
+                'status_url': reverse('import_status', args=[import_job.pk]),
+                'events_url': reverse('import_events', args=[import_job.pk]),
+                }, status=202)
+
+        else:
+            return HttpResponse("Form invalid.")
     else:
         form = ImportCompareForm()
         return render(request, 'Transfer/generic_form.html', {'form': form})
 
 
+def import_status(request, import_job_id):
+    """JSON state of an ImportJob: status, current stage and stage timings."""
+
+    import_job = get_object_or_404(ImportJob, pk=import_job_id)
+    progress = import_job.progress()
+    if import_job.project_id:
+        progress['comparison'] = reverse('comparison_result', args=[import_job.project_id])
+    return JsonResponse(progress)
+
+
+def comparison_result(request, project_id):
+    """JSON result of comparing a project's customer and core indexes.
+
+    Served from the comparison cache while neither the project's rows nor
+    the comparison settings have changed since the last comparison.
+    """
+
+    project = get_object_or_404(Project, pk=project_id)
+    comparer = DataComparison(project.project_id)
+    comparer.compare_data()
+
+    result = {field: getattr(comparer, field) for field in comparer.result_fields}
+    result['cached'] = comparer.cached
+    return JsonResponse(result)
+
+
+def import_events(request, import_job_id):
+    """Server-sent events with the live progress of an ImportJob.
+
+    The first event is the state 'import_status' would return, followed by
+    the stage changes published by the worker until the job finishes.
+    """
+
+    get_object_or_404(ImportJob, pk=import_job_id)
+
+    def snapshot():
+        progress = ImportJob.objects.get(pk=import_job_id).progress()
+        if progress['status'] in ('DONE', 'FAILED'):
+            progress['event'] = 'job_finished'
+        return progress
+
+    response = StreamingHttpResponse(
+        progress_events(progress_channel('import', import_job_id), snapshot),
+        content_type='text/event-stream'
+        )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def run_import_job(import_job_id):
+    """rq job running 'import_and_compare' for a queued ImportJob.
+
+    Failures are logged against the project once the sheet has been read,
+    the job is marked failed and the exception re-raised so that rq keeps
+    it in the failed registry.
+    """
+
+    import_job = ImportJob.objects.get(pk=import_job_id)
+    import_job.status = 'RUNNING'
+    import_job.started_at = timezone.now()
+    import_job.save(update_fields=['status', 'started_at'])
+    channel = progress_channel('import', import_job.pk)
+    publish_progress(channel, 'job_started', import_job=import_job.pk)
+
+    try:
+        comparison_output = import_and_compare(
+            import_job.sheet_path,
+            import_job.fastq_directory,
+            import_job.delete_previous,
+            import_job
+            )
+    except Exception as fail:
+        import_job.finish('FAILED', f"Run failed because of {fail.args}")
+        publish_progress(channel, 'job_finished', **import_job.progress())
+        if len(fail.args) == 3 and isinstance(fail.args[2], str):
+            error_logger(fail.args[0], 'FAIL', f"{fail.args[1]} {fail.args[2]}")
+        raise
+
+    import_job.finish('DONE', comparison_output)
+    publish_progress(channel, 'job_finished', **import_job.progress())
+    return comparison_output
+
+
 @transaction.atomic
 def delete_preexisting_wo_objects(project_id):
     CoreData.objects.filter(project_id=project_id).delete()
     ComponentInformation.objects.filter(project_id=project_id).delete()
     TubeInformation.objects.filter(project_id=project_id).delete()
+    invalidate_comparisons(project_id)
+
+
+def import_and_compare(sub_sheet_path, fastq_directory, delete_previous, import_job=None):
+        """Imports a submission sheet and its FastQ headers, then compares them.
 
+        With an 'import_job' every stage is recorded on it as it starts and
+        published to its progress channel.
+        """
 
-def import_and_compare(sub_sheet_path, fastq_directory, delete_previous):
+        def enter_stage(stage, **fields):
+            if import_job is not None:
+                import_job.enter_stage(stage)
+                publish_progress(
+                    progress_channel('import', import_job.pk), 'stage',
+                    stage=stage, stage_timings=json.loads(import_job.stage_timings), **fields
+                    )
 
         # Create customer submission sheet instance
+        enter_stage('sheet')
         current_sheet = SubmissionExcelParser(sub_sheet_path)
         print('Excel parser initialized')
 
+        if import_job is not None:
+            import_job.project, _ = Project.objects.get_or_create(
+                project_id=current_sheet.project_id_from_sheet)
+
         preexisting_wo_objects = (
             CoreData.objects.filter(project_id=current_sheet.project_id_from_sheet).count() +
             ComponentInformation.objects.filter(project_id=current_sheet.project_id_from_sheet).count() +
@@ -83,13 +225,12 @@ def import_and_compare(sub_sheet_path, fastq_directory, delete_previous):
             if delete_previous == True:
                 delete_preexisting_wo_objects(current_sheet.project_id_from_sheet)
             else:
-                error_logger(current_sheet.project_id_from_sheet, 'FAIL', "Duplicate Project ID")
                 message = (
                     f"There are already {preexisting_wo_objects} "
                     f"database entries for Work Order: {current_sheet.project_id_from_sheet}. "
                     "You can delete them by checking the box on the form."
                     )
-                return message
+                raise Exception(current_sheet.project_id_from_sheet, message, "Duplicate Project ID")
 
         try:
             current_sheet.find_columns()
@@ -120,6 +261,7 @@ def import_and_compare(sub_sheet_path, fastq_directory, delete_previous):
                 raise
 
         # Create fastQ parsing instance
+        enter_stage('fastq')
         try:
             importer = FastQParser(fastq_directory, current_sheet.project_id_from_sheet)
         except Exception as fail:
@@ -128,13 +270,19 @@ def import_and_compare(sub_sheet_path, fastq_directory, delete_previous):
             raise
 
         try:
-            importer.parse_fastq_filenames() > 0
+            if importer.parse_fastq_files() == 0:
+                raise Exception('No FastQ files parsed')
         except Exception as fail:
             print(fail)
             fail.args = (current_sheet.project_id_from_sheet, fail.args, 'No fastq files in directory: {}'.format(fastq_directory))
             raise
 
         # Create comparison instance
+        enter_stage(
+            'compare',
+            fastq_files=len(importer.bytes_read),
+            bytes_processed=sum(importer.bytes_read.values())
+            )
         try:
             comparer = DataComparison(current_sheet.project_id_from_sheet)
         except Exception as fail:
@@ -144,13 +292,23 @@ def import_and_compare(sub_sheet_path, fastq_directory, delete_previous):
 
         try:
             comparer.compare_data()
-            error_logger(current_sheet.project_id_from_sheet, 'OK', comparer.comparison_output)
         except Exception as fail:
             print(fail)
-            fail.args = (current_sheet.project_id_from_sheet.encode, fail.args, "Failed on 'compare_data' method")
+            fail.args = (current_sheet.project_id_from_sheet, fail.args, "Failed on 'compare_data' method")
+            raise
+
+        # Other projects sharing a lane with this one
+        try:
+            collision_report = lane_collisions(current_sheet.project_id_from_sheet)
+        except Exception as fail:
+            print(fail)
+            fail.args = (current_sheet.project_id_from_sheet, fail.args, "Failed on lane collision analysis")
             raise
 
-        return comparer.comparison_output
+        comparison_output = "\n".join(filter(None, [comparer.comparison_output, collision_report]))
+        error_logger(current_sheet.project_id_from_sheet, 'OK', comparison_output)
+
+        return comparison_output
 
 
 def handle_uploaded_file(file_, proj_dir):
@@ -159,6 +317,7 @@ def handle_uploaded_file(file_, proj_dir):
         datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S') + '.xlsx'
     )
 
+    os.makedirs(os.path.dirname(newPath), exist_ok=True)
     with open(newPath, 'wb+') as destination:
         for chunk in file_.chunks():
             destination.write(chunk)
@@ -7,7 +7,11 @@ sudo apt-get install mysql-server default-libmysqlclient-dev default-jre unzip
 sudo apt-get install python3-pip python3-dev redis
 
 # Install python packages
-pip3 install mysqlclient Django fuzzywuzzy rq django-rq multiqc openpyxl python-Levenshtein
+pip3 install mysqlclient Django rq django-rq multiqc openpyxl
+# Optional: numpy for vectorized comparison and quick-look QC, indexed_gzip
+# for saved gzip seek indexes, isal for faster FastQ decompression and
+# inotify_simple to wake the delivery watcher on file events
+pip3 install numpy indexed_gzip isal inotify_simple
 
 # Install FastQC
 cd /usr/local/src